@@ -0,0 +1,365 @@
+#Monthly rollups of climate_data, so period averages/totals don't have to re-read every daily row.
+#
+#climate_monthly holds, for every station, metric and calendar month:
+#    total (SUM), value_count (COUNT of non-null values), row_count (COUNT(*)), min_value, max_value
+#
+#Build it once (offline, writes to climate.db):   python aggregates.py build
+#After new daily rows are appended:                python aggregates.py refresh
+#
+#The page modules ask this module for range statistics. A date range is split into the whole
+#months it covers (answered from climate_monthly) plus the partial months at either end
+#(answered from the daily rows). If the rollup is missing, out of date or doesn't cover a
+#metric, everything is answered from the daily rows instead, exactly like before.
+#
+#Only appended rows are picked up by `refresh`. If existing rows are edited or deleted, run
+#`build` again.
+#
+#If the NumPy column store (columnstore.py) has been loaded for the database, range statistics
+#come from there instead, and SQL is only used for what it can't answer.
+
+import argparse
+import datetime
+import os
+import sqlite3
+
+import columnstore
+import metacache
+
+DB_PATH = os.path.join(os.path.dirname(__file__), "database", "climate.db")
+
+NUMERIC_TYPES = ("INT", "REAL", "FLOA", "DOUB", "NUM", "DEC")
+#Station lists go into station_id IN (...) this many at a time (older SQLite builds allow
+#only 999 parameters per statement)
+MAX_IN_PARAMS = 500
+
+
+def get_rollup_metrics(conn):
+    #Metric columns the rollup can answer for. Empty if it hasn't been built or new daily
+    #rows were added since the last build/refresh (a stale rollup would give wrong answers).
+    #Cached until the database file changes
+    database = get_database_path(conn)
+    if not database:
+        return load_rollup_metrics(conn)
+    return metacache.lookup(("aggregates.get_rollup_metrics", database), database, lambda: load_rollup_metrics(conn))
+
+
+def load_rollup_metrics(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('climate_monthly_metrics', 'climate_monthly_state');")
+    if len(cur.fetchall()) < 2:
+        return set()
+    cur.execute("SELECT value FROM climate_monthly_state WHERE key='last_rowid';")
+    row = cur.fetchone()
+    built_upto = row[0] if row else None
+    cur.execute("SELECT MAX(rowid) FROM climate_data;")
+    if cur.fetchone()[0] != built_upto:
+        return set()
+    cur.execute("SELECT metric FROM climate_monthly_metrics;")
+    return {row[0] for row in cur.fetchall()}
+
+
+def get_database_path(conn):
+    return conn.execute("PRAGMA database_list;").fetchone()[2]
+
+
+def has_rollup(conn, metric=None):
+    metrics = get_rollup_metrics(conn)
+    return bool(metrics) if metric is None else metric in metrics
+
+
+def get_column_store(conn, metrics=()):
+    #The loaded column store if it has all these metrics, otherwise None
+    store = columnstore.get_store(get_database_path(conn))
+    if store is not None and store.has_metrics(metrics):
+        return store
+    return None
+
+
+def has_range_stats(conn, metric=None):
+    #True if get_range_stats can answer without reading every daily row in the range: the
+    #column store is loaded or the monthly rollup covers the metric
+    return get_column_store(conn, [metric] if metric else []) is not None or has_rollup(conn, metric)
+
+
+def split_range(start, end):
+    #Splits the inclusive date range into whole months ((y, m) first, (y, m) last) plus the
+    #leftover partial-month ranges. Returns (None, [(start, end)]) if nothing can come from
+    #the rollup, eg. a range inside one month or dates not in YYYY-MM-DD form
+    try:
+        s = datetime.date.fromisoformat(start)
+        e = datetime.date.fromisoformat(end)
+    except (TypeError, ValueError):
+        return None, [(start, end)]
+    if s.isoformat() != start or e.isoformat() != end:
+        return None, [(start, end)]
+    if s > e:
+        return None, []
+
+    first = s if s.day == 1 else (s.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    last = e if (e + datetime.timedelta(days=1)).day == 1 else e.replace(day=1) - datetime.timedelta(days=1)
+    if first > last:
+        return None, [(start, end)]
+
+    edges = []
+    if s < first:
+        edges.append((start, (first - datetime.timedelta(days=1)).isoformat()))
+    if e > last:
+        edges.append(((last + datetime.timedelta(days=1)).isoformat(), end))
+    return ((first.year, first.month), (last.year, last.month)), edges
+
+
+def get_station_filters(station_id=None, station_ids=None):
+    #[(condition, params)] covering the stations asked for: one station, a list of stations
+    #(one IN per chunk of MAX_IN_PARAMS, so several statements for a long list) or, with
+    #both None, every station
+    if station_id is not None:
+        return [("station_id = ? AND ", [station_id])]
+    if station_ids is None:
+        return [("", [])]
+    station_ids = list(dict.fromkeys(str(sid) for sid in station_ids))
+    chunks = [station_ids[i:i + MAX_IN_PARAMS] for i in range(0, len(station_ids), MAX_IN_PARAMS)]
+    return [(f"station_id IN ({', '.join('?' for _ in chunk)}) AND ", chunk) for chunk in chunks]
+
+
+def add_stats(stats, key, total, value_count, row_count):
+    old = stats.get(key)
+    if old is None:
+        stats[key] = (total, value_count, row_count)
+        return
+    if total is None:
+        total = old[0]
+    elif old[0] is not None:
+        total = old[0] + total
+    stats[key] = (total, old[1] + value_count, old[2] + row_count)
+
+
+def get_raw_stats(conn, metrics, start, end, station_id=None, stats=None, station_ids=None):
+    #Same statistics straight from the daily rows
+    stats = {} if stats is None else stats
+    if not metrics:
+        return stats
+    columns = ", ".join(f"SUM([{m}]), COUNT([{m}])" for m in metrics)
+    cur = conn.cursor()
+    for station_filter, params in get_station_filters(station_id, station_ids):
+        cur.execute(f"""
+            SELECT station_id, COUNT(*), {columns}
+            FROM climate_data
+            WHERE {station_filter}date BETWEEN ? AND ?
+            GROUP BY station_id;
+        """, params + [start, end])
+        for row in cur.fetchall():
+            for i, m in enumerate(metrics):
+                add_stats(stats, (str(row[0]), m), row[2 + 2 * i], row[3 + 2 * i], row[1])
+    return stats
+
+
+def get_range_stats(conn, metrics, start, end, station_id=None, station_ids=None):
+    #Returns {(station_id as str, metric): (total, non-null count, row count)} for the
+    #inclusive date range, for one station, a list of stations or (both None) every station
+    store = get_column_store(conn, metrics)
+    if store is not None:
+        stats = store.range_stats(metrics, start, end, station_id, station_ids)
+        if stats is not None:
+            return stats
+
+    rollup_metrics = get_rollup_metrics(conn)
+    rolled = [m for m in metrics if m in rollup_metrics]
+    raw = [m for m in metrics if m not in rollup_metrics]
+
+    stats = get_raw_stats(conn, raw, start, end, station_id, station_ids=station_ids)
+    if not rolled:
+        return stats
+
+    months, edges = split_range(start, end)
+    if months is not None:
+        (y1, m1), (y2, m2) = months
+        cur = conn.cursor()
+        for station_filter, params in get_station_filters(station_id, station_ids):
+            cur.execute(f"""
+                SELECT station_id, metric, SUM(total), SUM(value_count), SUM(row_count)
+                FROM climate_monthly
+                WHERE {station_filter}metric IN ({', '.join('?' for _ in rolled)})
+                    AND (year, month) BETWEEN (?, ?) AND (?, ?)
+                GROUP BY station_id, metric;
+            """, params + list(rolled) + [y1, m1, y2, m2])
+            for row in cur.fetchall():
+                add_stats(stats, (str(row[0]), row[1]), row[2], row[3], row[4])
+    for edge_start, edge_end in edges:
+        get_raw_stats(conn, rolled, edge_start, edge_end, station_id, stats, station_ids)
+    return stats
+
+
+def get_station_range_stats(conn, station_id, metric, start, end):
+    return get_range_stats(conn, [metric], start, end, station_id).get((str(station_id), metric), (None, 0, 0))
+
+
+def get_station_range_avg(conn, station_id, metric, start, end):
+    #AVG(metric) for one station over the range, None if there are no values
+    total, value_count, row_count = get_station_range_stats(conn, station_id, metric, start, end)
+    return total / value_count if value_count else None
+
+
+def get_station_range_total(conn, station_id, metric, start, end):
+    #SUM(metric) for one station over the range, None if there are no values
+    total, value_count, row_count = get_station_range_stats(conn, station_id, metric, start, end)
+    return total if value_count else None
+
+
+def get_all_stations_range_avgs(conn, metric, start, end, station_ids=None):
+    #{station_id: AVG(metric) or None} for every station (or just `station_ids`) with rows in
+    #the range
+    return {
+        sid: (total / value_count if value_count else None)
+        for (sid, m), (total, value_count, row_count) in get_range_stats(conn, [metric], start, end, station_ids=station_ids).items()
+    }
+
+
+#Building and refreshing (needs a writable connection, not the read-only pool)
+
+def get_numeric_metrics(conn):
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(climate_data);")
+    return [
+        col[1] for col in cur.fetchall()
+        if col[1] not in ("station_id", "date") and any(t in (col[2] or "").upper() for t in NUMERIC_TYPES)
+    ]
+
+
+def create_tables(conn):
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(climate_data);")
+    station_type = next((col[2] for col in cur.fetchall() if col[1] == "station_id"), "")
+    #station_id gets the same type as climate_data.station_id so lookups with a string id
+    #from a form behave the same as they do against climate_data
+    conn.executescript(f"""
+        DROP TABLE IF EXISTS climate_monthly;
+        DROP TABLE IF EXISTS climate_monthly_metrics;
+        DROP TABLE IF EXISTS climate_monthly_state;
+        CREATE TABLE climate_monthly (
+            metric TEXT NOT NULL,
+            station_id {station_type},
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            total,
+            value_count INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            min_value,
+            max_value,
+            PRIMARY KEY (metric, station_id, year, month)
+        ) WITHOUT ROWID;
+        CREATE TABLE climate_monthly_metrics (metric TEXT PRIMARY KEY);
+        CREATE TABLE climate_monthly_state (key TEXT PRIMARY KEY, value);
+    """)
+
+
+def insert_rollup_rows(conn, metrics, source, params=()):
+    #One grouped pass over the daily rows in `source` (a table or subquery) into a wide temp
+    #table, then one small insert per metric to turn it into climate_monthly rows
+    columns = ",\n".join(
+        f"SUM([{m}]) AS s{i}, COUNT([{m}]) AS c{i}, MIN([{m}]) AS lo{i}, MAX([{m}]) AS hi{i}"
+        for i, m in enumerate(metrics)
+    )
+    conn.execute("DROP TABLE IF EXISTS temp.rollup_wide;")
+    conn.execute(f"""
+        CREATE TEMP TABLE rollup_wide AS
+        SELECT station_id, CAST(substr(date, 1, 4) AS INTEGER) AS year,
+               CAST(substr(date, 6, 2) AS INTEGER) AS month, COUNT(*) AS n,
+               {columns}
+        FROM {source}
+        GROUP BY station_id, substr(date, 1, 7);
+    """, params)
+    for i, m in enumerate(metrics):
+        conn.execute(f"""
+            INSERT INTO climate_monthly
+            SELECT ?, station_id, year, month, s{i}, c{i}, n, lo{i}, hi{i} FROM temp.rollup_wide;
+        """, (m,))
+    conn.execute("DROP TABLE temp.rollup_wide;")
+
+
+def check_dates(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT date FROM climate_data WHERE date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-1][0-9]-[0-3][0-9]' LIMIT 1;")
+    row = cur.fetchone()
+    if row is not None:
+        raise ValueError(f"climate_data.date values must look like YYYY-MM-DD to build monthly rollups, found {row[0]!r}")
+
+
+def build(database=DB_PATH):
+    #Rebuilds climate_monthly from scratch
+    conn = sqlite3.connect(database)
+    try:
+        check_dates(conn)
+        metrics = get_numeric_metrics(conn)
+        cur = conn.cursor()
+        cur.execute("SELECT MAX(rowid) FROM climate_data;")
+        last_rowid = cur.fetchone()[0]
+        with conn:
+            create_tables(conn)
+            insert_rollup_rows(conn, metrics, "climate_data WHERE rowid <= ?", (last_rowid or 0,))
+            conn.executemany("INSERT INTO climate_monthly_metrics VALUES (?);", [(m,) for m in metrics])
+            conn.execute("INSERT INTO climate_monthly_state VALUES ('last_rowid', ?);", (last_rowid,))
+        return metrics
+    finally:
+        conn.close()
+
+
+def refresh(database=DB_PATH):
+    #Recomputes only the station/months touched by daily rows appended since the last
+    #build/refresh. Returns how many station/months were recomputed
+    conn = sqlite3.connect(database)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='climate_monthly_state';")
+        if cur.fetchone() is None:
+            build(database)
+            cur.execute("SELECT COUNT(*) FROM (SELECT 1 FROM climate_monthly GROUP BY station_id, year, month);")
+            return cur.fetchone()[0]
+
+        cur.execute("SELECT value FROM climate_monthly_state WHERE key='last_rowid';")
+        last_rowid = cur.fetchone()[0] or 0
+        cur.execute("SELECT MAX(rowid) FROM climate_data;")
+        new_last = cur.fetchone()[0]
+        if new_last is None or new_last <= last_rowid:
+            return 0
+        cur.execute("SELECT metric FROM climate_monthly_metrics;")
+        metrics = [row[0] for row in cur.fetchall()]
+
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS temp.touched;")
+            conn.execute("""
+                CREATE TEMP TABLE touched AS
+                SELECT DISTINCT station_id, CAST(substr(date, 1, 4) AS INTEGER) AS year,
+                       CAST(substr(date, 6, 2) AS INTEGER) AS month, substr(date, 1, 7) AS ym
+                FROM climate_data WHERE rowid > ? AND rowid <= ?;
+            """, (last_rowid, new_last))
+            conn.execute("""
+                DELETE FROM climate_monthly
+                WHERE (station_id, year, month) IN (SELECT station_id, year, month FROM temp.touched);
+            """)
+            #Re-read the whole of each touched month, driven from the touched list so the
+            #(station_id, date) index is used instead of scanning climate_data
+            insert_rollup_rows(conn, metrics, """(
+                SELECT cd.* FROM temp.touched t
+                JOIN climate_data cd ON cd.station_id = t.station_id
+                    AND cd.date BETWEEN t.ym || '-01' AND t.ym || '-31'
+                WHERE cd.rowid <= ?
+            )""", (new_last,))
+            cur.execute("SELECT COUNT(*) FROM temp.touched;")
+            touched = cur.fetchone()[0]
+            conn.execute("DROP TABLE temp.touched;")
+            conn.execute("UPDATE climate_monthly_state SET value=? WHERE key='last_rowid';", (new_last,))
+        return touched
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh the monthly climate rollup table.")
+    parser.add_argument("action", choices=["build", "refresh"])
+    parser.add_argument("--db", default=DB_PATH, help="path to climate.db")
+    args = parser.parse_args()
+    if args.action == "build":
+        metrics = build(args.db)
+        print(f"Built monthly rollups for {len(metrics)} metrics: {', '.join(metrics)}")
+    else:
+        print(f"Recomputed {refresh(args.db)} station/months")
@@ -0,0 +1,230 @@
+#Static assets (the images/ folder next to this file), served by pyhtml whatever directory the
+#server was started from.
+#
+#Pages link to an asset with assets.url("persona1.jpg"), which gives a fingerprinted URL such
+#as /assets/persona1.3f2a9c1b07d4.jpg. The name changes whenever the file does, so browsers may
+#keep it for a year without checking back (Cache-Control: immutable). The plain /images/<name>
+#URLs still work but are revalidated with an ETag on every use.
+#
+#Files up to MEMORY_MAX_BYTES are read into memory once; bigger ones are sent from disk with
+#sendfile. A changed file is picked up within CHECK_INTERVAL seconds.
+#
+#Optional build step (needs Pillow): writes copies no wider than --max-width plus WebP versions
+#to images/build/. The server then sends the smaller copy, or the WebP one to browsers that
+#accept image/webp.
+#
+#    python assets.py build --max-width 480
+
+import argparse
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+BUILD_DIR = os.path.join(ASSETS_DIR, "build")
+URL_PREFIX = "/assets/"
+LEGACY_PREFIX = "/images/"
+MEMORY_MAX_BYTES = 1024 * 1024
+CHECK_INTERVAL = 1.0
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+RESIZABLE = (".jpg", ".jpeg", ".png")
+
+
+def get_stat(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+def get_variant_paths(name):
+    #(file to send, WebP version or None). Build output is only used if it is newer than the source
+    source = os.path.join(ASSETS_DIR, name)
+    source_stat = get_stat(source)
+    built = os.path.join(BUILD_DIR, name)
+
+    def is_current(path):
+        stat = get_stat(path)
+        return stat is not None and source_stat is not None and stat[0] >= source_stat[0]
+    return (built if is_current(built) else source), (built + ".webp" if is_current(built + ".webp") else None)
+
+
+def get_signature(name):
+    path, webp = get_variant_paths(name)
+    return (get_stat(os.path.join(ASSETS_DIR, name)), get_stat(path), get_stat(webp) if webp else None)
+
+
+class AssetFile:
+    #One file as sent: its bytes (if small enough to keep), size, ETag and type
+    def __init__(self, path, content_type, digest):
+        self.path = path
+        self.content_type = content_type
+        self.size = os.path.getsize(path)
+        self.body = None
+        if self.size <= MEMORY_MAX_BYTES:
+            with open(path, "rb") as f:
+                self.body = f.read()
+            self.size = len(self.body)
+        self.etag = f'"{digest}"'
+
+
+class Asset:
+    def __init__(self, name):
+        self.name = name
+        path, webp = get_variant_paths(name)
+        self.signature = get_signature(name)
+        self.checked = time.monotonic()
+        self.last_modified = os.path.getmtime(path)
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.file = AssetFile(path, content_type, hash_file(path))
+        self.webp = AssetFile(webp, "image/webp", hash_file(webp)) if webp else None
+        #Covers both versions, so the URL changes if either does
+        self.fingerprint = hashlib.blake2b((self.file.etag + (self.webp.etag if self.webp else "")).encode(), digest_size=6).hexdigest()
+        stem, ext = os.path.splitext(name)
+        self.url = f"{URL_PREFIX}{stem}.{self.fingerprint}{ext}"
+
+    def get_file(self, accept):
+        #The WebP version if there is one and the browser takes it
+        if self.webp is not None and "image/webp" in (accept or ""):
+            return self.webp
+        return self.file
+
+    def is_current(self):
+        return self.signature == get_signature(self.name)
+
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AssetStore:
+    def __init__(self):
+        self.assets = {}  #file name -> Asset
+        self.lock = threading.Lock()
+        self.scanned = 0.0
+
+    def scan(self):
+        #Caller holds the lock. Picks up added and removed files
+        try:
+            names = {e.name for e in os.scandir(ASSETS_DIR) if e.is_file() and not e.name.startswith(".")}
+        except OSError:
+            names = set()
+        for name in list(self.assets):
+            if name not in names:
+                del self.assets[name]
+        for name in names - self.assets.keys():
+            self.assets[name] = Asset(name)
+        self.scanned = time.monotonic()
+
+    def get(self, name):
+        #The Asset for a file in images/, or None
+        now = time.monotonic()
+        asset = self.assets.get(name)
+        if asset is not None and now - asset.checked < CHECK_INTERVAL:
+            return asset
+        with self.lock:
+            asset = self.assets.get(name)
+            if asset is None:
+                if now - self.scanned >= CHECK_INTERVAL:
+                    self.scan()
+                return self.assets.get(name)
+            if now - asset.checked >= CHECK_INTERVAL:
+                asset.checked = now
+                if not asset.is_current():
+                    if os.path.isfile(os.path.join(ASSETS_DIR, name)):
+                        asset = self.assets[name] = Asset(name)
+                    else:
+                        del self.assets[name]
+                        asset = None
+            return asset
+
+    def stats(self):
+        with self.lock:
+            assets = list(self.assets.values())
+        return {"files": len(assets), "bytes": sum(len(a.file.body or b"") + len(a.webp.body if a.webp and a.webp.body else b"") for a in assets)}
+
+
+store = AssetStore()
+
+
+def url(name):
+    #Fingerprinted URL for images/<name>, or the plain /images/ URL if there is no such file
+    asset = store.get(name)
+    return asset.url if asset is not None else LEGACY_PREFIX + name
+
+
+def lookup(path):
+    #(Asset, immutable) for a request path, or (None, False) if it isn't an asset URL.
+    #A fingerprint that doesn't match the file any more (a page rendered before the file
+    #changed) still gets the current file, just without the long caching
+    if path.startswith(LEGACY_PREFIX):
+        name = path[len(LEGACY_PREFIX):]
+        if "/" in name:
+            return None, False
+        return store.get(name), False
+    if not path.startswith(URL_PREFIX):
+        return None, False
+    stem, ext = os.path.splitext(path[len(URL_PREFIX):])
+    stem, _, fingerprint = stem.rpartition(".")
+    if not stem or "/" in stem:
+        return None, False
+    asset = store.get(stem + ext)
+    if asset is None:
+        return None, False
+    return asset, fingerprint == asset.fingerprint
+
+
+def build(max_width=480, quality=85):
+    #Writes resized copies and WebP versions of the images to BUILD_DIR (needs Pillow)
+    if Image is None:
+        raise SystemExit("Pillow is not installed (pip install Pillow)")
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    for entry in sorted(os.scandir(ASSETS_DIR), key=lambda e: e.name):
+        if not entry.is_file() or not entry.name.lower().endswith(RESIZABLE):
+            continue
+        target = os.path.join(BUILD_DIR, entry.name)
+        with Image.open(entry.path) as image:
+            if image.width > max_width:
+                image = image.resize((max_width, round(image.height * max_width / image.width)), Image.LANCZOS)
+            if entry.name.lower().endswith(".png"):
+                image.save(target, optimize=True)
+            else:
+                image.convert("RGB").save(target, quality=quality, optimize=True, progressive=True)
+            has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+            image.convert("RGBA" if has_alpha else "RGB").save(target + ".webp", "WEBP", quality=quality, method=6)
+        if os.path.getsize(target) >= entry.stat().st_size:
+            #No smaller than the original, keep sending that
+            os.remove(target)
+        if os.path.getsize(target + ".webp") >= (os.path.getsize(target) if os.path.exists(target) else entry.stat().st_size):
+            os.remove(target + ".webp")
+        sizes = [os.path.getsize(path) if os.path.exists(path) else "-" for path in (target, target + ".webp")]
+        print(f"{entry.name}: {entry.stat().st_size} -> {sizes[0]} bytes, webp {sizes[1]} bytes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Static assets in images/")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_parser = sub.add_parser("build", help="write resized and WebP versions (needs Pillow)")
+    build_parser.add_argument("--max-width", type=int, default=480)
+    build_parser.add_argument("--quality", type=int, default=85)
+    sub.add_parser("list", help="show the fingerprinted URL of every asset")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build(args.max_width, args.quality)
+    else:
+        for name in sorted(os.listdir(ASSETS_DIR)):
+            if os.path.isfile(os.path.join(ASSETS_DIR, name)) and not name.startswith("."):
+                print(f"{name}: {url(name)}")
@@ -0,0 +1,182 @@
+#Benchmarks every page's get_page_html and the two similarity searches against synthetic
+#databases of several sizes (see synthdb.py), so performance changes can be measured without
+#the real climate.db.
+#
+#    python benchmark.py                          #default sizes, 20 timed runs per case
+#    python benchmark.py --sizes 50x5,200x10 --repeat 50 --rollup
+#    python benchmark.py --json before.json       #save the results to compare later
+#
+#Sizes are STATIONSxYEARS. Generated databases are kept in --data-dir and reused by later
+#runs with the same size and seed. Each case is called --warmup times first (filling the
+#metadata caches and the OS page cache, like a server that has been up a while), then timed
+#--repeat times; streamed pages are read to the end. pyhtml's response cache is not involved,
+#every call renders the page.
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import columnstore
+import dbpool
+import metacache
+import synthdb
+
+import student_a_level_1
+import student_a_level_2
+import student_a_level_3
+import student_b_level_1
+import student_b_level_2
+import student_b_level_3
+
+DB_MODULES = [student_a_level_2, student_a_level_3, student_b_level_2, student_b_level_3]
+DEFAULT_SIZES = "20x2,60x5,150x10"
+
+
+def get_cases(database):
+    #(name, function, args) for each thing to time, using values that exist in this database
+    conn = dbpool.get_pool(database)
+    with conn.connection() as c:
+        cur = c.cursor()
+        cur.execute("SELECT state, MIN(latitude), MAX(latitude) FROM weather_station GROUP BY state ORDER BY COUNT(*) DESC, state LIMIT 1;")
+        state, lat_min, lat_max = cur.fetchone()
+        cur.execute("SELECT MIN(station_id) FROM weather_station;")
+        station_id = str(cur.fetchone()[0])
+        cur.execute("SELECT MIN(date), MAX(date) FROM climate_data;")
+        first_date, last_date = cur.fetchone()
+    metric = student_a_level_3.get_metrics()[0]["id"]
+    first_year, last_year = int(first_date[:4]), int(last_date[:4])
+    mid_year = (first_year + last_year + 1) // 2
+    p1 = (f"{first_year}-01-01", f"{mid_year - 1}-12-31")
+    p2 = (f"{mid_year}-01-01", f"{last_year}-12-31")
+
+    def form(**values):
+        return {k: [str(v)] for k, v in values.items()}
+
+    location = form(state=state, lat_start=lat_min, lat_end=lat_max, metric=metric)
+    by_metric = form(metric=metric, station_id=station_id, dt_start=first_date, dt_end=last_date)
+    return [
+        ("page1a home", student_a_level_1.get_page_html, ({},)),
+        ("page1b mission", student_b_level_1.get_page_html, ({},)),
+        ("page2a form", student_a_level_2.get_page_html, ({},)),
+        ("page2a location", student_a_level_2.get_page_html, (location,)),
+        ("page2a sorted", student_a_level_2.get_page_html,
+         (dict(location, station_sort_by=["latitude"], station_sort_order=["desc"],
+               summary_sort_by=["avg_max_temp"], summary_sort_order=["desc"]),)),
+        ("page2b 500 rows", student_b_level_2.get_page_html, (by_metric,)),
+        ("page2b all rows", student_b_level_2.get_page_html, (dict(by_metric, t1_page_size=["all"]),)),
+        ("page3a similar", student_a_level_3.get_page_html,
+         (form(period1_start=p1[0], period1_end=p1[1], period2_start=p2[0], period2_end=p2[1],
+               metric=metric, reference_station=station_id, num_similar=5),)),
+        ("page3b similar", student_b_level_3.get_page_html,
+         (form(period1_start=p1[0], period1_end=p1[1], period2_start=p2[0], period2_end=p2[1],
+               ref_metric=metric, station_id=station_id, num_results=5),)),
+        ("get_similar_stations", student_a_level_3.get_similar_stations,
+         (p1[0], p1[1], p2[0], p2[1], metric, station_id, 5)),
+        ("get_similar_metrics", student_b_level_3.get_similar_metrics,
+         (metric, station_id, p1[0], p1[1], p2[0], p2[1], 5)),
+    ]
+
+
+def call(function, args):
+    result = function(*args)
+    if not isinstance(result, (str, bytes, list)):
+        #Streamed page: producing the pieces is where the work happens
+        result = "".join(fragment if isinstance(fragment, str) else fragment.decode("utf-8") for fragment in result)
+    return result
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_case(function, args, warmup, repeat):
+    for _ in range(warmup):
+        call(function, args)
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call(function, args)
+        times.append(time.perf_counter() - started)
+    times.sort()
+    total = sum(times)
+    return {
+        "runs": repeat,
+        "ops_per_sec": repeat / total if total else float("inf"),
+        "mean_ms": total / repeat * 1000.0,
+        "p50_ms": percentile(times, 0.5) * 1000.0,
+        "p95_ms": percentile(times, 0.95) * 1000.0,
+        "p99_ms": percentile(times, 0.99) * 1000.0,
+    }
+
+
+def use_database(database):
+    #Points the page modules at another database file
+    for module in DB_MODULES:
+        module.DB_PATH = database
+    metacache.clear()
+
+
+def parse_sizes(text):
+    sizes = []
+    for part in text.split(","):
+        stations, years = part.lower().split("x")
+        sizes.append((int(stations), int(years)))
+    return sizes
+
+
+def run(sizes, data_dir, repeat=20, warmup=2, seed=1, with_indexes=True, with_rollup=False, only=None,
+        column_store=False):
+    results = []
+    original_paths = {module: module.DB_PATH for module in DB_MODULES}
+    try:
+        for stations, years in sizes:
+            suffix = ("" if with_indexes else "_noidx") + ("_rollup" if with_rollup else "")
+            database = os.path.join(data_dir, f"climate_{stations}x{years}_s{seed}{suffix}.db")
+            if not os.path.exists(database):
+                synthdb.generate(database, stations, years, seed=seed,
+                                 with_indexes=with_indexes, with_rollup=with_rollup, verbose=False)
+            use_database(database)
+            if column_store and columnstore.load(database) is None:
+                print("Column store not loaded (is numpy installed?)")
+            print(f"\n{stations} stations x {years} years ({os.path.getsize(database) / 1e6:.1f} MB)")
+            print(f"  {'case':<22} {'ops/s':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+            for name, function, args in get_cases(database):
+                if only and not any(o in name for o in only):
+                    continue
+                stats = run_case(function, args, warmup, repeat)
+                print(f"  {name:<22} {stats['ops_per_sec']:>9.1f} {stats['mean_ms']:>9.2f} "
+                      f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+                results.append(dict(stats, case=name, stations=stations, years=years))
+            columnstore.unload(database)
+            dbpool.get_pool(database).close()
+    finally:
+        for module, path in original_paths.items():
+            module.DB_PATH = path
+        metacache.clear()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pages against synthetic databases")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated STATIONSxYEARS, eg. 20x2,150x10")
+    parser.add_argument("--repeat", type=int, default=20, help="timed calls per case")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed calls per case first")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "climate_benchmark"),
+                        help="where generated databases are kept between runs")
+    parser.add_argument("--no-indexes", action="store_true", help="benchmark without the indexes from indexes.py")
+    parser.add_argument("--rollup", action="store_true", help="build the monthly rollup (aggregates.py) first")
+    parser.add_argument("--column-store", action="store_true", help="load the NumPy column store (columnstore.py)")
+    parser.add_argument("--only", action="append", help="only cases whose name contains this (repeatable)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = run(parse_sizes(args.sizes), args.data_dir, args.repeat, args.warmup, args.seed,
+                  with_indexes=not args.no_indexes, with_rollup=args.rollup, only=args.only,
+                  column_store=args.column_store)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
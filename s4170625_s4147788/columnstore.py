@@ -0,0 +1,511 @@
+#Optional in-memory copy of climate_data as NumPy columns, for range sums/averages without
+#going back to SQLite. Needs numpy; without it nothing is loaded and every query keeps using SQL.
+#
+#    columnstore.load(DB_PATH)   #once at startup (see demo3.py)
+#
+#Rows are kept sorted by (station_id, date). `offsets[i]:offsets[i + 1]` is the slice holding
+#station i, and `keys` (station number in the high 32 bits, day number in the low 32) is
+#sorted too, so the rows of a date range for any number of stations are found with one
+#np.searchsorted.
+#
+#Prefix-sum index: for every metric and station, sums holds the running total of the
+#station's non-null values (starting from 0 before its first row) and counts how many there
+#were. The rows of one station are contiguous, so the SUM and COUNT over any date range of a
+#station are sums[hi + s] - sums[lo + s] and counts[hi + s] - counts[lo + s], s being the
+#station number: two lookups whatever the length of the range, and the totals subtracted are
+#never bigger than one station's. Only the station/date keys are read by load(); each
+#metric's index is built the first time the metric is asked for.
+#
+#aggregates.get_range_stats sends queries here whenever a store is loaded for the database.
+#If climate.db changes on disk, the store notices (file size/mtime) and reloads in a
+#background thread, answering from what it had (or SQLite) until the reload is done.
+#
+#Column files: to share one copy between several server processes, export the columns once
+#
+#    python columnstore.py export            #writes database/climate_columns/
+#    python columnstore.py refresh           #after rows are appended to climate_data
+#
+#and load() will np.memmap those files instead of reading climate_data: startup is near
+#instant and the data lives in the OS page cache, shared by every process, instead of in
+#each process's memory. The files record the size/mtime of climate.db they were made from
+#and are ignored (SQL loading is used) once climate.db changes, until refreshed.
+#`refresh` only reads the rows appended since the last export/refresh (like
+#aggregates.py refresh) and recomputes the prefix sums of the stations that got rows. If
+#existing rows are edited or deleted, or a new station appears, it exports everything again.
+
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+import aggregates
+import dbpool
+import metacache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FETCH_ROWS = 65536
+INDEX_FILE = "index.json"
+FILES_VERSION = 3
+DAY_BIAS = 1 << 31  #Day numbers are stored as day + DAY_BIAS so they fit the low 32 bits
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_files_dir(database):
+    #database/climate.db -> database/climate_columns
+    return os.path.splitext(database)[0] + "_columns"
+
+
+def to_day(date_text):
+    #Day number for a YYYY-MM-DD string, None if it isn't exactly that form (SQL compares
+    #other strings as text, so those queries are left to SQLite)
+    try:
+        d = datetime.date.fromisoformat(date_text)
+    except (TypeError, ValueError):
+        return None
+    if d.isoformat() != date_text:
+        return None
+    return (d - datetime.date(1970, 1, 1)).days
+
+
+def to_days(dates):
+    #Day numbers for a list of YYYY-MM-DD strings
+    date_text = np.array(dates, dtype="U10")
+    try:
+        days = date_text.astype("datetime64[D]")
+    except ValueError:
+        days = None
+    if days is None or (len(dates) and not np.array_equal(days.astype("U10"), date_text)):
+        raise ValueError("climate_data.date values must look like YYYY-MM-DD for the column store")
+    return days.astype(np.int64)
+
+
+def make_keys(station_numbers, days):
+    return (np.asarray(station_numbers, dtype=np.int64) << 32) + (np.asarray(days, dtype=np.int64) + DAY_BIAS)
+
+
+def to_values(rows):
+    #float64 array from SQL values, NaN for NULL
+    return np.array([row[0] if isinstance(row, tuple) else row for row in rows], dtype=np.float64)
+
+
+def make_prefix(values, offsets):
+    #(sums, counts) restarting from 0 for every station: station s's prefix sums are
+    #sums[offsets[s] + s:offsets[s + 1] + s + 1], so a range of one station never subtracts
+    #two totals that also hold every station before it
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    sums = np.zeros(len(values) + len(offsets) - 1, dtype=np.float64)
+    counts = np.zeros(len(values) + len(offsets) - 1, dtype=np.int64)
+    for s in range(len(offsets) - 1):
+        lo, hi = int(offsets[s]), int(offsets[s + 1])
+        np.cumsum(filled[lo:hi], out=sums[lo + s + 1:hi + s + 1])
+        np.cumsum(present[lo:hi], out=counts[lo + s + 1:hi + s + 1])
+    return sums, counts
+
+
+class ColumnState:
+    #One load of the keys plus the prefix sums built for it so far. Nothing but `prefixes`
+    #changes after it is made and a reload swaps in a new state in one assignment, so a query
+    #that takes store.state once never pairs keys and prefix sums from different loads
+    def __init__(self, signature, keys, offsets, station_ids, metrics, last_rowid=None, mapped=False):
+        self.signature = signature
+        self.keys = keys
+        self.offsets = offsets
+        self.station_ids = station_ids
+        self.station_index = {sid: i for i, sid in enumerate(station_ids)}
+        self.row_count = len(keys)
+        self.last_rowid = last_rowid
+        self.metrics = frozenset(metrics)
+        self.mapped = mapped
+        self.prefixes = {}  #metric -> (sums, counts)
+
+    def has_metrics(self, metrics):
+        return all(m in self.metrics for m in metrics)
+
+    def get_stations(self, station_id=None, station_ids=None):
+        #Station numbers for one station, a list of stations or (both None) all of them
+        if station_id is not None:
+            station_ids = [station_id]
+        if station_ids is None:
+            return np.arange(len(self.station_ids), dtype=np.int64)
+        found = (self.station_index.get(str(sid)) for sid in station_ids)
+        return np.array(sorted({i for i in found if i is not None}), dtype=np.int64)
+
+    def get_bounds(self, start, end, station_id=None, station_ids=None):
+        #(station numbers, first row, end row) of the date range for the stations asked for,
+        #{} if none of them have rows, None if the dates can't be handled here.
+        #start/end None mean no limit
+        first = -DAY_BIAS if start is None else to_day(start)
+        last = DAY_BIAS - 1 if end is None else to_day(end)
+        if first is None or last is None:
+            return None
+        stations = self.get_stations(station_id, station_ids)
+        if not len(stations):
+            return {}
+        first = min(max(first, -DAY_BIAS), DAY_BIAS - 1)
+        last = min(max(last, -DAY_BIAS - 1), DAY_BIAS - 1)
+        lo = np.searchsorted(self.keys, make_keys(stations, first), side="left")
+        hi = np.searchsorted(self.keys, make_keys(stations, last), side="right")
+        return stations, lo, np.maximum(lo, hi)
+
+
+class ColumnStore:
+    def __init__(self, database, files_dir=None):
+        self.database = database
+        self.files_dir = get_files_dir(database) if files_dir is None else files_dir
+        self.lock = threading.Lock()
+        self.state = None
+        self.reloading = None  #Thread loading a new state, if climate.db changed
+
+    def load_state(self):
+        return self.open_files() or self.load_from_db()
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.files_dir, INDEX_FILE), encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return index if index.get("version") == FILES_VERSION else None
+
+    def open_files(self):
+        #A state memory-mapping the exported column files, if they match the current climate.db.
+        #Every prefix file is mapped straight away (mapping reads nothing), so this state keeps
+        #the files it was opened with even if a refresh replaces them later
+        signature = metacache.get_file_signature(self.database)
+        index = self.read_index()
+        if index is None:
+            return None
+        if index["signature"] != json.loads(json.dumps(signature)):
+            dbpool.query_log.warning("column files in %s are out of date, run: python columnstore.py refresh", self.files_dir)
+            return None
+        row_count = index["row_count"]
+        state = ColumnState(signature, self.map_file("keys.i64", np.int64, row_count),
+                            np.array(index["offsets"], dtype=np.int64), index["station_ids"],
+                            index["metrics"], index["last_rowid"], mapped=True)
+        for metric in index["metrics"]:
+            state.prefixes[metric] = (
+                self.map_file(f"{metric}.sum.f64", np.float64, row_count + len(state.station_ids)),
+                self.map_file(f"{metric}.count.i64", np.int64, row_count + len(state.station_ids)))
+        return state
+
+    def map_file(self, name, dtype, length):
+        if not length:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.files_dir, name), dtype=dtype, mode="r", shape=(length,))
+
+    def load_from_db(self):
+        #A state with the keys read from climate_data, without any prefix sums yet
+        signature = metacache.get_file_signature(self.database)
+        with dbpool.connect(self.database) as conn:
+            metrics = aggregates.get_numeric_metrics(conn)
+            cur = conn.cursor()
+            cur.execute("SELECT MAX(rowid) FROM climate_data;")
+            last_rowid = cur.fetchone()[0]
+            cur.execute("SELECT station_id, COUNT(*) FROM climate_data GROUP BY station_id ORDER BY station_id;")
+            station_rows = cur.fetchall()
+            counts = np.array([row[1] for row in station_rows], dtype=np.int64)
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            #Day numbers are converted a batch at a time into the key array, the dates are
+            #never all held as Python strings
+            keys = np.empty(int(offsets[-1]), dtype=np.int64)
+            filled = 0
+            cur.execute("SELECT date FROM climate_data ORDER BY station_id, date, rowid;")
+            while True:
+                batch = cur.fetchmany(FETCH_ROWS)
+                if not batch:
+                    break
+                if filled + len(batch) > len(keys):
+                    raise ValueError("climate_data changed while the column store was loading")
+                keys[filled:filled + len(batch)] = to_days([row[0] for row in batch])
+                filled += len(batch)
+        if filled != len(keys):
+            raise ValueError("climate_data changed while the column store was loading")
+        keys += DAY_BIAS
+        keys += np.repeat(np.arange(len(counts), dtype=np.int64), counts) << 32
+        return ColumnState(signature, keys, offsets, [str(row[0]) for row in station_rows], metrics, last_rowid)
+
+    def check_current(self):
+        #If climate.db changed, loads a new state in the background. Queries keep using the
+        #current one (and SQLite for any metric it hasn't loaded yet) until it's ready
+        state = self.state
+        if self.reloading is not None or state.signature == metacache.get_file_signature(self.database):
+            return
+        with self.lock:
+            if self.reloading is None and self.state is state:
+                self.reloading = threading.Thread(target=self.reload, name="columnstore-reload", daemon=True)
+                self.reloading.start()
+
+    def reload(self):
+        try:
+            self.state = self.load_state()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            dbpool.query_log.warning("column store dropped for %s: %s", self.database, e)
+            unload(self.database, self)
+        finally:
+            self.reloading = None
+
+    def wait(self):
+        #Waits for a background reload, if one is running
+        thread = self.reloading
+        if thread is not None:
+            thread.join()
+
+    def read_values(self, metric, row_count):
+        #The metric column from SQLite in key order, NaN for NULL, read in batches straight
+        #into the array. None if climate_data no longer has row_count rows
+        values = np.empty(row_count, dtype=np.float64)
+        filled = 0
+        with dbpool.connect(self.database) as conn:
+            cur = conn.cursor()
+            cur.execute(f"SELECT [{metric}] FROM climate_data ORDER BY station_id, date, rowid;")
+            while True:
+                batch = cur.fetchmany(FETCH_ROWS)
+                if not batch:
+                    break
+                if filled + len(batch) > row_count:
+                    return None
+                values[filled:filled + len(batch)] = to_values(batch)
+                filled += len(batch)
+        return values if filled == row_count else None
+
+    def get_prefix(self, state, metric):
+        #(sums, counts) for the metric in this state, built on first use. None if climate.db
+        #changed since the state was loaded (its rows wouldn't line up with the keys)
+        prefix = state.prefixes.get(metric)
+        if prefix is not None:
+            return prefix
+        with self.lock:
+            prefix = state.prefixes.get(metric)
+            if prefix is None:
+                if state.signature != metacache.get_file_signature(self.database):
+                    return None
+                values = self.read_values(metric, state.row_count)
+                if values is None:
+                    return None
+                prefix = state.prefixes[metric] = make_prefix(values, state.offsets)
+        return prefix
+
+    def has_metrics(self, metrics):
+        return self.state.has_metrics(metrics)
+
+    def range_stats(self, metrics, start, end, station_id=None, station_ids=None):
+        #Same result as aggregates.get_range_stats: {(station_id as str, metric): (total,
+        #non-null count, row count)} for stations with rows in the range. None if the query
+        #has to go to SQLite instead
+        state = self.state
+        if not state.has_metrics(metrics):
+            return None
+        bounds = state.get_bounds(start, end, station_id, station_ids)
+        if not bounds:
+            return bounds
+        prefixes = [self.get_prefix(state, metric) for metric in metrics]
+        if any(prefix is None for prefix in prefixes):
+            return None
+        stations, lo, hi = bounds
+        nonempty = hi > lo
+        stations, lo, hi = stations[nonempty], lo[nonempty], hi[nonempty]
+        stats = {}
+        row_counts = (hi - lo).tolist()
+        #Station s's prefix sums start s entries further on (see make_prefix)
+        lo += stations
+        hi += stations
+        stations = stations.tolist()
+        for metric, (sums, counts) in zip(metrics, prefixes):
+            totals = (sums[hi] - sums[lo]).tolist()
+            value_counts = (counts[hi] - counts[lo]).tolist()
+            for s, total, value_count, row_count in zip(stations, totals, value_counts, row_counts):
+                stats[(state.station_ids[s], metric)] = (total if value_count else None, value_count, row_count)
+        return stats
+
+
+def load(database, metrics=(), files_dir=None):
+    #Loads the station/date keys (and any `metrics` prefix sums up front), memory-mapping the
+    #exported column files when they are current. Returns the store, or None if numpy isn't
+    #installed or the database can't be loaded
+    if np is None or not os.path.exists(database):
+        return None
+    store = ColumnStore(database, files_dir)
+    try:
+        store.state = store.load_state()
+        for metric in metrics:
+            if metric in store.state.metrics:
+                store.get_prefix(store.state, metric)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        dbpool.query_log.warning("column store not loaded for %s: %s", database, e)
+        return None
+    with _stores_lock:
+        _stores[os.path.abspath(database)] = store
+    return store
+
+
+def unload(database, store=None):
+    #Forgets the store for this database (only if it is still `store`, when given)
+    with _stores_lock:
+        path = os.path.abspath(database)
+        if store is None or _stores.get(path) is store:
+            _stores.pop(path, None)
+
+
+def get_store(database):
+    #The loaded store for this database file, or None
+    if not _stores or not database:
+        return None
+    store = _stores.get(os.path.abspath(database))
+    if store is not None:
+        store.check_current()
+    return store
+
+
+#Column files: keys.i64, and for every metric <metric>.f64 (the values, NaN for NULL),
+#<metric>.sum.f64 and <metric>.count.i64 (the per-station prefix sums, see make_prefix), all
+#in native byte order, plus index.json (stations, offsets, last rowid and the climate.db
+#size/mtime). index.json is removed first and written last, so readers never take a
+#half-written export as current
+
+def write_array(path, array):
+    np.ascontiguousarray(array).tofile(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def write_index(files_dir, signature, row_count, last_rowid, offsets, station_ids, metrics):
+    index = {
+        "version": FILES_VERSION,
+        "signature": signature,
+        "row_count": row_count,
+        "last_rowid": last_rowid,
+        "offsets": [int(o) for o in offsets],
+        "station_ids": station_ids,
+        "metrics": metrics,
+    }
+    index_path = os.path.join(files_dir, INDEX_FILE)
+    with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def remove_index(files_dir):
+    index_path = os.path.join(files_dir, INDEX_FILE)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+
+def export(database, files_dir=None):
+    store = ColumnStore(database, files_dir)
+    state = store.load_from_db()
+    os.makedirs(store.files_dir, exist_ok=True)
+    remove_index(store.files_dir)
+    write_array(os.path.join(store.files_dir, "keys.i64"), state.keys)
+    metrics = sorted(state.metrics)
+    for metric in metrics:
+        values = store.read_values(metric, state.row_count)
+        if values is None:
+            raise ValueError("climate_data changed during the export, run it again")
+        sums, counts = make_prefix(values, state.offsets)
+        write_array(os.path.join(store.files_dir, f"{metric}.f64"), values)
+        write_array(os.path.join(store.files_dir, f"{metric}.sum.f64"), sums)
+        write_array(os.path.join(store.files_dir, f"{metric}.count.i64"), counts)
+    write_index(store.files_dir, state.signature, state.row_count, state.last_rowid,
+                state.offsets, state.station_ids, metrics)
+    return metrics
+
+
+def refresh(database, files_dir=None):
+    #Adds the rows appended since the last export/refresh to the column files. Returns how
+    #many rows were added
+    store = ColumnStore(database, files_dir)
+    files_dir = store.files_dir
+    index = store.read_index()
+    if index is None:
+        export(database, files_dir)
+        return store_row_count(database)
+
+    signature = metacache.get_file_signature(database)
+    with dbpool.connect(database) as conn:
+        metrics = sorted(aggregates.get_numeric_metrics(conn))
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*), MAX(rowid) FROM climate_data;")
+        row_count, last_rowid = cur.fetchone()
+        old_last = index["last_rowid"] or 0
+        added = row_count - index["row_count"]
+        if metrics != index["metrics"] or added < 0 or (added and (last_rowid or 0) <= old_last):
+            #Columns changed or rows were deleted/rewritten: start again
+            export(database, files_dir)
+            return row_count
+        if not added:
+            write_index(files_dir, signature, row_count, last_rowid, index["offsets"], index["station_ids"], metrics)
+            return 0
+        columns = ", ".join(f"[{m}]" for m in metrics)
+        cur.execute(f"""
+            SELECT station_id, date, {columns}
+            FROM climate_data
+            WHERE rowid > ?
+            ORDER BY station_id, date, rowid;
+        """, (old_last,))
+        new_rows = cur.fetchall()
+
+    station_index = {sid: i for i, sid in enumerate(index["station_ids"])}
+    if len(new_rows) != added or any(str(r[0]) not in station_index for r in new_rows):
+        #Rows were also deleted, or a new station appeared (station numbers would all move)
+        export(database, files_dir)
+        return added
+
+    old_count = index["row_count"]
+    new_stations = np.array([station_index[str(r[0])] for r in new_rows], dtype=np.int64)
+    new_keys = make_keys(new_stations, to_days([r[1] for r in new_rows]))
+    old_keys = np.fromfile(os.path.join(files_dir, "keys.i64"), dtype=np.int64, count=old_count)
+    #Appended rows go after existing rows with the same station and date, like rowid order
+    positions = np.searchsorted(old_keys, new_keys, side="right")
+    old_offsets = np.array(index["offsets"], dtype=np.int64)
+    offsets = old_offsets.copy()
+    offsets[1:] += np.cumsum(np.bincount(new_stations, minlength=len(offsets) - 1))
+    #Stations before the first one with new rows keep their rows and prefix sums as they are
+    first_station = int(new_stations.min())
+    first_row = int(old_offsets[first_station])
+    kept = first_row + first_station
+
+    remove_index(files_dir)
+    write_array(os.path.join(files_dir, "keys.i64"), np.insert(old_keys, positions, new_keys))
+    for i, metric in enumerate(metrics):
+        old_values = np.fromfile(os.path.join(files_dir, f"{metric}.f64"), dtype=np.float64, count=old_count)
+        values = np.insert(old_values, positions, to_values([r[2 + i] for r in new_rows]))
+        old_sums = np.fromfile(os.path.join(files_dir, f"{metric}.sum.f64"), dtype=np.float64, count=kept)
+        old_counts = np.fromfile(os.path.join(files_dir, f"{metric}.count.i64"), dtype=np.int64, count=kept)
+        sums, counts = make_prefix(values[first_row:], offsets[first_station:] - first_row)
+        write_array(os.path.join(files_dir, f"{metric}.f64"), values)
+        write_array(os.path.join(files_dir, f"{metric}.sum.f64"), np.concatenate([old_sums, sums]))
+        write_array(os.path.join(files_dir, f"{metric}.count.i64"), np.concatenate([old_counts, counts]))
+
+    write_index(files_dir, signature, old_count + added, last_rowid, offsets, index["station_ids"], metrics)
+    return added
+
+
+def store_row_count(database):
+    with dbpool.connect(database) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM climate_data;")
+        return cur.fetchone()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export climate_data as memory-mappable column files.")
+    parser.add_argument("action", choices=["export", "refresh"])
+    parser.add_argument("--db", default=aggregates.DB_PATH, help="path to climate.db")
+    parser.add_argument("--dir", help="output directory (default: next to climate.db, eg. database/climate_columns)")
+    args = parser.parse_args()
+    if np is None:
+        raise SystemExit("numpy is needed for column files")
+    if args.action == "export":
+        metrics = export(args.db, args.dir)
+        print(f"Exported {len(metrics)} metric columns to {args.dir or get_files_dir(args.db)}")
+    else:
+        print(f"Added {refresh(args.db, args.dir)} rows to {args.dir or get_files_dir(args.db)}")
@@ -0,0 +1,242 @@
+#Shared SQLite connection pool used by every page module (and pyhtml.get_results_from_query).
+#Instead of each data function opening its own sqlite3.connect(DB_PATH), they borrow a
+#read-only connection from here and hand it back when the `with` block ends:
+#
+#    with dbpool.connect(DB_PATH) as conn:
+#        cur = conn.cursor()
+#        ...
+#
+#Connections are opened lazily (up to MAX_CONNECTIONS per database file) and kept open
+#between requests. A thread that already holds a connection gets the same one back if it
+#asks again, so nested helpers never deadlock waiting on themselves.
+#
+#Cursors from these connections feed the "pyhtml.query" log: a sample of queries (and every
+#slow one) is logged with the calling function, row count and time taken - never the rows.
+#Every query's time also goes into the pyhtml_sql_seconds histogram (see metrics.py). The
+#calling function is looked up from the stack only when one of those actually records the
+#query, so with logging quiet and metrics off a query costs two clock reads.
+
+import contextlib
+import logging
+import os
+import pathlib
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+
+MAX_CONNECTIONS = 8
+
+QUERY_LOG_SAMPLE_RATE = 0.01  #Fraction of queries logged at INFO level
+SLOW_QUERY_MS = 250.0         #Queries slower than this are always logged, as warnings
+
+query_log = logging.getLogger("pyhtml.query")
+
+_caller_names = {}  #code object -> "module.function"
+
+#Applied to every new connection. query_only makes any accidental write fail loudly.
+PRAGMAS = {
+    "mmap_size": 256 * 1024 * 1024,  #Let SQLite read pages straight from the OS page cache
+    "cache_size": -64 * 1024,        #Negative means KiB, so 64MB of page cache per connection
+    "temp_store": "MEMORY",
+    "query_only": "ON",
+}
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    #Times each query from execute() until its results have been fetched
+    started = None
+
+    def execute(self, sql, parameters=()):
+        self.query_sql = sql
+        self.query_rows = 0
+        self.started = time.perf_counter()
+        return super().execute(sql, parameters)
+
+    def fetchone(self):
+        row = super().fetchone()
+        self.finish_query(0 if row is None else 1)
+        return row
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.finish_query(len(rows))
+        return rows
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = super().fetchmany(size)
+        self.query_rows += len(rows)
+        if len(rows) < size:
+            self.finish_query(0)
+        return rows
+
+    def finish_query(self, rows):
+        #Called from the fetch methods, so the function that fetched (normally the one that
+        #ran the query) is two frames up
+        if self.started is None:
+            return
+        elapsed = time.perf_counter() - self.started
+        elapsed_ms = elapsed * 1000.0
+        self.started = None
+        self.query_rows += rows
+        if metrics.enabled:
+            metrics.observe("pyhtml_sql_seconds", elapsed, caller=get_caller(2))
+        if elapsed_ms >= SLOW_QUERY_MS:
+            query_log.warning("slow query caller=%s rows=%d ms=%.2f sql=%s",
+                              get_caller(2), self.query_rows, elapsed_ms, ShortSQL(self.query_sql))
+        elif QUERY_LOG_SAMPLE_RATE and query_log.isEnabledFor(logging.INFO) and random.random() < QUERY_LOG_SAMPLE_RATE:
+            query_log.info("query caller=%s rows=%d ms=%.2f sql=%s",
+                           get_caller(2), self.query_rows, elapsed_ms, ShortSQL(self.query_sql))
+
+
+def get_caller(depth):
+    #"module.function" of the frame `depth` levels above the function calling this
+    frame = sys._getframe(depth + 1)
+    name = _caller_names.get(frame.f_code)
+    if name is None:
+        name = _caller_names[frame.f_code] = f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}"
+    return name
+
+
+class ShortSQL:
+    #Whitespace-collapsed, truncated SQL text, only built if the log line is actually written
+    def __init__(self, sql):
+        self.sql = sql
+
+    def __str__(self):
+        text = " ".join(self.sql.split())
+        return text if len(text) <= 200 else text[:197] + "..."
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+
+class ConnectionPool:
+    def __init__(self, database, max_connections=MAX_CONNECTIONS, pragmas=None):
+        self.database = database
+        self.max_connections = max(1, int(max_connections))
+        self.pragmas = dict(PRAGMAS if pragmas is None else pragmas)
+        self.idle = []
+        self.open_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.lock = threading.Condition()
+        self.local = threading.local()
+
+    def open_connection(self):
+        uri = pathlib.Path(os.path.abspath(self.database)).as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=InstrumentedConnection)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value};")
+        return conn
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                if self.idle:
+                    self.hits += 1
+                    return self.idle.pop()
+                if self.open_count < self.max_connections:
+                    #Reserve the slot now, open outside the lock below
+                    self.open_count += 1
+                    self.misses += 1
+                    break
+                self.waits += 1
+                self.lock.wait()
+        try:
+            return self.open_connection()
+        except Exception:
+            with self.lock:
+                self.open_count -= 1
+                self.lock.notify()
+            raise
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            self.idle.append(conn)
+            self.lock.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        held = getattr(self.local, "conn", None)
+        if held is not None:
+            #Re-entrant use from the same thread shares the connection already checked out
+            with self.lock:
+                self.hits += 1
+            self.local.depth += 1
+            try:
+                yield held
+            finally:
+                self.local.depth -= 1
+            return
+
+        conn = self.acquire()
+        self.local.conn = conn
+        self.local.depth = 1
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            self.local.depth = 0
+            self.release(conn)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "database": self.database,
+                "open": self.open_count,
+                "idle": len(self.idle),
+                "in_use": self.open_count - len(self.idle),
+                "max": self.max_connections,
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+            }
+
+    def close(self):
+        #Closes idle connections. The pool stays usable and reopens connections on demand
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+                self.open_count -= 1
+            self.idle = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database):
+    key = os.path.abspath(database)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(database)
+        return pool
+
+
+def connect(database):
+    #Drop-in replacement for `sqlite3.connect(database)` in a `with` statement
+    return get_pool(database).connection()
+
+
+def stats():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [pool.stats() for pool in pools]
+
+
+def close_all():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
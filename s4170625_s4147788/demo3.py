@@ -1,4 +1,7 @@
 import pyhtml
+import indexes
+import columnstore
+import prerender
 import student_a_level_1
 import student_a_level_2
 import student_a_level_3
@@ -8,6 +11,7 @@ import student_b_level_2
 import student_b_level_3
 
 pyhtml.need_debugging_help=True
+pyhtml.server_workers=8  #How many requests can be handled at the same time
 
 #All pages that you want on the site need to be added as below
 pyhtml.MyRequestHandler.pages["/"]      =student_a_level_1; #Page to show when someone accesses "http://localhost/"
@@ -17,5 +21,19 @@ pyhtml.MyRequestHandler.pages["/page1b"]=student_b_level_1; #Page to show when s
 pyhtml.MyRequestHandler.pages["/page2b"]=student_b_level_2; #Page to show when someone accesses "http://localhost/page2b"
 pyhtml.MyRequestHandler.pages["/page3b"]=student_b_level_3; #Page to show when someone accesses "http://localhost/page3b"
 
-#Host the site!
-pyhtml.host_site()
\ No newline at end of file
+#Only when run as the main script: worker processes (see PARALLEL_WORKERS in
+#student_a_level_3.py) import this file again and must not start another server
+if __name__ == "__main__":
+    #Make sure climate.db has the indexes the pages rely on (only slow the first time)
+    indexes.ensure_indexes()
+
+    #Keep climate_data in memory as NumPy columns for the period averages/totals (only if numpy
+    #is installed, otherwise the pages keep querying SQLite)
+    columnstore.load(indexes.DB_PATH)
+
+    #Render and compress the pages that never change before the first visitor arrives
+    prerender.get_static_page(student_a_level_1)
+    prerender.get_static_page(student_b_level_1)
+
+    #Host the site!
+    pyhtml.host_site()
\ No newline at end of file
@@ -0,0 +1,195 @@
+#Index advisor for climate.db.
+#Checks the queries the page modules run with EXPLAIN QUERY PLAN, creates any missing
+#indexes they need and prints the query plans before and after.
+#
+#Run it by hand:            python indexes.py            (create missing indexes)
+#                           python indexes.py --check    (only report, change nothing)
+#or at startup (demo3.py):  indexes.ensure_indexes()
+
+import argparse
+import os
+import sqlite3
+
+DB_PATH = os.path.join(os.path.dirname(__file__), "database", "climate.db")
+
+#name -> (table, indexed columns/expressions)
+INDEXES = {
+    #Every per-station lookup filters climate_data by station_id and a date range
+    "idx_climate_data_station_date": ("climate_data", "station_id, date"),
+    #Level 2a filters by the normalised state and a latitude band. The expression has to be
+    #written exactly as the queries write it for SQLite to use the index
+    "idx_weather_station_state_lat": ("weather_station", "UPPER(TRIM(state)), latitude"),
+    #Station dropdowns list every station ordered by name
+    "idx_weather_station_name": ("weather_station", "name, station_id"),
+}
+
+#Representative versions of the hot queries issued by the page modules, with the index each
+#one needs: name -> (sql, params, index). {metric} is filled in with the first metric column
+#of climate_data
+SAMPLE_QUERIES = {
+    #One grouped pass over every station (conditional aggregation, see user-003)
+    "get_all_station_period_avgs (3a)": (
+        "SELECT station_id, AVG(CASE WHEN date BETWEEN ? AND ? THEN {metric} END), "
+        "AVG(CASE WHEN date BETWEEN ? AND ? THEN {metric} END) FROM climate_data "
+        "WHERE (date BETWEEN ? AND ? OR date BETWEEN ? AND ?) GROUP BY station_id;",
+        ("2000-01-01", "2000-12-31", "2010-01-01", "2010-12-31") * 2,
+        "idx_climate_data_station_date"),
+    #Both period totals of every metric for one station in a single query
+    "get_all_metric_totals (3b)": (
+        "SELECT SUM(CASE WHEN date BETWEEN ? AND ? THEN {metric} END), "
+        "SUM(CASE WHEN date BETWEEN ? AND ? THEN {metric} END) FROM climate_data "
+        "WHERE station_id = ? AND (date BETWEEN ? AND ? OR date BETWEEN ? AND ?);",
+        ("2000-01-01", "2000-12-31", "2010-01-01", "2010-12-31", 1,
+         "2000-01-01", "2000-12-31", "2010-01-01", "2010-12-31"),
+        "idx_climate_data_station_date"),
+    #Partial months at the ends of a range for every station (see aggregates.py). After ANALYZE
+    #SQLite skip-scans the (station_id, date) index for this, so no separate date index
+    "aggregates.get_raw_stats (all stations)": (
+        "SELECT station_id, COUNT(*), SUM({metric}), COUNT({metric}) FROM climate_data "
+        "WHERE date BETWEEN ? AND ? GROUP BY station_id;",
+        ("2000-01-15", "2000-01-31"),
+        "idx_climate_data_station_date"),
+    "get_metric_data (2b)": (
+        "SELECT cd.station_id, cd.date, cd.{metric}, ws.state, ws.region FROM climate_data cd "
+        "JOIN weather_station ws ON cd.station_id = ws.station_id "
+        "WHERE cd.station_id = ? AND cd.date BETWEEN ? AND ? ORDER BY date ASC;",
+        (1, "2000-01-01", "2000-12-31"),
+        "idx_climate_data_station_date"),
+    "get_station_data (2a)": (
+        "SELECT station_id, name, region, latitude FROM weather_station "
+        "WHERE UPPER(TRIM(state))=? AND latitude BETWEEN ? AND ? ORDER BY station_id ASC;",
+        ("VIC", -40.0, -30.0),
+        "idx_weather_station_state_lat"),
+    "get_summary_data (2a)": (
+        "SELECT ws.region, COUNT(DISTINCT ws.station_id), AVG(cd.{metric}) FROM weather_station ws "
+        "LEFT JOIN climate_data cd ON ws.station_id = cd.station_id "
+        "WHERE UPPER(TRIM(ws.state))=? AND ws.latitude BETWEEN ? AND ? GROUP BY ws.region;",
+        ("VIC", -40.0, -30.0),
+        "idx_climate_data_station_date"),
+    "get_all_stations": (
+        "SELECT station_id, name FROM weather_station ORDER BY name;", (),
+        "idx_weather_station_name"),
+}
+
+
+def get_existing_indexes(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='index';")
+    return {row[0] for row in cur.fetchall()}
+
+
+def get_columns(conn, table):
+    cur = conn.cursor()
+    cur.execute(f"PRAGMA table_info({table});")
+    return {row[1] for row in cur.fetchall()}
+
+
+def get_query_plans(conn):
+    #Returns {query name: [plan detail lines]}. Queries that reference columns this copy
+    #of the database doesn't have are reported instead of failing the whole run
+    plans = {}
+    metrics = sorted(get_columns(conn, "climate_data") - {"station_id", "date"})
+    metric = metrics[0] if metrics else "station_id"
+    cur = conn.cursor()
+    for name, (sql, params, index) in SAMPLE_QUERIES.items():
+        try:
+            cur.execute("EXPLAIN QUERY PLAN " + sql.format(metric=f"[{metric}]"), params)
+            plans[name] = [row[3] for row in cur.fetchall()]
+        except sqlite3.Error as e:
+            plans[name] = [f"(could not plan: {e})"]
+    return plans
+
+
+#Plans name a table by its alias when the query gives it one
+TABLE_ALIASES = {"cd": "climate_data", "ws": "weather_station"}
+
+
+def is_full_scan(line, table=None):
+    #"SCAN climate_data" reads the whole table; "SCAN climate_data USING INDEX ..." walks an index
+    words = line.split()
+    if len(words) < 2 or words[0] != "SCAN" or "USING" in words:
+        return False
+    return table is None or TABLE_ALIASES.get(words[1], words[1]) == table
+
+
+def find_missing_indexes(conn, plans=None):
+    #An index is missing when a query that needs it is planned as a full scan of its table.
+    #Going by the plan rather than the index name means an equivalent index created under
+    #another name counts, and one SQLite won't use for the query doesn't
+    if plans is None:
+        plans = get_query_plans(conn)
+    existing = get_existing_indexes(conn)
+    missing = {}
+    for name, (sql, params, index) in SAMPLE_QUERIES.items():
+        table, columns = INDEXES[index]
+        if index in existing or index in missing:
+            continue
+        if not any(is_full_scan(line, table) for line in plans.get(name, ())):
+            continue
+        #Skip indexes for columns this copy of the database doesn't have
+        needed = {c.strip() for c in columns.replace("UPPER(TRIM(", "").replace("))", "").split(",")}
+        if needed <= get_columns(conn, table):
+            missing[index] = (table, columns)
+    return missing
+
+
+def print_plans(title, plans):
+    print(title)
+    for name, lines in plans.items():
+        print(f"  {name}")
+        for line in lines:
+            marker = "  <-- full scan" if is_full_scan(line) else ""
+            print(f"      {line}{marker}")
+
+
+def ensure_indexes(database=DB_PATH, check_only=False, verbose=True):
+    #Creates any missing indexes (unless check_only) and returns the names that were missing
+    if not os.path.exists(database):
+        if verbose:
+            print(f"Index check skipped: {database} not found")
+        return []
+
+    conn = sqlite3.connect(database)
+    try:
+        plans = get_query_plans(conn)
+        missing = find_missing_indexes(conn, plans)
+        if not missing:
+            if verbose:
+                print("Index check: no query needs a missing index")
+                if check_only:
+                    print_plans("Query plans:", plans)
+            return []
+
+        if verbose:
+            print_plans("Query plans before:", plans)
+        if check_only:
+            if verbose:
+                print("Missing indexes: " + ", ".join(missing))
+            return list(missing)
+
+        for name, (table, columns) in missing.items():
+            if verbose:
+                print(f"Creating {name} ON {table}({columns}) ...")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns});")
+        #Refresh the planner statistics so the new indexes are actually picked
+        conn.execute("ANALYZE;")
+        conn.commit()
+
+        if verbose:
+            print_plans("Query plans after:", get_query_plans(conn))
+        return list(missing)
+    except sqlite3.OperationalError as e:
+        #eg. the database file is read-only; the site still works, just slower
+        if verbose:
+            print(f"Could not create indexes: {e}")
+        return []
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and create the indexes climate.db needs.")
+    parser.add_argument("--db", default=DB_PATH, help="path to climate.db")
+    parser.add_argument("--check", action="store_true", help="only report missing indexes and query plans")
+    args = parser.parse_args()
+    ensure_indexes(args.db, check_only=args.check)
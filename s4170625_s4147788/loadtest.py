@@ -0,0 +1,231 @@
+#HTTP load generator for the running site (python demo3.py), to check server concurrency and
+#caching changes end to end.
+#
+#    python loadtest.py --url http://localhost:80 --concurrency 16 --duration 30
+#    python loadtest.py --mix page2a_form=1,page3a=1 --requests 500
+#
+#Each of --concurrency client threads keeps sending requests, picking the kind of request at
+#random by the --mix weights:
+#    home         GET /
+#    page2a_form  /page2a form submission with a random state, latitude band and metric
+#    page2a_sort  a click on one of the sort links from a page2a result the thread got earlier
+#    page3a       /page3a similar stations search with random metric, station and periods
+#    static       one of the images in images/
+#States, metrics and stations are read from the site's own form <select>s at startup.
+#At the end it prints requests per second, the error rate and latency percentiles per route.
+
+import argparse
+import html
+import http.client
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+
+DEFAULT_MIX = "home=1,page2a_form=4,page2a_sort=3,page3a=1,static=2"
+IMAGES_DIR = os.path.join(os.path.dirname(__file__), "images")
+LATITUDE_RANGE = (-44.0, -10.0)
+
+
+def get_select_values(page, name):
+    match = re.search(r'<select name="%s"[^>]*>(.*?)</select>' % re.escape(name), page, re.S)
+    if not match:
+        return []
+    return [html.unescape(v) for v in re.findall(r'<option value="([^"]+)"', match.group(1))]
+
+
+class Client:
+    #One HTTP connection per thread. With keep_alive the connection is reused until the
+    #server closes it, otherwise every request opens a new one (like the default HTTP/1.0 server)
+    def __init__(self, host, port, keep_alive=False, timeout=60):
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.conn = None
+
+    def get(self, path):
+        reused = self.conn is not None
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.conn.request("GET", path, headers={} if self.keep_alive else {"Connection": "close"})
+            response = self.conn.getresponse()
+            body = response.read()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            self.close()
+            if not reused:
+                raise
+            #The server closed the idle connection as this request went out; browsers retry
+            #on a new connection in that case, so do the same
+            return self.get(path)
+        except Exception:
+            self.close()
+            raise
+        if not self.keep_alive or response.will_close:
+            self.close()
+        return response.status, body
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class LoadTest:
+    def __init__(self, url, mix, concurrency=8, duration=30.0, max_requests=None, keep_alive=False,
+                 years=(2000, 2009), seed=1):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 80
+        self.mix = mix
+        self.concurrency = concurrency
+        self.duration = duration
+        self.max_requests = max_requests
+        self.keep_alive = keep_alive
+        self.years = years
+        self.seed = seed
+        self.images = sorted(f for f in os.listdir(IMAGES_DIR) if not f.startswith("."))
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.results = {}  #route -> list of (seconds, ok, bytes)
+
+    def discover(self):
+        client = Client(self.host, self.port)
+        status, body = client.get("/page2a")
+        page2a = body.decode("utf-8", "replace")
+        status, body = client.get("/page3a")
+        page3a = body.decode("utf-8", "replace")
+        self.states = get_select_values(page2a, "state")
+        self.metrics = get_select_values(page2a, "metric")
+        self.stations = get_select_values(page3a, "reference_station")
+        if not (self.states and self.metrics and self.stations):
+            raise SystemExit("Could not read states/metrics/stations from /page2a and /page3a, is the site running?")
+        print(f"Found {len(self.states)} states, {len(self.metrics)} metrics, {len(self.stations)} stations")
+
+    def make_page2a_form(self, rnd):
+        lat_start = round(rnd.uniform(*LATITUDE_RANGE), 2)
+        lat_end = round(rnd.uniform(lat_start, LATITUDE_RANGE[1]), 2)
+        return "/page2a?" + urlencode({
+            "state": rnd.choice(self.states), "lat_start": lat_start, "lat_end": lat_end,
+            "metric": rnd.choice(self.metrics),
+            "station_sort_by": "site", "station_sort_order": "asc",
+            "summary_sort_by": "region", "summary_sort_order": "asc",
+        })
+
+    def make_page3a(self, rnd):
+        first, last = self.years
+        split = rnd.randint(first, last - 1) if last > first else first
+        return "/page3a?" + urlencode({
+            "period1_start": f"{first}-01-01", "period1_end": f"{split}-12-31",
+            "period2_start": f"{split + 1}-01-01", "period2_end": f"{last}-12-31",
+            "metric": rnd.choice(self.metrics), "reference_station": rnd.choice(self.stations),
+            "num_similar": rnd.randint(1, 10),
+        })
+
+    def take_request(self):
+        with self.lock:
+            if self.max_requests is not None and self.sent >= self.max_requests:
+                return False
+            self.sent += 1
+            return True
+
+    def record(self, route, seconds, ok, size):
+        with self.lock:
+            self.results.setdefault(route, []).append((seconds, ok, size))
+
+    def worker(self, number, deadline):
+        rnd = random.Random(self.seed + number)
+        client = Client(self.host, self.port, self.keep_alive)
+        routes = list(self.mix)
+        weights = [self.mix[r] for r in routes]
+        sort_links = []
+        try:
+            while time.monotonic() < deadline and self.take_request():
+                route = rnd.choices(routes, weights)[0]
+                if route == "home":
+                    path = "/"
+                elif route == "page2a_form" or (route == "page2a_sort" and not sort_links):
+                    route, path = "page2a_form", self.make_page2a_form(rnd)
+                elif route == "page2a_sort":
+                    path = "/page2a" + rnd.choice(sort_links)
+                elif route == "page3a":
+                    path = self.make_page3a(rnd)
+                else:
+                    path = "/images/" + rnd.choice(self.images)
+
+                started = time.perf_counter()
+                try:
+                    status, body = client.get(path)
+                    ok = status < 400
+                except Exception:
+                    status, body, ok = None, b"", False
+                self.record(route, time.perf_counter() - started, ok, len(body))
+
+                if ok and path.startswith("/page2a?"):
+                    links = re.findall(r'href="(\?[^"]*_sort_by=[^"]*)"', body.decode("utf-8", "replace"))
+                    if links:
+                        sort_links = [html.unescape(link) for link in links]
+        finally:
+            client.close()
+
+    def run(self):
+        self.discover()
+        started = time.monotonic()
+        deadline = started + self.duration
+        threads = [threading.Thread(target=self.worker, args=(i, deadline), daemon=True) for i in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.elapsed = time.monotonic() - started
+        return self.results
+
+    def report(self):
+        all_results = [r for results in self.results.values() for r in results]
+        total = len(all_results)
+        errors = sum(1 for _, ok, _ in all_results if not ok)
+        print(f"\n{total} requests in {self.elapsed:.1f}s with {self.concurrency} clients"
+              f"{' (keep-alive)' if self.keep_alive else ''}: "
+              f"{total / self.elapsed:.1f} req/s, {errors} errors ({100.0 * errors / max(1, total):.2f}%)")
+        print(f"  {'route':<12} {'count':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'avg KB':>8}")
+        for route in sorted(self.results):
+            results = self.results[route]
+            times = sorted(t for t, _, _ in results)
+            pick = lambda q: times[min(len(times) - 1, int(q * len(times)))] * 1000.0
+            print(f"  {route:<12} {len(results):>7} {sum(1 for _, ok, _ in results if not ok):>7} "
+                  f"{len(results) / self.elapsed:>8.1f} {pick(0.5):>9.2f} {pick(0.95):>9.2f} {pick(0.99):>9.2f} "
+                  f"{times[-1] * 1000.0:>9.2f} {sum(s for _, _, s in results) / len(results) / 1024:>8.1f}")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        route, weight = part.split("=")
+        if route not in ("home", "page2a_form", "page2a_sort", "page3a", "static"):
+            raise SystemExit(f"Unknown route in --mix: {route}")
+        if float(weight) > 0:
+            mix[route] = float(weight)
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the running climate site")
+    parser.add_argument("--url", default="http://localhost:80")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of client threads")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run for")
+    parser.add_argument("--requests", type=int, help="stop after this many requests instead")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="route=weight list, routes: home, page2a_form, page2a_sort, page3a, static")
+    parser.add_argument("--years", default="2000-2009", help="first-last year used for /page3a periods")
+    parser.add_argument("--keep-alive", action="store_true", help="reuse connections when the server allows it")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    first_year, last_year = (int(y) for y in args.years.split("-"))
+    duration = float("inf") if args.requests and args.duration == parser.get_default("duration") else args.duration
+    test = LoadTest(args.url, parse_mix(args.mix), args.concurrency, duration, args.requests,
+                    args.keep_alive, (first_year, last_year), args.seed)
+    test.run()
+    test.report()
@@ -0,0 +1,116 @@
+#Shared cache for reference data that almost never changes: the metric list (table schema),
+#the station list, the state list, station names, description.csv, ...
+#
+#    @metacache.cached(lambda: DB_PATH)
+#    def get_metrics():
+#        ...
+#
+#The path is given as a function so it is looked up on every call: benchmark.py and the tests
+#repoint a page module's DB_PATH, and the cache has to follow the file actually being read.
+#Entries are kept per file, so several databases can be cached at once.
+#
+#Entries are evicted least-recently-used once MAX_ENTRIES is reached, can optionally expire
+#after a TTL, and are all dropped as soon as the file they came from changes (its size or
+#modification time, or those of its -wal file when SQLite runs in WAL mode).
+#Cached values are shared between requests, so callers must not modify them.
+
+import collections
+import functools
+import os
+import threading
+import time
+
+MAX_ENTRIES = 512
+
+
+def get_file_signature(path):
+    sig = []
+    for p in (path, path + "-wal"):
+        try:
+            st = os.stat(p)
+            sig.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+
+class MetadataCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  #key -> (value, file signature, expires at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, path, loader, ttl=None):
+        signature = get_file_signature(path)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, entry_signature, expires = entry
+                if entry_signature == signature and (expires is None or now < expires):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+                self.invalidations += 1
+            self.misses += 1
+
+        #Load outside the lock so a slow query doesn't block other lookups
+        value = loader()
+        with self.lock:
+            self.entries[key] = (value, signature, None if ttl is None else now + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+_cache = MetadataCache()
+
+
+def cached(path, ttl=None):
+    #Decorator caching a function's result per positional arguments until `path` changes
+    #(or `ttl` seconds pass, if given). `path` is a file name or a function returning one
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            source = path() if callable(path) else path
+            return _cache.get((name, source) + args, source, lambda: func(*args), ttl)
+
+        wrapper.uncached = func
+        return wrapper
+    return decorator
+
+
+def lookup(key, path, loader, ttl=None):
+    return _cache.get(key, path, loader, ttl)
+
+
+def stats():
+    return _cache.stats()
+
+
+def clear():
+    _cache.clear()
@@ -0,0 +1,148 @@
+#Latency and counter metrics for the site, served by pyhtml at /metrics in the Prometheus
+#text format.
+#
+#    metrics.observe("pyhtml_page_seconds", 0.012, page="/page3a", phase="render")
+#    metrics.inc("pyhtml_requests_total", page="/page3a", status="200")
+#
+#Every series is a histogram (for Prometheus to aggregate) and also keeps its most recent
+#samples so p50/p95/p99 can be shown directly without a Prometheus server.
+
+import bisect
+import collections
+import threading
+
+#Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+RECENT_SAMPLES = 1024
+#False records nothing: observe() and inc() return straight away (pyhtml turns this off when
+#its /metrics route is off)
+enabled = True
+
+HELP = {
+    "pyhtml_page_seconds": "Time spent per page request, by phase (render = get_page_html, encode, write, total).",
+    "pyhtml_sql_seconds": "Time from execute() until the results were fetched, by calling function.",
+    "pyhtml_requests_total": "Requests answered, by page and status code.",
+}
+
+
+class Series:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent = collections.deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def quantiles(self):
+        ordered = sorted(self.recent)
+        if not ordered:
+            return {}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  #(name, labels) -> Series
+        self.counters = {}    #(name, labels) -> int
+        self.gauge_sources = []
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = Series()
+            series.observe(seconds)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_gauges(self, source):
+        #source() returns [(name, labels dict, value), ...]; called on every scrape
+        self.gauge_sources.append(source)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            snapshots = [(key, list(s.bucket_counts), s.count, s.total, s.quantiles()) for key, s in histograms]
+
+        seen = set()
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for (name, labels), bucket_counts, count, total, quantiles in snapshots:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS + (float("inf"),), bucket_counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total!r}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+
+        #Recent-sample percentiles as a separate gauge family
+        for (name, labels), bucket_counts, count, total, quantiles in snapshots:
+            for q, value in quantiles.items():
+                header(name + "_recent", "gauge")
+                lines.append(f"{name}_recent{format_labels(labels + (('quantile', str(q)),))} {value!r}")
+
+        for source in self.gauge_sources:
+            for name, labels, value in source():
+                header(name, "gauge")
+                lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+registry = Registry()
+
+
+def observe(name, seconds, **labels):
+    if enabled:
+        registry.observe(name, seconds, **labels)
+
+
+def inc(name, amount=1, **labels):
+    if enabled:
+        registry.inc(name, amount, **labels)
+
+
+def add_gauges(source):
+    registry.add_gauges(source)
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,135 @@
+#Pre-rendering for pages that don't depend on the form data (Home and Mission).
+#
+#A page module opts in with STATIC_PAGE = True. Its get_page_html({}) is called once, the
+#result is encoded and compressed (gzip, and brotli if the brotli package is installed), and
+#pyhtml sends those bytes straight from memory with a strong ETag per encoding. The page is
+#rebuilt when its module file or its CACHE_FILE (eg. description.csv) changes, or when one of
+#the images listed in its ASSETS gets a new fingerprinted URL (see assets.py); a changed
+#module is reloaded first so the new code is what gets rendered.
+#
+#    python prerender.py                      #build and show the sizes
+#    python prerender.py --out build/pages    #also write index.html, index.html.gz, ... there
+
+import argparse
+import email.utils
+import gzip
+import hashlib
+import importlib
+import os
+import threading
+import time
+
+import assets
+import metacache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+
+class StaticPage:
+    def __init__(self, body, signature, last_modified):
+        self.signature = signature
+        self.last_modified = email.utils.formatdate(last_modified, usegmt=True)
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        #encoding -> (body, etag). Each encoding gets its own strong ETag since the bytes differ,
+        #named like pyhtml's compressed copies ("<digest>-<encoding>")
+        self.variants = {"identity": (body, f'"{digest}"')}
+        self.variants["gzip"] = (gzip.compress(body, GZIP_LEVEL, mtime=0), f'"{digest}-gzip"')
+        if brotli is not None:
+            self.variants["br"] = (brotli.compress(body, quality=BROTLI_QUALITY), f'"{digest}-br"')
+
+
+def get_sources(page):
+    sources = [page.__file__]
+    if getattr(page, "CACHE_FILE", None):
+        sources.append(page.CACHE_FILE)
+    return sources
+
+
+def get_signature(page):
+    #The module file's signature comes first (StaticPages.get reloads the module if it changed)
+    return (tuple(metacache.get_file_signature(path) for path in get_sources(page))
+            + tuple(assets.url(name) for name in getattr(page, "ASSETS", ())))
+
+
+def get_last_modified(page):
+    #Newest mtime of the page's sources, so Last-Modified stays the same across restarts
+    mtimes = []
+    for path in get_sources(page):
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            pass
+    for name in getattr(page, "ASSETS", ()):
+        asset = assets.store.get(name)
+        if asset is not None:
+            mtimes.append(asset.last_modified)
+    return max(mtimes, default=time.time())
+
+
+def build(page):
+    body = page.get_page_html({})
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    elif not isinstance(body, bytes):
+        body = b"".join(f if isinstance(f, bytes) else f.encode("utf-8") for f in body)
+    return body
+
+
+class StaticPages:
+    def __init__(self):
+        self.pages = {}  #module name -> StaticPage
+        self.lock = threading.Lock()
+
+    def get(self, page):
+        signature = get_signature(page)
+        entry = self.pages.get(page.__name__)
+        if entry is not None and entry.signature == signature:
+            return entry
+        with self.lock:
+            entry = self.pages.get(page.__name__)
+            if entry is not None and entry.signature == signature:
+                return entry
+            if entry is not None and entry.signature[0] != signature[0]:
+                page = importlib.reload(page)
+            entry = StaticPage(build(page), signature, get_last_modified(page))
+            self.pages[page.__name__] = entry
+            return entry
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+
+
+static_pages = StaticPages()
+
+
+def get_static_page(page):
+    #The page's pre-rendered bytes, building them on first use or after a change
+    return static_pages.get(page)
+
+
+if __name__ == "__main__":
+    import student_a_level_1
+    import student_b_level_1
+
+    parser = argparse.ArgumentParser(description="Pre-render the static pages")
+    parser.add_argument("--out", help="also write the page files (and .gz/.br) to this directory")
+    args = parser.parse_args()
+
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+    for name, page in (("index.html", student_a_level_1), ("mission.html", student_b_level_1)):
+        entry = get_static_page(page)
+        sizes = ", ".join(f"{encoding} {len(body)}" for encoding, (body, _) in entry.variants.items())
+        print(f"{page.__name__}: {sizes} bytes")
+        if args.out:
+            for encoding, (body, _) in entry.variants.items():
+                suffix = {"identity": "", "gzip": ".gz", "br": ".br"}[encoding]
+                with open(os.path.join(args.out, name + suffix), "wb") as f:
+                    f.write(body)
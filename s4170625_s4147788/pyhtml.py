@@ -2,64 +2,787 @@
 #File version: 2025.03.28
 #Author: Gayan Wijesinghe, for questions, contact via Ms Teams.
 
-import sqlite3
+import collections
+import email.utils
+import hashlib
+import logging
 import os
+import select
+import signal
+import threading
+import time
+import zlib
 
 import http.server
 import socketserver
-from urllib.parse import parse_qs, urlparse
-need_debugging_help=True
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlparse
+
+import assets
+import dbpool
+import metacache
+import metrics
+import prerender
+import templates
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+need_debugging_help=True  #Turns on the access log and the sampled query log (see configure_logging)
+log_level="INFO"          #Use "DEBUG" to also log form data for every request
+
+logger = logging.getLogger("pyhtml")
+access_log = logging.getLogger("pyhtml.access")
+
+#Serving options, change these before calling host_site() (eg. from demo3.py)
+server_workers=8      #Number of worker threads handling requests at the same time
+server_backlog=64     #Connections allowed to wait for a free worker before new ones are refused
+
+#HTTP/1.1 persistent connections: a browser can send its next request (sort link clicks, the
+#images of a page) on the same connection. A worker thread stays with an idle connection for at
+#most keep_alive_timeout seconds, and lets it go straight away if other connections are
+#waiting for a worker. Set keep_alive=False to go back to one request per connection (HTTP/1.0)
+keep_alive=True
+keep_alive_timeout=5          #Seconds an idle connection is kept open
+keep_alive_max_requests=100   #Requests per connection before the server closes it
+request_timeout=30            #Seconds a client may take to send a request or read the response
+
+#Pages opt in to response caching by setting CACHE_TTL (seconds) in their module, eg. CACHE_TTL=300.
+#Cached pages are also dropped as soon as the file the page reads from changes: the module's
+#CACHE_FILE if it sets one, otherwise its DB_PATH. A page that returns (or streams a piece
+#of) templates.Uncached text, eg. an error message, is sent but not cached.
+response_cache_max_bytes=32*1024*1024
+response_cache_max_entries=1024
+
+#Pages are compressed when the browser accepts it (zstd and br only if the zstandard/brotli
+#packages are installed). Whole pages smaller than compress_min_bytes are sent as they are;
+#streamed pages are always compressed, flushing at every write so nothing is held back.
+#Static files are sent as their .br/.gz copy (eg. style.css.gz) when one exists and is up to date
+compress_min_bytes=1024
+compress_level=6
+
+#Images are served from the images/ folder next to this file (see assets.py). Any other static
+#files (eg. a stylesheet) are only served from static_dir, never the code or the database;
+#everything else is a 404
+static_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+#Pages that set STATIC_PAGE=True don't look at the form data; they are rendered and compressed
+#once (see prerender.py) and sent from memory, in the best encoding the browser accepts
+
+#Pages may return an iterator/generator of HTML pieces instead of one string; they are sent
+#as they are produced, grouped into writes of about this many bytes
+stream_flush_bytes=16*1024
+#A streamed page of a module with CACHE_TTL is collected for the response cache while it is
+#sent, up to this many bytes; past that it is just sent, so memory stays flat however long
+#the page is. A module that streams because its pages are big sets CACHE_STREAMED=False
+stream_cache_max_bytes=256*1024
+
+#Latency histograms (page render/encode/write, SQL per calling function) and cache/pool
+#counters in the Prometheus text format. Set to None to turn the route off
+metrics_path="/metrics"
+
+class ResponseCache:
+    #Size-bounded LRU of fully rendered pages, keyed by path + canonical query string
+    def __init__(self, max_bytes, max_entries):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  #key -> CachedResponse
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, signature):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.signature == signature and now < entry.expires:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            entry.key = key
+            self.entries[key] = entry
+            self.size += entry.size
+            self.evict()
+
+    def grow(self, entry, extra):
+        #A compressed copy of a cached page was made: it counts against max_bytes too
+        with self.lock:
+            if self.entries.get(entry.key) is not entry:
+                return
+            entry.size += extra
+            self.size += extra
+            self.evict()
+
+    def evict(self):
+        #Caller holds the lock
+        while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        #Caller holds the lock
+        self.size -= self.entries.pop(key).size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+class CachedResponse:
+    def __init__(self, body, signature=None, ttl=0):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.last_modified = int(time.time())
+        self.signature = signature
+        self.expires = time.monotonic() + ttl
+        self.cached = ttl > 0
+        #encoding -> (compressed body, etag), made on first request for that encoding and
+        #kept while the page is cached. `size` (body plus these) is what the cache counts
+        self.variants = {}
+        self.size = len(body)
+        self.key = None
+
+    def get_variant(self, encoding):
+        if encoding == "identity":
+            return self.body, self.etag
+        variant = self.variants.get(encoding)
+        if variant is None:
+            compressor = Compressor(encoding)
+            variant = (compressor.compress(self.body) + compressor.finish(), get_variant_etag(self.etag, encoding))
+            #Two threads may compress at once; only the copy that is kept gets counted
+            kept = self.variants.setdefault(encoding, variant)
+            if kept is variant and self.cached:
+                response_cache.grow(self, len(variant[0]))
+            variant = kept
+        return variant
+
+def get_variant_etag(etag, encoding):
+    #Strong ETag of a compressed copy: the page's ETag with the encoding added, eg. "abc-gzip"
+    return etag[:-1] + "-" + encoding + '"'
+
+response_cache = ResponseCache(response_cache_max_bytes, response_cache_max_entries)
+
+def get_cache_key(path, form_data):
+    #Same page + same form values = same key, whatever order the browser sent them in
+    return (path, tuple(sorted((k, tuple(v)) for k, v in form_data.items())))
+
+class StreamedResponse:
+    #A page that returned an iterator/generator of HTML pieces (str or bytes) instead of one
+    #string. If the page opted in to caching, the pieces are collected while they are sent
+    #and the finished page is cached, so the next identical request is served from memory
+    #(not for modules with CACHE_STREAMED=False, pages over stream_cache_max_bytes or pages
+    #with a templates.Uncached piece)
+    def __init__(self, fragments, cache_key=None, signature=None, ttl=0):
+        self.fragments = fragments
+        self.cache_key = cache_key
+        self.signature = signature
+        self.ttl = ttl
+        self.render_time = 0.0  #Time get_page_html took to return the iterator
+
+def get_page_response(page, path, form_data):
+    #Returns a CachedResponse, or a StreamedResponse if the page chose to stream
+    ttl = getattr(page, "CACHE_TTL", None)
+    if not ttl:
+        return render_page(page, path, form_data)
+
+    source = getattr(page, "CACHE_FILE", getattr(page, "DB_PATH", None))
+    signature = metacache.get_file_signature(source) if source else None
+    key = get_cache_key(path, form_data)
+    entry = response_cache.get(key, signature)
+    if entry is None:
+        entry = render_page(page, path, form_data, key, signature, ttl)
+        if isinstance(entry, CachedResponse) and entry.cached:
+            response_cache.put(key, entry)
+    return entry
+
+def render_page(page, path, form_data, cache_key=None, signature=None, ttl=0):
+    #Calls get_page_html, recording render and encode times. For streamed pages the time
+    #spent producing each piece is added in send_streamed
+    started = time.perf_counter()
+    html_content = page.get_page_html(form_data)
+    encoding = time.perf_counter()
+    if not isinstance(html_content, (str, bytes)):
+        if not getattr(page, "CACHE_STREAMED", True):
+            cache_key = None
+        response = StreamedResponse(html_content, cache_key, signature, ttl)
+        response.render_time = encoding - started
+        return response
+    if isinstance(html_content, templates.Uncached):
+        #Eg. an error message: sent, but not kept for later requests
+        ttl = 0
+    response = CachedResponse(encode_fragment(html_content), signature, ttl)
+    metrics.observe("pyhtml_page_seconds", encoding - started, page=path, phase="render")
+    metrics.observe("pyhtml_page_seconds", time.perf_counter() - encoding, page=path, phase="encode")
+    return response
+
+def encode_fragment(fragment):
+    return fragment if isinstance(fragment, bytes) else fragment.encode('utf-8')
+
+def get_accepted_encodings(header):
+    #Accept-Encoding header -> {encoding: q}. Encodings with q=0 are refused
+    accepted = {}
+    for part in (header or "").split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+def get_compress_encodings():
+    #Encodings pages can be sent in, most preferred first
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    return encodings + ["gzip", "deflate"]
+
+class Compressor:
+    #Incremental compressor for one response. compress(data, flush=True) returns everything
+    #needed to decode `data` so far (used between writes of a streamed page)
+    def __init__(self, encoding, level=None):
+        level = compress_level if level is None else level
+        self.encoding = encoding
+        if encoding == "gzip":
+            self.obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            #"deflate" in HTTP means the zlib format, not raw deflate
+            self.obj = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+        elif encoding == "br":
+            self.obj = brotli.Compressor(quality=min(level, 11))
+        elif encoding == "zstd":
+            self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+    def compress(self, data, flush=False):
+        if self.encoding == "br":
+            out = self.obj.process(data)
+            return out + self.obj.flush() if flush else out
+        out = self.obj.compress(data)
+        if flush:
+            if self.encoding == "zstd":
+                out += self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            else:
+                out += self.obj.flush(zlib.Z_SYNC_FLUSH)
+        return out
+
+    def finish(self):
+        return self.obj.finish() if self.encoding == "br" else self.obj.flush()
+
+def choose_encoding(header, available):
+    #Best of `available` (in order of preference) that the client accepts, else "identity"
+    accepted = get_accepted_encodings(header)
+    best, best_q = "identity", 0.0
+    for encoding in available:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def get_metrics_gauges():
+    #Read on every /metrics request
+    gauges = []
+    for pool in dbpool.stats():
+        for name in ("open", "idle", "in_use", "hits", "misses", "waits"):
+            gauges.append((f"pyhtml_dbpool_{name}", {"database": os.path.basename(pool["database"])}, pool[name]))
+    for name, value in metacache.stats().items():
+        gauges.append((f"pyhtml_metacache_{name}", {}, value))
+    for name, value in response_cache.stats().items():
+        gauges.append((f"pyhtml_response_cache_{name}", {}, value))
+    for name, value in assets.store.stats().items():
+        gauges.append((f"pyhtml_assets_{name}", {}, value))
+    return gauges
+
+metrics.add_gauges(get_metrics_gauges)
 
 class MyRequestHandler(http.server.SimpleHTTPRequestHandler):
     pages={}
+    #Headers and body go out in separate writes; without TCP_NODELAY the body of a response on
+    #a kept-alive connection waits for the client's delayed ACK of the headers (~40ms)
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=static_dir, **kwargs)
     def do_GET(self):
         parsed_url = urlparse(self.path)
-        debugging_helper(f"A web browser wants to GET the following: {parsed_url.path}")
         if parsed_url.path in MyRequestHandler.pages:
+            query = parsed_url.query
+            form_data = parse_qs(query)
+            logger.debug("GET %s form_data=%s", parsed_url.path, form_data)
+            self.metrics_page = parsed_url.path
+            page = MyRequestHandler.pages[parsed_url.path]
+            if getattr(page, "STATIC_PAGE", False):
+                self.send_static_page(prerender.get_static_page(page))
+                return
+
+            response = get_page_response(page, parsed_url.path, form_data)
+            if isinstance(response, StreamedResponse):
+                self.send_streamed(response)
+                return
+
+            encoding = "identity"
+            if len(response.body) >= compress_min_bytes:
+                encoding = choose_encoding(self.headers.get("Accept-Encoding"), get_compress_encodings())
+            started = time.perf_counter()
+            body, etag = response.get_variant(encoding)
+            if encoding != "identity":
+                metrics.observe("pyhtml_page_seconds", time.perf_counter() - started, page=self.metrics_page, phase="compress")
+
+            if self.is_not_modified(response, etag):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return
+
             self.send_response(200)
             self.send_header("Content-type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            if encoding != "identity":
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("ETag", etag)
+            if response.cached:
+                self.send_header("Last-Modified", email.utils.formatdate(response.last_modified, usegmt=True))
+            #Browsers may keep the page but must check back (and get a 304 if nothing changed)
+            self.send_header("Cache-Control", "no-cache")
             self.end_headers()
-
-            query = parsed_url.query
-            form_data = parse_qs(query)
-            debugging_helper(f"\tReceived following data with GET request: {form_data}")
-            
-            html_content = MyRequestHandler.pages[parsed_url.path].get_page_html(form_data)
-            
-            self.wfile.write(html_content.encode('utf-8'))            
-        else:
+            started = time.perf_counter()
+            self.wfile.write(body)
+            metrics.observe("pyhtml_page_seconds", time.perf_counter() - started, page=self.metrics_page, phase="write")
+        elif metrics_path and parsed_url.path == metrics_path:
+            self.metrics_page = metrics_path
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.send_asset(unquote(parsed_url.path)):
+            return
+        elif not self.send_precompressed():
             # Let the server handle static files (like images, .html files)
             super().do_GET()
+
+    def setup(self):
+        self.timeout = request_timeout
+        self.requests_handled = 0
+        super().setup()
+        self.wfile = CountingWriter(self.wfile)
+
+    def handle(self):
+        #Like BaseHTTPRequestHandler.handle, but waits for the next request on a kept-alive
+        #connection in wait_for_request instead of blocking in readline
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        #True once the client has sent something (or closed the connection); False if it has
+        #been idle for keep_alive_timeout or another connection needs this worker
+        deadline = time.monotonic() + keep_alive_timeout
+        self.connection.setblocking(False)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.server.has_waiting():
+                return False
+            readable, _, _ = select.select([self.connection], [], [], min(remaining, 0.1))
+            if readable:
+                return True
+
+    def end_headers(self):
+        #Every response says whether the connection stays open
+        if not self.close_connection:
+            if self.requests_handled + 1 >= keep_alive_max_requests or self.server.has_waiting():
+                self.send_header("Connection", "close")
+            else:
+                if self.request_version < "HTTP/1.1":
+                    self.send_header("Connection", "keep-alive")
+                self.send_header("Keep-Alive", f"timeout={keep_alive_timeout}, max={keep_alive_max_requests - self.requests_handled - 1}")
+        super().end_headers()
+
+    def handle_one_request(self):
+        #One structured access log line per request, written after the response is sent
+        self.response_status = None
+        self.metrics_page = "static"  #Pages and /metrics set their own path in do_GET
+        self.wfile.count = 0
+        started = time.perf_counter()
+        super().handle_one_request()
+        if self.response_status is None:
+            return
+        self.requests_handled += 1
+        elapsed = time.perf_counter() - started
+        metrics.observe("pyhtml_page_seconds", elapsed, page=self.metrics_page, phase="total")
+        metrics.inc("pyhtml_requests_total", page=self.metrics_page, status=str(self.response_status))
+        if access_log.isEnabledFor(logging.INFO):
+            access_log.info("client=%s method=%s path=%s status=%s bytes=%d ms=%.2f",
+                            self.client_address[0], self.command, self.path, self.response_status,
+                            self.wfile.count, elapsed * 1000.0)
+
+    def log_request(self, code="-", size="-"):
+        #Called by send_response(); the access line is written once the request is done
+        self.response_status = getattr(code, "value", code)
+
+    def log_message(self, format, *args):
+        #Errors from http.server (bad requests, missing files, ...) go to the log instead of stderr
+        logger.warning("client=%s %s", self.client_address[0], format % args)
+
+    def send_static_page(self, entry):
+        encoding = choose_encoding(self.headers.get("Accept-Encoding"), [e for e in ("br", "gzip") if e in entry.variants])
+        body, etag = entry.variants[encoding]
+        if self.is_not_modified_etag(etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if encoding != "identity":
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", entry.last_modified)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        started = time.perf_counter()
+        self.wfile.write(body)
+        metrics.observe("pyhtml_page_seconds", time.perf_counter() - started, page=self.metrics_page, phase="write")
+
+    def send_streamed(self, response):
+        #Sends the page piece by piece as the page module produces it, so the browser can
+        #start rendering the top of the page while slow queries are still running.
+        #HTTP/1.1 clients get chunked transfer encoding; otherwise closing the connection
+        #marks the end of the page. The first piece goes out straight away, later small
+        #pieces are grouped into writes of about stream_flush_bytes. When compressing, each
+        #write is flushed through the compressor so the browser can decode it straight away
+        chunked = self.protocol_version >= "HTTP/1.1" and self.request_version >= "HTTP/1.1"
+        encoding = choose_encoding(self.headers.get("Accept-Encoding"), get_compress_encodings())
+        compressor = Compressor(encoding) if encoding != "identity" else None
+        fragments = response.fragments
+        collected = [] if response.cache_key is not None else None
+        collected_size = 0
+        pending = []
+        pending_size = 0
+        first = True
+        render_time, encode_time, write_time = response.render_time, 0.0, 0.0
+        self.compress_time = 0.0
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "text/html")
+            if compressor is not None:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            fragments_iter = iter(fragments)
+            while True:
+                started = time.perf_counter()
+                fragment = next(fragments_iter, None)
+                encoding = time.perf_counter()
+                render_time += encoding - started
+                if fragment is None:
+                    break
+                data = encode_fragment(fragment)
+                encode_time += time.perf_counter() - encoding
+                if not data:
+                    continue
+                if isinstance(fragment, templates.Uncached):
+                    collected = None
+                if collected is not None:
+                    collected.append(data)
+                    collected_size += len(data)
+                    if collected_size > stream_cache_max_bytes:
+                        #Too big to be worth caching, stop holding on to it
+                        collected = None
+                pending.append(data)
+                pending_size += len(data)
+                if first or pending_size >= stream_flush_bytes:
+                    data = self.compress_chunk(compressor, b"".join(pending), flush=True)
+                    started = time.perf_counter()
+                    self.write_chunk(data, chunked)
+                    write_time += time.perf_counter() - started
+                    pending, pending_size, first = [], 0, False
+            data = self.compress_chunk(compressor, b"".join(pending), finish=True)
+            started = time.perf_counter()
+            if data:
+                self.write_chunk(data, chunked)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+            write_time += time.perf_counter() - started
+        except Exception:
+            #Headers are already out so no error page can be sent; drop the connection so the
+            #browser sees an incomplete response rather than a truncated "complete" one
+            self.close_connection = True
+            raise
+        finally:
+            #Lets the page generator release its database connection even if the client left
+            if hasattr(fragments, "close"):
+                fragments.close()
+            page = self.metrics_page
+            metrics.observe("pyhtml_page_seconds", render_time, page=page, phase="render")
+            metrics.observe("pyhtml_page_seconds", encode_time, page=page, phase="encode")
+            metrics.observe("pyhtml_page_seconds", write_time, page=page, phase="write")
+            if compressor is not None:
+                metrics.observe("pyhtml_page_seconds", self.compress_time, page=page, phase="compress")
+        if collected is not None:
+            response_cache.put(response.cache_key, CachedResponse(b"".join(collected), response.signature, response.ttl))
+
+    def compress_chunk(self, compressor, data, flush=False, finish=False):
+        if compressor is None:
+            return data
+        started = time.perf_counter()
+        data = compressor.compress(data, flush)
+        if finish:
+            data += compressor.finish()
+        self.compress_time += time.perf_counter() - started
+        return data
+
+    def send_asset(self, path):
+        #Sends an image from images/ (fingerprinted /assets/ URL or plain /images/ one).
+        #Returns False if the path isn't one
+        asset, immutable = assets.lookup(path)
+        if asset is None:
+            return False
+        file = asset.get_file(self.headers.get("Accept"))
+        if self.is_not_modified_etag(file.etag):
+            self.send_response(304)
+            self.send_header("ETag", file.etag)
+            self.end_headers()
+            return True
+        self.send_response(200)
+        self.send_header("Content-type", file.content_type)
+        self.send_header("Content-Length", str(file.size))
+        self.send_header("ETag", file.etag)
+        self.send_header("Last-Modified", self.date_time_string(asset.last_modified))
+        self.send_header("Cache-Control", assets.IMMUTABLE_CACHE_CONTROL if immutable else "no-cache")
+        if asset.webp is not None:
+            self.send_header("Vary", "Accept")
+        self.end_headers()
+        if file.body is not None:
+            self.wfile.write(file.body)
+        else:
+            #Too big to keep in memory: let the kernel copy it from the file to the socket
+            with open(file.path, "rb") as f:
+                self.wfile.count += self.connection.sendfile(f)
+        return True
+
+    def is_not_modified_etag(self, etag):
+        if_none_match = self.headers.get("If-None-Match")
+        return if_none_match is not None and (if_none_match.strip() == "*" or
+                                              etag in [tag.strip() for tag in if_none_match.split(",")])
+
+    def send_precompressed(self):
+        #Sends a static file as its .br/.gz copy if there is one (no older than the file) and
+        #the browser accepts that encoding. Returns False to let SimpleHTTPRequestHandler
+        #send the file as usual
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return False
+        try:
+            st = os.stat(path)
+            sidecars = {}
+            for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+                if os.path.isfile(path + suffix) and os.stat(path + suffix).st_mtime >= st.st_mtime:
+                    sidecars[encoding] = path + suffix
+            encoding = choose_encoding(self.headers.get("Accept-Encoding"), list(sidecars))
+            if encoding == "identity":
+                return False
+            with open(sidecars[encoding], "rb") as f:
+                body = f.read()
+        except OSError:
+            return False
+        self.send_response(200)
+        self.send_header("Content-type", self.guess_type(path))
+        self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def write_chunk(self, data, chunked):
+        if chunked:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def is_not_modified(self, response, etag=None):
+        etag = response.etag if etag is None else etag
+        if self.headers.get("If-None-Match") is not None:
+            return self.is_not_modified_etag(etag)
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since and response.cached:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return response.last_modified <= since
+        return False
+
+    def list_directory(self, path):
+        #No directory listings
+        self.send_error(404, "File not found")
+        return None
             
 
-def host_site():
+class CountingWriter:
+    #Wraps the response stream to count the bytes sent, for the access log
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.raw.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class PooledTCPServer(socketserver.TCPServer):
+    #TCPServer that hands each accepted connection to a fixed pool of worker threads.
+    #The accept loop blocks once `workers + backlog` connections are in flight, so further
+    #clients queue up in the kernel listen backlog instead of in an unbounded Python queue.
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers=8, backlog=64):
+        self.request_queue_size = backlog
+        self.workers = max(1, int(workers))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pyhtml-worker")
+        self.slots = threading.BoundedSemaphore(self.workers + backlog)
+        self.in_flight = 0  #Connections accepted and not finished yet, running or queued
+        self.in_flight_lock = threading.Lock()
+        super().__init__(server_address, handler_class)
+
+    def has_waiting(self):
+        #True if some accepted connection is queued because every worker is busy
+        return self.in_flight > self.workers
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        with self.in_flight_lock:
+            self.in_flight += 1
+        try:
+            self.executor.submit(self.process_request_worker, request, client_address)
+        except RuntimeError:
+            #Executor already shut down, drop the connection
+            self.finished_request()
+            self.shutdown_request(request)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.finished_request()
+
+    def finished_request(self):
+        with self.in_flight_lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def server_close(self):
+        #Stop accepting, then let in-flight requests finish before returning
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def host_site(port=80, workers=None, backlog=None):
     # Set the port
-    PORT = 80
+    PORT = port
+    workers = server_workers if workers is None else workers
+    backlog = server_backlog if backlog is None else backlog
+    MyRequestHandler.protocol_version = "HTTP/1.1" if keep_alive else "HTTP/1.0"
+    #Nothing is recorded if there is no route to read it from
+    metrics.enabled = bool(metrics_path)
+
+    configure_logging()
 
     # Create the HTTP server
-    with socketserver.TCPServer(("", PORT), MyRequestHandler) as httpd:
+    with PooledTCPServer(("", PORT), MyRequestHandler, workers=workers, backlog=backlog) as httpd:
+        #SIGTERM (eg. from a process manager) stops the server the same way Ctrl+C does.
+        #shutdown() has to run on another thread because serve_forever() is running on this one.
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGTERM"):
+            signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=httpd.shutdown).start())
+
         print("Using your favourite browser, go to:\n")
         if (PORT==80):
             print("http://localhost")
         print(f"or\nhttp://localhost:{PORT}\n")
-        httpd.serve_forever()
+        print(f"Serving with {httpd.workers} worker threads (backlog {backlog})"
+              + (f", keep-alive {keep_alive_timeout}s" if keep_alive else ""))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\nShutting down, waiting for open requests to finish...")
         
         
 def get_results_from_query(database,query):
-    debugging_helper("\n------------------------")
-    debugging_helper("Opening database \""+database+"\"... ")
-    connection = sqlite3.connect(database)
-    cursor=connection.cursor()
-    debugging_helper("done\n")
-    debugging_helper("Executing query \""+query+"\"... ")
-    cursor.execute(query)
-    debugging_helper("done\n")
-    debugging_helper("Fetching results...\n")
-    results = cursor.fetchall();
-    debugging_helper(results)
-    debugging_helper("\n------------------------")
+    #Timing and row counts are recorded by the query log (dbpool.InstrumentedCursor)
+    with dbpool.connect(database) as connection:
+        cursor=connection.cursor()
+        cursor.execute(query)
+        results = cursor.fetchall();
     return results
 
+def configure_logging():
+    #need_debugging_help=True: INFO level, so one access line per request plus a sample of
+    #queries (dbpool.QUERY_LOG_SAMPLE_RATE) and every slow query. Otherwise warnings only.
+    #Log calls below the active level return straight away without formatting anything
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    logger.setLevel(log_level if need_debugging_help else "WARNING")
+
 def debugging_helper(message):
+    #Kept for older code; prefer logger.debug("...%s", value) so nothing is formatted unless needed
     if (need_debugging_help):
-        print(message,)
+        logger.debug("%s", message)
@@ -0,0 +1,64 @@
+#Top-k ranking shared by the similarity pages (3a stations, 3b metrics).
+#
+#Candidates are (value, item) pairs where value is a raw float (eg. a percentage change) and
+#item is whatever the page needs to show that row later. Only the k candidates closest to the
+#reference value are kept, in a bounded heap, so nothing is sorted or formatted apart from the
+#k rows that end up on the page. Ties keep the order the candidates came in, the same as a
+#stable sort of the whole list would.
+#
+#The distance is pluggable: any function(value, reference) -> float, smaller is closer.
+
+import heapq
+
+
+def pct_change(first, second):
+    #Percentage change from first to second, None if there isn't one (missing or zero first)
+    if first is None or second is None or first == 0:
+        return None
+    return ((second - first) / first) * 100.0
+
+
+def abs_diff(value, reference):
+    return abs(value - reference)
+
+
+def rounded_abs_diff(value, reference, places=2):
+    #Difference as shown on the page (to `places` decimals), so rows showing the same
+    #difference tie and stay in their original order
+    return abs(round(value - reference, places))
+
+
+class TopK:
+    #The k items with the smallest distance seen so far. The heap holds (-distance, -seq, value,
+    #item) so its top is the current worst: largest distance, and latest added among equals
+    def __init__(self, k):
+        self.k = max(0, int(k))
+        self.heap = []
+        self.seq = 0
+
+    def push(self, distance, value, item):
+        #Returns False if the candidate didn't make it in
+        self.seq += 1
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (-distance, -self.seq, value, item))
+            return True
+        if self.k and distance < -self.heap[0][0]:
+            heapq.heapreplace(self.heap, (-distance, -self.seq, value, item))
+            return True
+        return False
+
+    def results(self):
+        #[(distance, value, item)] closest first
+        return [(-d, value, item) for d, _, value, item in sorted(self.heap, reverse=True)]
+
+
+def top_k(candidates, k, reference, distance=rounded_abs_diff):
+    #[(distance, value, item)] of the k candidates whose value is closest to reference.
+    #Candidates with a None value are skipped
+    best = TopK(k)
+    if best.k == 0:
+        return []
+    for value, item in candidates:
+        if value is not None:
+            best.push(distance(value, reference), value, item)
+    return best.results()
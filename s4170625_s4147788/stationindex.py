@@ -0,0 +1,118 @@
+#In-memory spatial index of weather_station, for the latitude band queries on page 2a and
+#"nearest N stations" lookups on page 3a.
+#
+#Stations are grouped by normalised state code (UPPER(TRIM(state)), worked out once here
+#instead of for every row of every query) and kept sorted by latitude, so a band
+#lat_start..lat_end is two binary searches. Nearest stations are found by walking outwards
+#in latitude from the point and stopping once the latitude gap alone is further away than
+#the N-th closest station found so far.
+#
+#The index is built from weather_station on first use and rebuilt when climate.db changes.
+#Nearest-station lookups need a longitude column; without one they return None.
+
+import bisect
+import heapq
+import math
+
+import dbpool
+import metacache
+
+EARTH_RADIUS_KM = 6371.0
+
+
+class StationIndex:
+    def __init__(self, rows, has_longitude):
+        #rows: (station_id, name, region, latitude, longitude, normalised state)
+        self.has_longitude = has_longitude
+        self.states = {}  #state -> ([latitudes], [rows]) sorted by latitude
+        located = []
+        for row in sorted((r for r in rows if r[3] is not None), key=lambda r: r[3]):
+            lats, state_rows = self.states.setdefault(row[5], ([], []))
+            lats.append(row[3])
+            state_rows.append(row)
+            if row[4] is not None:
+                located.append(row)
+        self.latitudes = [row[3] for row in located]
+        self.located = located
+        self.by_id = {str(row[0]): row for row in rows}
+
+    def band(self, state, lat_start, lat_end):
+        #Stations of the state with lat_start <= latitude <= lat_end, in latitude order
+        lats, rows = self.states.get(state, ([], []))
+        return rows[bisect.bisect_left(lats, lat_start):bisect.bisect_right(lats, lat_end)]
+
+    def nearest(self, latitude, longitude, n, exclude=None):
+        #[(distance in km, row)] of the n closest stations to the point, closest first
+        if n <= 0:
+            return []
+        lat0, lon0 = math.radians(latitude), math.radians(longitude)
+        best = []  #max-heap of (-distance, i)
+        below = bisect.bisect_left(self.latitudes, latitude) - 1
+        above = below + 1
+        while below >= 0 or above < len(self.latitudes):
+            if above >= len(self.latitudes) or (below >= 0 and latitude - self.latitudes[below] <= self.latitudes[above] - latitude):
+                i, below = below, below - 1
+            else:
+                i, above = above, above + 1
+            row = self.located[i]
+            lat_gap = abs(math.radians(row[3]) - lat0) * EARTH_RADIUS_KM
+            if len(best) == n and lat_gap > -best[0][0]:
+                break
+            if exclude is not None and str(row[0]) == str(exclude):
+                continue
+            distance = get_distance(lat0, lon0, math.radians(row[3]), math.radians(row[4]))
+            if len(best) < n:
+                heapq.heappush(best, (-distance, i))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, i))
+        return [(-d, self.located[i]) for d, i in sorted(best, reverse=True)]
+
+
+def get_distance(lat1, lon1, lat2, lon2):
+    #Great-circle distance in km between two points given in radians (haversine)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def load_index(database):
+    with dbpool.connect(database) as conn:
+        cur = conn.cursor()
+        cur.execute("PRAGMA table_info(weather_station);")
+        has_longitude = any(col[1] == "longitude" for col in cur.fetchall())
+        longitude = "longitude" if has_longitude else "NULL"
+        cur.execute(f"""
+            SELECT station_id, name, region, latitude, {longitude}, UPPER(TRIM(state))
+            FROM weather_station;
+        """)
+        return StationIndex(cur.fetchall(), has_longitude)
+
+
+def get_index(database):
+    #Shared index, rebuilt when the database file changes
+    return metacache.lookup(("stationindex.get_index", database), database, lambda: load_index(database))
+
+
+def get_stations_in_band(database, state, lat_start, lat_end):
+    #[(station_id, name, region, latitude, longitude, state)] for the band, or None if the
+    #latitudes aren't numbers (left to SQL, which compares them as text)
+    try:
+        lat_start, lat_end = float(lat_start), float(lat_end)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(lat_start) or math.isnan(lat_end):
+        return None
+    return get_index(database).band(state, lat_start, lat_end)
+
+
+def has_coordinates(database):
+    return get_index(database).has_longitude
+
+
+def get_nearest_stations(database, station_id, n):
+    #Station ids (as str) of the n stations closest to the given one, not counting itself.
+    #None if that can't be worked out (no longitude column, or the station has no position)
+    index = get_index(database)
+    row = index.by_id.get(str(station_id))
+    if not index.has_longitude or row is None or row[3] is None or row[4] is None:
+        return None
+    return [str(r[0]) for distance, r in index.nearest(row[3], row[4], n, exclude=station_id)]
@@ -1,26 +1,35 @@
 import os
 import csv
+import metacache
+import templates
 
-def get_page_html(form_data):
-    # Get the path for FRICKEN DESCRIPTION.CSV ;-;
-    desc_csv_path = os.path.join(os.path.dirname(__file__), "description.csv")
-    
+# Get the path for FRICKEN DESCRIPTION.CSV ;-;
+DESC_CSV_PATH = os.path.join(os.path.dirname(__file__), "description.csv")
+# Page only changes when description.csv does, so the server renders it once and keeps it
+# (rebuilt when description.csv or this file changes, see prerender.py)
+STATIC_PAGE = True
+CACHE_FILE = DESC_CSV_PATH
+
+# Only re-read when description.csv changes
+@metacache.cached(DESC_CSV_PATH)
+def get_attributes():
     attributes_list = []
     
-    with open(desc_csv_path, mode='r', encoding='utf-8') as csvfile:
+    with open(DESC_CSV_PATH, mode='r', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
             
             attributes_list.append(f"{row['Field']}: {row['Description']}")
+    return attributes_list
 
-    # FACTS :3
-    fact1 = "Available year range: 1910 to 2023"
-    fact2 = "Lowest recorded temperature: -15.6°C at Charlotte Pass"
-    fact3 = "Highest recorded rainfall: 894mm at Tully Sugar Mill"
-    fact4 = "Region with most weather stations: Western District (21 stations)"
-    
-    # HTML mumbojumbo :P 
-    page_html = f"""
+# FACTS :3
+FACT1 = "Available year range: 1910 to 2023"
+FACT2 = "Lowest recorded temperature: -15.6°C at Charlotte Pass"
+FACT3 = "Highest recorded rainfall: 894mm at Tully Sugar Mill"
+FACT4 = "Region with most weather stations: Western District (21 stations)"
+
+# HTML mumbojumbo :P (split into static bytes and slots once, see templates.py)
+PAGE = templates.Template("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -49,21 +58,7 @@ def get_page_html(form_data):
         </style>
     </head>
     <body>
-    <header style="display:flex; align-items:center; gap:20px; padding:10px;">
-    <a href="/">
-        <img src="https://cdn-icons-png.flaticon.com/512/1163/1163661.png"
-             alt="Weather Logo"
-             style="height:40px; width:auto; vertical-align:middle;">
-    </a>
-    <nav style="display:flex; gap:12px;">
-        <a href="/">Home</a>
-        <a href="/page1b">Mission</a>
-        <a href="/page2a">Climate By Location</a>
-        <a href="/page2b">Climate By Metric</a>
-        <a href="/page3a">Similar Weather Station Sites</a>
-        <a href="/page3b">Similar Weather Station Metrics</a>
-    </nav>
-</header>
+    {nav_bar}
     <div class="container">
         <div class="topics-section">
             <h3>Topics covered by this website:</h3>
@@ -89,11 +84,14 @@ def get_page_html(form_data):
         <div class="attributes-section">
             <h2>Natural Language (Attributes and descriptions)</h2>
             <ul>
-                {''.join(f'<li>{attr}</li>' for attr in attributes_list)}
+                {attributes}
             </ul>
         </div>
     </div>
     </body>
     </html>
-    """
-    return page_html
+    """, nav_bar=templates.NAV_BAR, fact1=FACT1, fact2=FACT2, fact3=FACT3, fact4=FACT4)
+
+def get_page_html(form_data):
+    attributes_list = get_attributes()
+    return PAGE.render(attributes="".join(f"<li>{attr}</li>" for attr in attributes_list))
@@ -1,8 +1,13 @@
-import sqlite3
 import os
 import html
+import aggregates
+import dbpool
+import metacache
+import stationindex
+import templates
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "database", "climate.db")
+CACHE_TTL = 300  #seconds, see pyhtml
 
 #Sorting ;-;
 STATION_COLS = {
@@ -17,14 +22,16 @@ SUMMARY_COLS = {
     "avg_max_temp": "avg_max_temp"
 }
 
+@metacache.cached(lambda: DB_PATH)
 def get_states():
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         cur.execute("SELECT DISTINCT UPPER(TRIM(state)) FROM weather_station ORDER BY UPPER(TRIM(state));")
         return [row[0] for row in cur.fetchall()]
 
+@metacache.cached(lambda: DB_PATH)
 def get_metrics():
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         cur.execute("PRAGMA table_info(climate_data);")
         cols = cur.fetchall()
@@ -40,7 +47,15 @@ def get_metrics():
 def get_station_data(state, lat_start, lat_end, sort_by, sort_order):
     col = STATION_COLS.get(sort_by, "station_id")
     order = "DESC" if sort_order == "desc" else "ASC"
-    with sqlite3.connect(DB_PATH) as conn:
+    # Stations in the latitude band come from the in-memory station index (binary search)
+    rows = stationindex.get_stations_in_band(DB_PATH, state, lat_start, lat_end)
+    if rows is not None:
+        rows = sort_rows(sorted(rows, key=lambda r: r[0]), ["station_id", "name", "region", "latitude"].index(col), order)
+        return [
+            {"site": row[0], "name": row[1], "region": row[2], "latitude": row[3]}
+            for row in rows
+        ]
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         cur.execute(f"""
             SELECT station_id, name, region, latitude
@@ -62,25 +77,72 @@ def get_summary_data(state, lat_start, lat_end, metric, sort_by, sort_order):
     }
     col = col_map.get(sort_by, "region")
     order = "DESC" if sort_order == "desc" else "ASC"
-    with sqlite3.connect(DB_PATH) as conn:
+    col_index = {"region": 0, "num_stations": 1, "avg_max_temp": 2}
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
-        cur.execute(f"""
-            SELECT ws.region, COUNT(DISTINCT ws.station_id) AS num_stations, AVG(cd.[{metric}]) AS avg_max_temp
-            FROM weather_station ws
-            LEFT JOIN climate_data cd ON ws.station_id = cd.station_id
-            WHERE UPPER(TRIM(ws.state))=? AND ws.latitude BETWEEN ? AND ?
-            GROUP BY ws.region
-            ORDER BY {col} {order};
-        """, (state, lat_start, lat_end))
+        store = aggregates.get_column_store(conn, [metric])
+        if store is not None:
+            # Stations from the station index, per-station totals over all dates from the column store
+            stations = stationindex.get_stations_in_band(DB_PATH, state, lat_start, lat_end)
+            if stations is not None:
+                stations = [(row[0], row[2]) for row in stations]
+            else:
+                cur.execute("""
+                    SELECT station_id, region
+                    FROM weather_station
+                    WHERE UPPER(TRIM(state))=? AND latitude BETWEEN ? AND ?;
+                """, (state, lat_start, lat_end))
+                stations = cur.fetchall()
+            rows = get_region_averages(sort_rows(stations, 1, "ASC"), store.range_stats([metric], None, None), metric)
+            rows = sort_rows(rows, col_index[col], order)
+        elif aggregates.has_rollup(conn, metric):
+            # Average over all dates = sum of the monthly totals / sum of the monthly counts
+            cur.execute(f"""
+                SELECT ws.region, COUNT(DISTINCT ws.station_id) AS num_stations,
+                       CASE WHEN SUM(cm.value_count) > 0 THEN SUM(cm.total) * 1.0 / SUM(cm.value_count) END AS avg_max_temp
+                FROM weather_station ws
+                LEFT JOIN climate_monthly cm ON cm.metric = ? AND ws.station_id = cm.station_id
+                WHERE UPPER(TRIM(ws.state))=? AND ws.latitude BETWEEN ? AND ?
+                GROUP BY ws.region
+                ORDER BY {col} {order};
+            """, (metric, state, lat_start, lat_end))
+        else:
+            cur.execute(f"""
+                SELECT ws.region, COUNT(DISTINCT ws.station_id) AS num_stations, AVG(cd.[{metric}]) AS avg_max_temp
+                FROM weather_station ws
+                LEFT JOIN climate_data cd ON ws.station_id = cd.station_id
+                WHERE UPPER(TRIM(ws.state))=? AND ws.latitude BETWEEN ? AND ?
+                GROUP BY ws.region
+                ORDER BY {col} {order};
+            """, (state, lat_start, lat_end))
+        if store is None:
+            rows = cur.fetchall()
         return [
             {
                 "region": row[0],
                 "num_stations": row[1],
                 "avg_max_temp": f"{row[2]:.1f}" if row[2] is not None else "N/A"
             }
-            for row in cur.fetchall()
+            for row in rows
         ]
 
+def sort_rows(rows, index, order):
+    # Like ORDER BY on column `index`: NULLs first when ascending, last when descending
+    return sorted(rows, key=lambda row: (row[index] is not None, row[index]), reverse=(order == "DESC"))
+
+def get_region_averages(stations, stats, metric):
+    # (region, number of stations, average) rows like the SQL above, from
+    # {(station_id, metric): (total, value count, row count)}
+    regions = {}
+    for station_id, region in stations:
+        total, value_count, row_count = stats.get((str(station_id), metric), (None, 0, 0))
+        r = regions.setdefault(region, [0, 0.0, 0])
+        r[0] += 1
+        if value_count:
+            r[1] += total
+            r[2] += value_count
+    return [(region, n, total / count if count else None) for region, (n, total, count) in regions.items()]
+
 def get_first(val):
     if isinstance(val, list):
         return val[0] if val else ""
@@ -110,7 +172,7 @@ def get_page_html(form_data):
                 stations_data = get_station_data(state, float(lat_start), float(lat_end), station_sort_by, station_sort_order)
                 summary_data = get_summary_data(state, float(lat_start), float(lat_end), metric, summary_sort_by, summary_sort_order)
             except Exception as e:
-                return f"<pre>Error: {e}</pre>"
+                return templates.Uncached(f"<pre>Error: {e}</pre>")
 
         return get_level2_page_html(
             form_data={
@@ -124,7 +186,7 @@ def get_page_html(form_data):
             summary_data=summary_data
         )
     except Exception as e:
-        return f"<pre>Fatal error: {e}</pre>"
+        return templates.Uncached(f"<pre>Fatal error: {e}</pre>")
 
 def get_sort_link(form_data, table, col):
     sort_by = f"{table}_sort_by"
@@ -141,82 +203,8 @@ def get_sort_link(form_data, table, col):
 
     return f"?{'&'.join(params)}"
 
-def get_level2_page_html(form_data, states, metrics, stations_data, summary_data):
-    # Sort indicators
-    station_sort_by = form_data.get("station_sort_by", "site")
-    station_sort_order = form_data.get("station_sort_order", "asc")
-    summary_sort_by = form_data.get("summary_sort_by", "region")
-    summary_sort_order = form_data.get("summary_sort_order", "asc")
-
-    # Arrow indicator
-    def arrow(selected, order):
-        return " ▲" if order == "asc" and selected else (" ▼" if order == "desc" and selected else "")
-
-    state_options = "".join(
-        f'<option value="{s}" {"selected" if form_data.get("state") == str(s) else ""}>{s}</option>'
-        for s in states
-    )
-    metric_options = "".join(
-        f'<option value="{m["id"]}" {"selected" if form_data.get("metric") == m["id"] else ""}>{m["name"]}</option>'
-        for m in metrics
-    )
-    if stations_data:
-        table1_rows = "\n".join(
-            f"<tr><td>{s['site']}</td><td>{html.escape(s['name'])}</td><td>{html.escape(s['region'])}</td><td>{s['latitude']}</td></tr>"
-            for s in stations_data
-        )
-    else:
-        table1_rows = '<tr><td colspan="4" style="text-align:center">No stations in this range.</td></tr>'
-
-    if summary_data:
-        table2_rows = "\n".join(
-            f"<tr><td>{html.escape(s['region'])}</td><td>{s['num_stations']}</td><td>{s['avg_max_temp']}</td></tr>"
-            for s in summary_data
-        )
-    else:
-        table2_rows = '<tr><td colspan="3" style="text-align:center">No summary data.</td></tr>'
-
-    nav_bar = """
-    <header style="display:flex; align-items:center; gap:20px; padding:10px;">
-    <a href="/">
-        <img src="https://cdn-icons-png.flaticon.com/512/1163/1163661.png"
-             alt="Weather Logo"
-             style="height:40px; width:auto; vertical-align:middle;">
-    </a>
-    <nav style="display:flex; gap:12px;">
-        <a href="/">Home</a>
-        <a href="/page1b">Mission</a>
-        <a href="/page2a">Climate By Location</a>
-        <a href="/page2b">Climate By Metric</a>
-        <a href="/page3a">Similar Weather Station Sites</a>
-        <a href="/page3b">Similar Weather Station Metrics</a>
-    </nav>
-    </header>
-    """
-    # Build table headers with links
-    t1 = f"""
-    <table>
-        <tr>
-            <th><a href="{get_sort_link(form_data, 'station', 'site')}">Station no.{arrow(station_sort_by=='site', station_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 'station', 'name')}">Station Name{arrow(station_sort_by=='name', station_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 'station', 'region')}">Region{arrow(station_sort_by=='region', station_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 'station', 'latitude')}">Latitude{arrow(station_sort_by=='latitude', station_sort_order)}</a></th>
-        </tr>
-        {table1_rows}
-    </table>
-    """
-    t2 = f"""
-    <table>
-        <tr>
-            <th><a href="{get_sort_link(form_data, 'summary', 'region')}">Region{arrow(summary_sort_by=='region', summary_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 'summary', 'num_stations')}">Number Weather Stations{arrow(summary_sort_by=='num_stations', summary_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 'summary', 'avg_max_temp')}">Average {next((m['name'] for m in metrics if m['id'] == form_data.get('metric')), 'Metric')}{arrow(summary_sort_by=='avg_max_temp', summary_sort_order)}</a></th>
-        </tr>
-        {table2_rows}
-    </table>
-
-    """
-    return f"""
+# Page layout, split into static bytes and slots once (see templates.py)
+PAGE = templates.Template("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -357,11 +345,11 @@ def get_level2_page_html(form_data, states, metrics, stations_data, summary_data
                     </div>
                     <div>
                         <label for="lat_start">Start Latitude:</label>
-                        <input type="number" step="0.01" name="lat_start" id="lat_start" value="{form_data.get('lat_start', '')}" required>
+                        <input type="number" step="0.01" name="lat_start" id="lat_start" value="{lat_start}" required>
                     </div>
                     <div>
                         <label for="lat_end">End Latitude:</label>
-                        <input type="number" step="0.01" name="lat_end" id="lat_end" value="{form_data.get('lat_end', '')}" required>
+                        <input type="number" step="0.01" name="lat_end" id="lat_end" value="{lat_end}" required>
                     </div>
                     <div>
                         <label for="metric">Climate Metric:</label>
@@ -371,10 +359,10 @@ def get_level2_page_html(form_data, states, metrics, stations_data, summary_data
                         </select>
                     </div>
                     <!-- Hidden sort fields to preserve on submit -->
-                    <input type="hidden" name="station_sort_by" value="{form_data.get('station_sort_by', 'site')}">
-                    <input type="hidden" name="station_sort_order" value="{form_data.get('station_sort_order', 'asc')}">
-                    <input type="hidden" name="summary_sort_by" value="{form_data.get('summary_sort_by', 'region')}">
-                    <input type="hidden" name="summary_sort_order" value="{form_data.get('summary_sort_order', 'asc')}">
+                    <input type="hidden" name="station_sort_by" value="{station_sort_by}">
+                    <input type="hidden" name="station_sort_order" value="{station_sort_order}">
+                    <input type="hidden" name="summary_sort_by" value="{summary_sort_by}">
+                    <input type="hidden" name="summary_sort_order" value="{summary_sort_order}">
                     <div class="form-button-row">
                         <input type="submit" value="View Data">
                     </div>
@@ -387,5 +375,70 @@ def get_level2_page_html(form_data, states, metrics, stations_data, summary_data
         </div>
     </body>
     </html>
+    """, nav_bar=templates.NAV_BAR)
+
+def get_level2_page_html(form_data, states, metrics, stations_data, summary_data):
+    # Sort indicators
+    station_sort_by = form_data.get("station_sort_by", "site")
+    station_sort_order = form_data.get("station_sort_order", "asc")
+    summary_sort_by = form_data.get("summary_sort_by", "region")
+    summary_sort_order = form_data.get("summary_sort_order", "asc")
+
+    # Arrow indicator
+    def arrow(selected, order):
+        return " ▲" if order == "asc" and selected else (" ▼" if order == "desc" and selected else "")
+
+    state_options = "".join(
+        f'<option value="{s}" {"selected" if form_data.get("state") == str(s) else ""}>{s}</option>'
+        for s in states
+    )
+    metric_options = "".join(
+        f'<option value="{m["id"]}" {"selected" if form_data.get("metric") == m["id"] else ""}>{m["name"]}</option>'
+        for m in metrics
+    )
+    if stations_data:
+        table1_rows = "\n".join(
+            f"<tr><td>{s['site']}</td><td>{html.escape(s['name'])}</td><td>{html.escape(s['region'])}</td><td>{s['latitude']}</td></tr>"
+            for s in stations_data
+        )
+    else:
+        table1_rows = '<tr><td colspan="4" style="text-align:center">No stations in this range.</td></tr>'
+
+    if summary_data:
+        table2_rows = "\n".join(
+            f"<tr><td>{html.escape(s['region'])}</td><td>{s['num_stations']}</td><td>{s['avg_max_temp']}</td></tr>"
+            for s in summary_data
+        )
+    else:
+        table2_rows = '<tr><td colspan="3" style="text-align:center">No summary data.</td></tr>'
+
+    # Build table headers with links
+    t1 = f"""
+    <table>
+        <tr>
+            <th><a href="{get_sort_link(form_data, 'station', 'site')}">Station no.{arrow(station_sort_by=='site', station_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 'station', 'name')}">Station Name{arrow(station_sort_by=='name', station_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 'station', 'region')}">Region{arrow(station_sort_by=='region', station_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 'station', 'latitude')}">Latitude{arrow(station_sort_by=='latitude', station_sort_order)}</a></th>
+        </tr>
+        {table1_rows}
+    </table>
     """
+    t2 = f"""
+    <table>
+        <tr>
+            <th><a href="{get_sort_link(form_data, 'summary', 'region')}">Region{arrow(summary_sort_by=='region', summary_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 'summary', 'num_stations')}">Number Weather Stations{arrow(summary_sort_by=='num_stations', summary_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 'summary', 'avg_max_temp')}">Average {next((m['name'] for m in metrics if m['id'] == form_data.get('metric')), 'Metric')}{arrow(summary_sort_by=='avg_max_temp', summary_sort_order)}</a></th>
+        </tr>
+        {table2_rows}
+    </table>
+
+    """
+    return PAGE.render(
+        state_options=state_options, metric_options=metric_options, t1=t1, t2=t2,
+        lat_start=form_data.get("lat_start", ""), lat_end=form_data.get("lat_end", ""),
+        station_sort_by=station_sort_by, station_sort_order=station_sort_order,
+        summary_sort_by=summary_sort_by, summary_sort_order=summary_sort_order
+    )
 #html has ruined my life :(
\ No newline at end of file
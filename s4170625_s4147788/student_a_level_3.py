@@ -1,11 +1,29 @@
-import sqlite3
 import os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import aggregates
+import dbpool
+import metacache
+import ranking
+import stationindex
+import templates
 
 # Point to the database location
 DB_PATH = os.path.join(os.path.dirname(__file__), "database", "climate.db")
+CACHE_TTL = 300  #seconds, see pyhtml
+#Set above 1 to split the similar stations search over this many processes when there are at
+#least PARALLEL_MIN_STATIONS stations to compare (not used when the column store is loaded,
+#that is faster on its own)
+PARALLEL_WORKERS = 0
+PARALLEL_MIN_STATIONS = 200
+#How far a station's % change is from the reference's, for ranking (see ranking.py)
+RANK_DISTANCE = ranking.rounded_abs_diff
 
+@metacache.cached(lambda: DB_PATH)
 def get_metrics():
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         # Get all columns in climate_data 
         cur.execute("PRAGMA table_info(climate_data);")
@@ -19,16 +37,18 @@ def get_metrics():
                 metrics.append({"id": col_name, "name": display})
         return metrics
 
+@metacache.cached(lambda: DB_PATH)
 def get_all_stations():
     # Gets all wewther station IDs and names alphabetical ordering 
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         cur.execute("SELECT station_id, name FROM weather_station ORDER BY name;")
         return [{"station_id": str(row[0]), "name": row[1]} for row in cur.fetchall()]
 
+@metacache.cached(lambda: DB_PATH)
 def get_station_name(station_id):
     # Gets the name of a station using its ID
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         cur.execute("SELECT name FROM weather_station WHERE station_id = ?", (station_id,))
         row = cur.fetchone()
@@ -36,7 +56,10 @@ def get_station_name(station_id):
 
 def get_station_period_avg(station_id, metric, start_date, end_date):
     # Gets the average value of the metric for the station between the two dates
-    with sqlite3.connect(DB_PATH) as conn:
+    # (from the column store or monthly rollup when one is available, see aggregates.py)
+    with dbpool.connect(DB_PATH) as conn:
+        if aggregates.has_range_stats(conn, metric):
+            return aggregates.get_station_range_avg(conn, station_id, metric, start_date, end_date)
         cur = conn.cursor()
         cur.execute(f"""
             SELECT AVG({metric})
@@ -46,22 +69,69 @@ def get_station_period_avg(station_id, metric, start_date, end_date):
         result = cur.fetchone()
         return result[0] if result and result[0] is not None else None
 
+def get_all_station_period_avgs(metric, period1_start, period1_end, period2_start, period2_end, station_ids=None, database=None):
+    # Gets both period averages for every station (or just `station_ids`) in one grouped pass
+    # over climate_data (conditional aggregation), instead of two queries per station.
+    # With the monthly rollup built, this reads station x month rows instead of daily rows,
+    # and with the column store loaded it doesn't touch SQLite at all
+    with dbpool.connect(database or DB_PATH) as conn:
+        if aggregates.has_range_stats(conn, metric):
+            avgs1 = aggregates.get_all_stations_range_avgs(conn, metric, period1_start, period1_end, station_ids)
+            avgs2 = aggregates.get_all_stations_range_avgs(conn, metric, period2_start, period2_end, station_ids)
+            return {sid: (avgs1.get(sid), avgs2.get(sid)) for sid in avgs1.keys() | avgs2.keys()}
+        cur = conn.cursor()
+        period_avgs = {}
+        # A long station list is sent in chunks, each its own grouped query
+        for station_filter, params in aggregates.get_station_filters(station_ids=station_ids):
+            cur.execute(f"""
+                SELECT station_id,
+                       AVG(CASE WHEN date BETWEEN ? AND ? THEN {metric} END),
+                       AVG(CASE WHEN date BETWEEN ? AND ? THEN {metric} END)
+                FROM climate_data
+                WHERE {station_filter}(date BETWEEN ? AND ? OR date BETWEEN ? AND ?)
+                GROUP BY station_id;
+            """, [period1_start, period1_end, period2_start, period2_end] + params
+                 + [period1_start, period1_end, period2_start, period2_end])
+            period_avgs.update((str(row[0]), (row[1], row[2])) for row in cur.fetchall())
+        return period_avgs
+
 def get_first(val):
     # If the value is a list, return its first item; otherwise, return the value as-is
     if isinstance(val, list):
         return val[0] if val else ""
     return val
 
-def get_similar_stations(period1_start, period1_end, period2_start, period2_end, metric, reference_station_id, num_similar):
+def get_similar_stations(period1_start, period1_end, period2_start, period2_end, metric, reference_station_id, num_similar, nearby=None):
     # Finds the weather stations with the most similar percentage change as the reference
+    # (only among the `nearby` closest stations to it, if given)
     stations = get_all_stations()
     reference_station_id = str(reference_station_id)
-    ref_avg1 = get_station_period_avg(reference_station_id, metric, period1_start, period1_end)
-    ref_avg2 = get_station_period_avg(reference_station_id, metric, period2_start, period2_end)
-    if ref_avg1 is None or ref_avg2 is None or ref_avg1 == 0:
+    # Only these stations' averages are worked out (None = all of them)
+    station_ids = None
+    if nearby:
+        nearest = stationindex.get_nearest_stations(DB_PATH, reference_station_id, int(nearby))
+        if nearest is not None:
+            station_ids = nearest + [reference_station_id]
+            nearest = set(nearest)
+            stations = [s for s in stations if s["station_id"] in nearest]
+    periods = (period1_start, period1_end, period2_start, period2_end)
+    pool = get_worker_pool(len(stations))
+    if pool is None:
+        period_avgs = get_all_station_period_avgs(metric, *periods, station_ids=station_ids)
+    else:
+        period_avgs = get_all_station_period_avgs(metric, *periods, station_ids=[reference_station_id])
+    ref_avg1, ref_avg2 = period_avgs.get(reference_station_id, (None, None))
+    ref_pct_change = ranking.pct_change(ref_avg1, ref_avg2)
+    if ref_pct_change is None:
         return []
 
-    ref_pct_change = ((ref_avg2 - ref_avg1) / ref_avg1) * 100.0
+    closest = None
+    if pool is not None:
+        closest = get_closest_parallel(pool, stations, metric, periods, reference_station_id, ref_pct_change, int(num_similar))
+    if closest is None:
+        if pool is not None:
+            period_avgs = get_all_station_period_avgs(metric, *periods, station_ids=station_ids)
+        closest = get_closest_stations(stations, period_avgs, reference_station_id, ref_pct_change, int(num_similar))
     results = []
 
     # Add the reference station at the top
@@ -75,63 +145,88 @@ def get_similar_stations(period1_start, period1_end, period2_start, period2_end,
         "selected": True
     })
 
-    # Compare all other stations to the reference
-    others = []
-    for s in stations:
-        sid = s["station_id"]
-        if sid == reference_station_id:
-            continue
-        avg1 = get_station_period_avg(sid, metric, period1_start, period1_end)
-        avg2 = get_station_period_avg(sid, metric, period2_start, period2_end)
-        if avg1 is None or avg2 is None or avg1 == 0:
-            continue
-        pct_change = ((avg2 - avg1) / avg1) * 100.0
-        diff_from_ref = pct_change - ref_pct_change
-        others.append({
-            "name": s["name"],
+    # Only the stations that made the cut get formatted
+    for distance, pct_change, (name, avg1, avg2) in closest:
+        results.append({
+            "name": name,
             "avg1": f"{avg1:.2f}",
             "avg2": f"{avg2:.2f}",
             "pct_change": f"{pct_change:+.2f}",
-            "diff_from_ref": f"{diff_from_ref:+.2f}",
+            "diff_from_ref": f"{pct_change - ref_pct_change:+.2f}",
             "selected": False
         })
-
-    # Sort by how close each station is to the reference
-    others = sorted(others, key=lambda x: abs(float(x["diff_from_ref"])))
-    # Only include as many as the user asked for (no duplicates)
-    results += others[:int(num_similar)]
     return results
 
-def get_page_html(form_data):
-    # This sets up the form and the table
-    metrics = get_metrics()
-    stations = get_all_stations()
+def get_closest_stations(stations, period_avgs, reference_station_id, ref_pct_change, num_similar, distance=None):
+    # Compares all other stations to the reference and returns
+    # [(distance, pct_change, (name, avg1, avg2))] of the closest ones, closest first.
+    # With the default distance (difference rounded to 2dp) ties keep the stations in name
+    # order, the same as the old full sort on the formatted strings
+    def candidates():
+        for s in stations:
+            sid = s["station_id"]
+            if sid == reference_station_id:
+                continue
+            avg1, avg2 = period_avgs.get(sid, (None, None))
+            yield ranking.pct_change(avg1, avg2), (s["name"], avg1, avg2)
+    return ranking.top_k(candidates(), num_similar, ref_pct_change, distance or RANK_DISTANCE)
 
-    # Keep the form values after the user submits (so their choices stick)
-    period1_start = get_first(form_data.get("period1_start", ""))
-    period1_end = get_first(form_data.get("period1_end", ""))
-    period2_start = get_first(form_data.get("period2_start", ""))
-    period2_end = get_first(form_data.get("period2_end", ""))
-    metric = get_first(form_data.get("metric", ""))
-    reference_station = get_first(form_data.get("reference_station", ""))
-    num_similar = get_first(form_data.get("num_similar", "2"))
+# Parallel search: the stations (sorted by name) are cut into one contiguous shard per worker
+# process, each worker works out the period averages of its shard and returns its own closest
+# num_similar, and those are merged here. Ties keep their input order, so merging the shards in order
+# gives exactly the same stations (and tie order) as the single process search.
+# Workers are started with "spawn" (forking a threaded server isn't safe), so the script
+# hosting the site has to keep its startup code under `if __name__ == "__main__":`
+worker_pool = None
+worker_pool_lock = threading.Lock()
 
-    # Build the dropdowns for the form
-    metric_options = "".join(
-        f'<option value="{m["id"]}" {"selected" if metric == m["id"] else ""}>{m["name"]}</option>'
-        for m in metrics
-    )
-    station_options = "".join(
-        f'<option value="{s["station_id"]}" {"selected" if reference_station == s["station_id"] else ""}>{s["name"]}</option>'
-        for s in stations
-    )
+def get_worker_pool(station_count):
+    # The shared worker pool, or None if the search should run in this process
+    global worker_pool
+    if PARALLEL_WORKERS <= 1 or station_count < PARALLEL_MIN_STATIONS:
+        return None
+    with dbpool.connect(DB_PATH) as conn:
+        if aggregates.get_column_store(conn) is not None:
+            return None
+    with worker_pool_lock:
+        if worker_pool is None:
+            worker_pool = ProcessPoolExecutor(PARALLEL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return worker_pool
 
-    # Only show the table if the form is filled out
-    show_table = all([period1_start, period1_end, period2_start, period2_end, metric, reference_station, num_similar])
+def reset_worker_pool(broken):
+    global worker_pool
+    with worker_pool_lock:
+        if worker_pool is broken:
+            worker_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def get_shard_closest(database, metric, periods, shard, reference_station_id, ref_pct_change, num_similar, distance):
+    # Runs in a worker process
+    period_avgs = get_all_station_period_avgs(metric, *periods, station_ids=[s["station_id"] for s in shard], database=database)
+    return get_closest_stations(shard, period_avgs, reference_station_id, ref_pct_change, num_similar, distance)
+
+def get_closest_parallel(pool, stations, metric, periods, reference_station_id, ref_pct_change, num_similar):
+    # Closest stations worked out by the worker processes, or None if the pool has broken
+    # (a worker was killed), in which case the caller searches in this process
+    stations = [s for s in stations if s["station_id"] != reference_station_id]
+    shard_size = -(-len(stations) // PARALLEL_WORKERS)
+    shards = [stations[i:i + shard_size] for i in range(0, len(stations), shard_size)]
+    try:
+        futures = [pool.submit(get_shard_closest, DB_PATH, metric, periods, shard, reference_station_id, ref_pct_change,
+                               num_similar, RANK_DISTANCE)
+                   for shard in shards]
+        return ranking.top_k(((pct_change, item) for f in futures for _, pct_change, item in f.result()),
+                             num_similar, ref_pct_change, RANK_DISTANCE)
+    except BrokenProcessPool:
+        reset_worker_pool(pool)
+        return None
+
+def get_table_rows(show_table, period1_start, period1_end, period2_start, period2_end, metric, reference_station, num_similar, nearby=None):
+    # Runs the similarity search and builds the result table rows
     table_rows = ""
     if show_table:
         try:
-            results = get_similar_stations(period1_start, period1_end, period2_start, period2_end, metric, reference_station, num_similar)
+            results = get_similar_stations(period1_start, period1_end, period2_start, period2_end, metric, reference_station, num_similar, nearby)
             if not results:
                 table_rows = '<tr><td colspan="5" style="text-align:center">No data for these dates or stations.</td></tr>'
             else:
@@ -149,31 +244,14 @@ def get_page_html(form_data):
                     </tr>
                     """
         except Exception as e:
-            table_rows = f'<tr><td colspan="5" style="color:red">Error: {e}</td></tr>'
+            table_rows = templates.Uncached(f'<tr><td colspan="5" style="color:red">Error: {e}</td></tr>')
     else:
         table_rows = '<tr><td colspan="5" style="text-align:center">No data to display. Please fill the form and submit.</td></tr>'
+    return table_rows
 
-    # Navigation bar HTML
-    nav_bar = """
-    <header style="display:flex; align-items:center; gap:20px; padding:10px;">
-    <a href="/">
-        <img src="https://cdn-icons-png.flaticon.com/512/1163/1163661.png"
-             alt="Weather Logo"
-             style="height:40px; width:auto; vertical-align:middle;">
-    </a>
-    <nav style="display:flex; gap:12px;">
-        <a href="/">Home</a>
-        <a href="/page1b">Mission</a>
-        <a href="/page2a">Climate By Location</a>
-        <a href="/page2b">Climate By Metric</a>
-        <a href="/page3a">Similar Weather Station Sites</a>
-        <a href="/page3b">Similar Weather Station Metrics</a>
-    </nav>
-</header>
-    """
-
-    # Main HTML structure
-    html = f"""
+# Page layout, split into static bytes and slots once (see templates.py). The result
+# rows go between the two
+PAGE_TOP = templates.Template("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -297,7 +375,7 @@ def get_page_html(form_data):
                     <div>
                         <label>Number of similar stations:</label>
                         <input type="number" name="num_similar" min="1" max="10" value="{num_similar}" required>
-                    </div>
+                    </div>{nearby_field}
                     <input type="submit" value="View Data">
                 </form>
             </div>
@@ -309,11 +387,65 @@ def get_page_html(form_data):
                     <th>% Change</th>
                     <th>Difference from Reference</th>
                 </tr>
-                {table_rows}
+                """, nav_bar=templates.NAV_BAR)
+PAGE_BOTTOM = templates.Template("""
             </table>
         </div>
     </body>
     </html>
-    """
-    return html
+    """)
+
+def get_page_html(form_data):
+    # This sets up the form and the table
+    metrics = get_metrics()
+    stations = get_all_stations()
+
+    # Keep the form values after the user submits (so their choices stick)
+    period1_start = get_first(form_data.get("period1_start", ""))
+    period1_end = get_first(form_data.get("period1_end", ""))
+    period2_start = get_first(form_data.get("period2_start", ""))
+    period2_end = get_first(form_data.get("period2_end", ""))
+    metric = get_first(form_data.get("metric", ""))
+    reference_station = get_first(form_data.get("reference_station", ""))
+    num_similar = get_first(form_data.get("num_similar", "2"))
+    nearby = get_first(form_data.get("nearby", ""))
+
+    # Build the dropdowns for the form
+    metric_options = "".join(
+        f'<option value="{m["id"]}" {"selected" if metric == m["id"] else ""}>{m["name"]}</option>'
+        for m in metrics
+    )
+    station_options = "".join(
+        f'<option value="{s["station_id"]}" {"selected" if reference_station == s["station_id"] else ""}>{s["name"]}</option>'
+        for s in stations
+    )
+
+    # Limiting the search to nearby stations needs station longitudes
+    nearby_field = ""
+    if stationindex.has_coordinates(DB_PATH):
+        nearby_field = f"""
+                    <div>
+                        <label>Only compare the nearest:</label>
+                        <input type="number" name="nearby" min="1" value="{nearby}" placeholder="all">
+                        <span>stations</span>
+                    </div>"""
+
+    # Only show the table if the form is filled out
+    show_table = all([period1_start, period1_end, period2_start, period2_end, metric, reference_station, num_similar])
+
+    page_top = PAGE_TOP.render(
+        period1_start=period1_start, period1_end=period1_end, period2_start=period2_start, period2_end=period2_end,
+        metric_options=metric_options, station_options=station_options, num_similar=num_similar, nearby_field=nearby_field
+    )
+    page_bottom = PAGE_BOTTOM.render()
+    if not show_table:
+        return page_top + templates.encode(get_table_rows(show_table, period1_start, period1_end, period2_start, period2_end, metric, reference_station, num_similar, nearby)) + page_bottom
+    # Send the top of the page (form and table header) straight away, the similarity
+    # search below can take a while
+    return stream_page(page_top, page_bottom, show_table, period1_start, period1_end, period2_start, period2_end, metric, reference_station, num_similar, nearby)
+
+def stream_page(page_top, page_bottom, show_table, period1_start, period1_end, period2_start, period2_end, metric, reference_station, num_similar, nearby=None):
+    yield page_top
+    yield get_table_rows(show_table, period1_start, period1_end, period2_start, period2_end, metric, reference_station, num_similar, nearby)
+    yield page_bottom
 #I am so sick rn ;-; 
@@ -1,29 +1,37 @@
-def get_page_html(form_data):
-    page_html = """
+import assets
+import templates
+
+#Constant page, the server renders it once and keeps it (see prerender.py)
+STATIC_PAGE = True
+#Images the page links to; it is rendered again when one of them changes (new fingerprint)
+ASSETS = [f"persona{i}.jpg" for i in range(1, 5)]
+
+#Only the image URLs are filled in (fingerprinted, see assets.py)
+PAGE = templates.Template("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
         <meta charset="UTF-8">
         <title>Mission Statement</title>
         <style>
-            body {
+            body {{
                 font-family: Arial, sans-serif;
                 margin: 0;
                 padding: 0;
-            }
-            header {
+            }}
+            header {{
                 background: #fff;
                 padding: 10px 20px;
                 display: flex;
                 justify-content: space-between;
                 align-items: center;
                 border-bottom: 1px solid #ccc;
-            }
-            header .logo {
+            }}
+            header .logo {{
                 font-weight: bold;
                 font-size: 1.2em;
-            }
-            header nav a {
+            }}
+            header nav a {{
                 margin-left: 10px;
                 padding: 6px 14px;
                 border: 1px solid #000;
@@ -33,24 +41,24 @@ def get_page_html(form_data):
                 border-radius: 3px;
                 font-size: 1em;
                 transition: background 0.2s;
-            }
-            header nav a:hover {
+            }}
+            header nav a:hover {{
                 background: #003366;
                 color: #fff;
-            }
-            .container {
+            }}
+            .container {{
                 padding: 20px;
                 text-align: center;
-            }
-            .personas-grid {
+            }}
+            .personas-grid {{
                 display: grid;
                 grid-template-columns: 1fr 1fr;
                 grid-template-rows: 1fr 1fr;
                 gap: 24px;
                 max-width: 900px;
                 margin: 30px auto 0 auto;
-            }
-            .persona {
+            }}
+            .persona {{
                 background: #fafafa;
                 padding: 18px;
                 border-radius: 8px;
@@ -58,46 +66,32 @@ def get_page_html(form_data):
                 display: flex;
                 flex-direction: column;
                 align-items: center;
-            }
-            .persona img {
+            }}
+            .persona img {{
                 width: 120px;
                 height: 120px;
                 object-fit: cover;
                 border-radius: 50%;
                 margin-bottom: 12px;
                 background: #ccc;
-            }
-            .persona h3 {
+            }}
+            .persona h3 {{
                 margin: 8px 0 6px 0;
-            }
-            .persona p {
+            }}
+            .persona p {{
                 margin: 0;
                 color: #444;
                 font-size: 1em;
-            }
-            @media (max-width: 700px) {
-                .personas-grid {
+            }}
+            @media (max-width: 700px) {{
+                .personas-grid {{
                     grid-template-columns: 1fr;
                     grid-template-rows: repeat(4, 1fr);
-                }
+                }}
         </style>
     </head>
     <body>
-    <header style="display:flex; align-items:center; gap:20px; padding:10px;">
-    <a href="/">
-        <img src="https://cdn-icons-png.flaticon.com/512/1163/1163661.png"
-             alt="Weather Logo"
-             style="height:40px; width:auto; vertical-align:middle;">
-    </a>
-    <nav style="display:flex; gap:12px;">
-        <a href="/">Home</a>
-        <a href="/page1b">Mission</a>
-        <a href="/page2a">Climate By Location</a>
-        <a href="/page2b">Climate By Metric</a>
-        <a href="/page3a">Similar Weather Station Sites</a>
-        <a href="/page3b">Similar Weather Station Metrics</a>
-    </nav>
-</header>
+    {nav_bar}
 
     <div class="container">
         <h2><strong>Mission Statement</strong></h2>
@@ -111,27 +105,27 @@ def get_page_html(form_data):
 
         <div class="personas-grid">
             <div class="persona">
-                <img src="images/persona1.jpg">
+                <img src="{persona1}">
                 <h3>Marge Smith</h3>
                 <p>"I normally feel like most websites are too complicated to use, but with this one,
                 I can check the weather in my area so easily. Thank you so much!"</p>
             </div>
             <div class="persona">
-                <img src="images/persona2.jpg">
+                <img src="{persona2}">
                 <h3>Bob Mann</h3>
                 <p>"As an avid climate activist, I feel that this website really provides me with the
                 information that I need in order to include in my pamphlets. This is a really underrated
                 website, so if you're here, show your support to them!"</p>
             </div>
             <div class="persona">
-                <img src=images/persona3.jpg>
+                <img src="{persona3}">
                 <h3>Serene Chan</h3>
                 <p>"Although I had my doubts about this website at first, I was pleasantly surprised to find
                 that they data that is provided here is really quite on par with other top sites. I will be coming
                 back to use this website again. Highly recommend it."</p>
             </div>
             <div class="persona">
-                <img src="images/persona4.jpg">
+                <img src="{persona4}">
                 <h3>Robert Tan</h3>
                 <p>"I'm no weather expert, but I feel that this website has really help me to become one
                 in a way! I don't think any other weather website is quite as reliable as this one, and
@@ -141,5 +135,7 @@ def get_page_html(form_data):
     </div>
     </body>
     </html>
-    """
-    return page_html
+    """, nav_bar=templates.NAV_BAR)
+
+def get_page_html(form_data):
+    return PAGE.render(**{name.split(".")[0]: assets.url(name) for name in ASSETS})
@@ -1,22 +1,30 @@
-import sqlite3
 import os
 import html
+import aggregates
+import dbpool
+import metacache
+import templates
  
 DB_PATH = os.path.join(os.path.dirname(__file__), "database", "climate.db")
+CACHE_TTL = 300  #seconds, see pyhtml
+#Only the "all" daily table is streamed, and that is to keep memory flat: never hold it for the cache
+CACHE_STREAMED = False
  
 def get_first(val, default=""):
     return val[0] if isinstance(val, list) and val else (val or default)
  
+@metacache.cached(lambda: DB_PATH)
 def get_metrics():
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         cur.execute("PRAGMA table_info(climate_data);")
         cols = cur.fetchall()
         return [{"id": col[1], "name": col[1].replace("_", " ").title()}
                 for col in cols if col[1] not in ("station_id", "date")]
  
+@metacache.cached(lambda: DB_PATH)
 def get_all_stations():
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         cur.execute("SELECT station_id, name FROM weather_station ORDER BY name;")
         return [{"id": str(row[0]), "name": row[1]} for row in cur.fetchall()]
@@ -24,6 +32,12 @@ def get_all_stations():
 T1_ALLOWED = {"station_id", "date", "value", "state", "region"}
 T2_ALLOWED = {"state", "total"}
  
+# Daily table paging. "all" streams every row to the browser instead of paging
+PAGE_SIZES = ["100", "500", "1000", "all"]
+DEFAULT_PAGE_SIZE = "500"
+PAGING_KEYS = ("t1_after", "t1_before")
+STREAM_BATCH_ROWS = 500
+ 
 def get_sort_link(form_data, table, col):
     sort_by = f"{table}_sort_by"
     sort_order = f"{table}_sort_order"
@@ -32,29 +46,110 @@ def get_sort_link(form_data, table, col):
     new_order = "desc" if cur_by == col and cur_order == "asc" else "asc"
     params = []
     for k, v in form_data.items():
-        if k not in [sort_by, sort_order]:
+        # Re-sorting starts again from the first page
+        if k not in [sort_by, sort_order, *PAGING_KEYS]:
             actual_val = get_first(v)
             params.append(f"{html.escape(k)}={html.escape(str(actual_val))}")
     params += [f"{sort_by}={col}", f"{sort_order}={new_order}"]
     return f"?{'&'.join(params)}"
  
-def get_metric_data(metric, station_id, start, end, sort_by, sort_order):
-    col = sort_by if sort_by in T1_ALLOWED else "date"
-    order = "DESC" if sort_order == "desc" else "ASC"
-    sql = f"""
-        SELECT cd.station_id, cd.date, cd.[{metric}] AS value, ws.state, ws.region
+def get_page_link(form_data, cursor_key, cursor):
+    # Same search and sort state, different page of the daily table
+    params = []
+    for k, v in form_data.items():
+        if k not in PAGING_KEYS:
+            actual_val = get_first(v)
+            params.append(f"{html.escape(k)}={html.escape(str(actual_val))}")
+    params.append(f"{cursor_key}={cursor}")
+    return f"?{'&'.join(params)}"
+ 
+def get_order_terms(metric, sort_by, sort_order):
+    # (SQL expression, descending?) pairs the daily table is ordered by. Station, state and
+    # region are the same on every row (one station is selected), so they keep date order.
+    # date and rowid break ties, giving every row a unique position for keyset paging
+    desc = sort_order == "desc"
+    if sort_by == "value":
+        # NULLs first going up and last going down, like ORDER BY value, as their own term so
+        # the value term only ever compares numbers with numbers
+        return [(f"(cd.[{metric}] IS NULL)", not desc), (f"cd.[{metric}]", desc), ("cd.date", False), ("cd.rowid", False)]
+    if sort_by in T1_ALLOWED and sort_by != "date":
+        return [("cd.date", False), ("cd.rowid", False)]
+    return [("cd.date", desc), ("cd.rowid", desc)]
+ 
+def get_keyset_condition(terms, values, backwards):
+    # SQL for "comes after the cursor row in this ordering" (or before it, going backwards).
+    # Ties are matched with IS so a NULL value equals NULL (rows with a value never tie with
+    # a NULL, the IS NULL term before it already tells them apart)
+    condition, params = None, []
+    for (expr, desc), value in reversed(list(zip(terms, values))):
+        op = ">" if desc == backwards else "<"
+        if condition is None:
+            condition, params = f"{expr} {op} ?", [value]
+        else:
+            condition, params = f"({expr} {op} ? OR ({expr} IS ? AND {condition}))", [value, value] + params
+    return condition, params
+ 
+def get_daily_rows_sql(metric, terms, where_extra="", backwards=False):
+    order_by = ", ".join(f"{expr} {'DESC' if desc != backwards else 'ASC'}" for expr, desc in terms)
+    return f"""
+        SELECT cd.rowid, cd.station_id, cd.date, cd.[{metric}] AS value, ws.state, ws.region
         FROM climate_data cd
         JOIN weather_station ws ON cd.station_id = ws.station_id
-        WHERE cd.station_id = ? AND cd.date BETWEEN ? AND ?
-        ORDER BY {col} {order};
+        WHERE cd.station_id = ? AND cd.date BETWEEN ? AND ? {where_extra}
+        ORDER BY {order_by}
     """
-    with sqlite3.connect(DB_PATH) as conn:
+ 
+def to_daily_row(r):
+    return {"rowid": r[0], "station_id": r[1], "date": r[2], "value": r[3], "state": r[4], "region": r[5]}
+ 
+def get_metric_page(metric, station_id, start, end, sort_by, sort_order, page_size, after=None, before=None):
+    # One page of the daily table using keyset paging: `after`/`before` is the rowid of the
+    # last/first row of the page the user came from, so no OFFSET scanning is needed.
+    # Returns (rows, cursor for the previous page or None, cursor for the next page or None)
+    terms = get_order_terms(metric, sort_by, sort_order)
+    cursor = after or before
+    backwards = not after and bool(before)
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
-        cur.execute(sql, (station_id, start, end))
-        return [
-            {"station_id": r[0], "date": r[1], "value": r[2], "state": r[3], "region": r[4]}
-            for r in cur.fetchall()
-        ]
+        where_extra, extra_params = "", []
+        if cursor:
+            cur.execute(f"SELECT {', '.join(expr for expr, desc in terms)} FROM climate_data cd WHERE cd.rowid = ?;", (cursor,))
+            values = cur.fetchone()
+            if values is not None:
+                condition, extra_params = get_keyset_condition(terms, values, backwards)
+                where_extra = f"AND {condition}"
+            else:
+                backwards = False
+        cur.execute(get_daily_rows_sql(metric, terms, where_extra, backwards) + " LIMIT ?;",
+                    [station_id, start, end] + extra_params + [page_size + 1])
+        rows = [to_daily_row(r) for r in cur.fetchall()]
+ 
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = bool(where_extra), more
+    if not rows:
+        return rows, None, None
+    return rows, (rows[0]["rowid"] if has_prev else None), (rows[-1]["rowid"] if has_next else None)
+ 
+def iter_metric_data(metric, station_id, start, end, sort_by, sort_order):
+    # Every daily row in order, read in batches so memory stays flat however long the range
+    terms = get_order_terms(metric, sort_by, sort_order)
+    with dbpool.connect(DB_PATH) as conn:
+        cur = conn.cursor()
+        cur.execute(get_daily_rows_sql(metric, terms) + ";", (station_id, start, end))
+        while True:
+            batch = cur.fetchmany(STREAM_BATCH_ROWS)
+            if not batch:
+                break
+            for r in batch:
+                yield to_daily_row(r)
+ 
+def get_metric_data(metric, station_id, start, end, sort_by, sort_order):
+    return list(iter_metric_data(metric, station_id, start, end, sort_by, sort_order))
  
 def get_summary_data(metric, station_id, start, end, sort_by, sort_order):
     col = sort_by if sort_by in T2_ALLOWED else "state"
@@ -67,59 +162,27 @@ def get_summary_data(metric, station_id, start, end, sort_by, sort_order):
         GROUP BY ws.state
         ORDER BY {col} {order};
     """
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
+        if aggregates.has_range_stats(conn, metric):
+            # Only one station is selected, so this is at most one row: its state and the
+            # range average, from the column store or (whole months) the monthly rollup
+            cur.execute("SELECT state FROM weather_station WHERE station_id = ?;", (station_id,))
+            row = cur.fetchone()
+            total, value_count, row_count = aggregates.get_station_range_stats(conn, station_id, metric, start, end)
+            if row is None or not row_count:
+                return []
+            avg = total / value_count if value_count else None
+            return [{"state": row[0], "total": f"{avg:.1f}" if avg is not None else "N/A"}]
         cur.execute(sql, (station_id, start, end))
         return [
             {"state": r[0], "total": f"{r[1]:.1f}" if r[1] is not None else "N/A"}
             for r in cur.fetchall()
         ]
  
-def get_page_html(form_data):
-    metrics = get_metrics()
-    stations = get_all_stations()
- 
-    metric = get_first(form_data.get("metric"))
-    station_id = get_first(form_data.get("station_id"))
-    dt_start = get_first(form_data.get("dt_start"))
-    dt_end = get_first(form_data.get("dt_end"))
-    t1_sort_by = get_first(form_data.get("t1_sort_by", "date"))
-    t1_sort_order = get_first(form_data.get("t1_sort_order", "asc"))
-    t2_sort_by = get_first(form_data.get("t2_sort_by", "state"))
-    t2_sort_order = get_first(form_data.get("t2_sort_order", "asc"))
- 
-    metric_options = "".join(
-        f'<option value="{m["id"]}" {"selected" if metric == m["id"] else ""}>{m["name"]}</option>'
-        for m in metrics
-    )
-    station_options = "".join(
-        f'<option value="{s["id"]}" {"selected" if station_id == s["id"] else ""}>{s["name"]}</option>'
-        for s in stations
-    )
- 
-    daily_rows = []
-    summary_rows = []
- 
-    if metric and station_id and dt_start and dt_end:
-        daily_rows = get_metric_data(metric, station_id, dt_start, dt_end, t1_sort_by, t1_sort_order)
-        summary_rows = get_summary_data(metric, station_id, dt_start, dt_end, t2_sort_by, t2_sort_order)
- 
-    metric_name = next((m["name"] for m in metrics if m["id"] == metric), "Metric")
- 
-    def arrow(active, order):
-        return " ▲" if active and order == "asc" else (" ▼" if active and order == "desc" else "")
- 
-    t1_rows = "\n".join(
-        f"<tr><td>{r['station_id']}</td><td>{r['date']}</td><td>{r['value']}</td><td>{r['state']}</td><td>{r['region']}</td></tr>"
-        for r in daily_rows
-    ) if daily_rows else '<tr><td colspan="5" style="text-align:center">No data available.</td></tr>'
- 
-    t2_rows = "\n".join(
-        f"<tr><td>{r['state']}</td><td>{r['total']}</td></tr>"
-        for r in summary_rows
-    ) if summary_rows else '<tr><td colspan="2" style="text-align:center">No summary available.</td></tr>'
- 
-    return f"""
+# Page layout, split into static bytes and slots once (see templates.py). The daily rows
+# go between the two
+PAGE_TOP = templates.Template("""
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -180,20 +243,14 @@ def get_page_html(form_data):
             text-align:left;
         }}
         th {{ background:#e3eaf3; font-weight:bold; }}
+        .pager {{
+            display:flex; justify-content:space-between;
+            margin:-18px 0 30px;
+        }}
     </style>
 </head>
 <body>
-<header>
-    <a href="/"><img src="https://cdn-icons-png.flaticon.com/512/1163/1163661.png" style="height:40px;"></a>
-    <nav>
-        <a href="/">Home</a>
-        <a href="/page1b">Mission</a>
-        <a href="/page2a">Climate By Location</a>
-        <a href="/page2b">Climate By Metric</a>
-        <a href="/page3a">Similar Weather Station Sites</a>
-        <a href="/page3b">Similar Weather Station Metrics</a>
-    </nav>
-</header>
+{nav_bar}
  
 <div class="container">
     <h2 style="text-align:center; color:#003366;">Focused View of Climate Change by Climate Metric</h2>
@@ -221,6 +278,12 @@ def get_page_html(form_data):
                 <label>End Date:</label>
                 <input type="date" name="dt_end" value="{dt_end}" required>
             </div>
+            <div>
+                <label>Rows per page:</label>
+                <select name="t1_page_size">
+                    {page_size_options}
+                </select>
+            </div>
             <!-- Hidden sort fields -->
             <input type="hidden" name="t1_sort_by" value="{t1_sort_by}">
             <input type="hidden" name="t1_sort_order" value="{t1_sort_order}">
@@ -234,25 +297,127 @@ def get_page_html(form_data):
  
     <h3>Table 1: Daily {metric_name} Values</h3>
     <table>
-        <tr>
-            <th><a href="{get_sort_link(form_data, 't1', 'station_id')}">Station ID{arrow(t1_sort_by=='station_id', t1_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 't1', 'date')}">Date{arrow(t1_sort_by=='date', t1_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 't1', 'value')}">{metric_name}{arrow(t1_sort_by=='value', t1_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 't1', 'state')}">State{arrow(t1_sort_by=='state', t1_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 't1', 'region')}">Region{arrow(t1_sort_by=='region', t1_sort_order)}</a></th>
+        <tr>{t1_header}
         </tr>
-        {t1_rows}
+""", nav_bar=templates.NAV_BAR)
+PAGE_BOTTOM = templates.Template("""
     </table>
+    {pager}
  
     <h3>Table 2: State-Level Total {metric_name}</h3>
     <table>
-        <tr>
-            <th><a href="{get_sort_link(form_data, 't2', 'state')}">State{arrow(t2_sort_by=='state', t2_sort_order)}</a></th>
-            <th><a href="{get_sort_link(form_data, 't2', 'total')}">Total {metric_name}{arrow(t2_sort_by=='total', t2_sort_order)}</a></th>
+        <tr>{t2_header}
         </tr>
         {t2_rows}
     </table>
 </div>
 </body>
 </html>
-"""
\ No newline at end of file
+""")
+
+def get_page_html(form_data):
+    metrics = get_metrics()
+    stations = get_all_stations()
+ 
+    metric = get_first(form_data.get("metric"))
+    station_id = get_first(form_data.get("station_id"))
+    dt_start = get_first(form_data.get("dt_start"))
+    dt_end = get_first(form_data.get("dt_end"))
+    t1_sort_by = get_first(form_data.get("t1_sort_by", "date"))
+    t1_sort_order = get_first(form_data.get("t1_sort_order", "asc"))
+    t2_sort_by = get_first(form_data.get("t2_sort_by", "state"))
+    t2_sort_order = get_first(form_data.get("t2_sort_order", "asc"))
+    t1_page_size = get_first(form_data.get("t1_page_size", DEFAULT_PAGE_SIZE))
+    if t1_page_size not in PAGE_SIZES:
+        t1_page_size = DEFAULT_PAGE_SIZE
+    t1_after = get_first(form_data.get("t1_after"))
+    t1_before = get_first(form_data.get("t1_before"))
+    t1_after = int(t1_after) if t1_after and t1_after.isdigit() else None
+    t1_before = int(t1_before) if t1_before and t1_before.isdigit() else None
+    stream = t1_page_size == "all"
+ 
+    metric_options = "".join(
+        f'<option value="{m["id"]}" {"selected" if metric == m["id"] else ""}>{m["name"]}</option>'
+        for m in metrics
+    )
+    station_options = "".join(
+        f'<option value="{s["id"]}" {"selected" if station_id == s["id"] else ""}>{s["name"]}</option>'
+        for s in stations
+    )
+ 
+    page_size_options = "".join(
+        f'<option value="{size}" {"selected" if t1_page_size == size else ""}>{size.title()}</option>'
+        for size in PAGE_SIZES
+    )
+ 
+    daily_rows = []
+    summary_rows = []
+    prev_cursor = next_cursor = None
+    searched = bool(metric and station_id and dt_start and dt_end)
+ 
+    if searched:
+        if not stream:
+            daily_rows, prev_cursor, next_cursor = get_metric_page(
+                metric, station_id, dt_start, dt_end, t1_sort_by, t1_sort_order,
+                int(t1_page_size), t1_after, t1_before)
+        summary_rows = get_summary_data(metric, station_id, dt_start, dt_end, t2_sort_by, t2_sort_order)
+ 
+    metric_name = next((m["name"] for m in metrics if m["id"] == metric), "Metric")
+ 
+    def arrow(active, order):
+        return " ▲" if active and order == "asc" else (" ▼" if active and order == "desc" else "")
+ 
+    t1_rows = "\n".join(
+        f"<tr><td>{r['station_id']}</td><td>{r['date']}</td><td>{r['value']}</td><td>{r['state']}</td><td>{r['region']}</td></tr>"
+        for r in daily_rows
+    ) if daily_rows else '<tr><td colspan="5" style="text-align:center">No data available.</td></tr>'
+ 
+    pager = ""
+    if prev_cursor is not None or next_cursor is not None:
+        prev_link = f'<a href="{get_page_link(form_data, "t1_before", prev_cursor)}">&larr; Previous {t1_page_size}</a>' if prev_cursor is not None else "<span></span>"
+        next_link = f'<a href="{get_page_link(form_data, "t1_after", next_cursor)}">Next {t1_page_size} &rarr;</a>' if next_cursor is not None else "<span></span>"
+        pager = f'<div class="pager">{prev_link}{next_link}</div>'
+ 
+    t2_rows = "\n".join(
+        f"<tr><td>{r['state']}</td><td>{r['total']}</td></tr>"
+        for r in summary_rows
+    ) if summary_rows else '<tr><td colspan="2" style="text-align:center">No summary available.</td></tr>'
+ 
+    # Sortable column headings
+    t1_header = f"""
+            <th><a href="{get_sort_link(form_data, 't1', 'station_id')}">Station ID{arrow(t1_sort_by=='station_id', t1_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 't1', 'date')}">Date{arrow(t1_sort_by=='date', t1_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 't1', 'value')}">{metric_name}{arrow(t1_sort_by=='value', t1_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 't1', 'state')}">State{arrow(t1_sort_by=='state', t1_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 't1', 'region')}">Region{arrow(t1_sort_by=='region', t1_sort_order)}</a></th>"""
+    t2_header = f"""
+            <th><a href="{get_sort_link(form_data, 't2', 'state')}">State{arrow(t2_sort_by=='state', t2_sort_order)}</a></th>
+            <th><a href="{get_sort_link(form_data, 't2', 'total')}">Total {metric_name}{arrow(t2_sort_by=='total', t2_sort_order)}</a></th>"""
+
+    page_top = PAGE_TOP.render(
+        metric_options=metric_options, station_options=station_options, page_size_options=page_size_options,
+        dt_start=dt_start, dt_end=dt_end, t1_sort_by=t1_sort_by, t1_sort_order=t1_sort_order,
+        t2_sort_by=t2_sort_by, t2_sort_order=t2_sort_order, metric_name=metric_name, t1_header=t1_header
+    )
+    page_bottom = PAGE_BOTTOM.render(pager=pager, metric_name=metric_name, t2_header=t2_header, t2_rows=t2_rows)
+ 
+    if stream and searched:
+        return stream_page(page_top, page_bottom, metric, station_id, dt_start, dt_end, t1_sort_by, t1_sort_order)
+    return page_top + templates.encode("        " + t1_rows) + page_bottom
+ 
+def stream_page(page_top, page_bottom, metric, station_id, dt_start, dt_end, sort_by, sort_order):
+    # Yields the page in pieces so pyhtml can send the daily rows as they are read
+    yield page_top
+    batch = []
+    any_rows = False
+    for r in iter_metric_data(metric, station_id, dt_start, dt_end, sort_by, sort_order):
+        batch.append(f"<tr><td>{r['station_id']}</td><td>{r['date']}</td><td>{r['value']}</td><td>{r['state']}</td><td>{r['region']}</td></tr>\n")
+        if len(batch) >= STREAM_BATCH_ROWS:
+            yield "".join(batch)
+            batch = []
+            any_rows = True
+    if batch:
+        yield "".join(batch)
+    elif not any_rows:
+        yield '<tr><td colspan="5" style="text-align:center">No data available.</td></tr>\n'
+    yield page_bottom
@@ -1,10 +1,18 @@
-import sqlite3
 import os
+import aggregates
+import dbpool
+import metacache
+import ranking
+import templates
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "database", "climate.db")
+CACHE_TTL = 300  #seconds, see pyhtml
+#How far a metric's % change is from the reference's, for ranking (see ranking.py)
+RANK_DISTANCE = ranking.rounded_abs_diff
 
+@metacache.cached(lambda: DB_PATH)
 def get_metrics():
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         cur.execute("PRAGMA table_info(climate_data);")
         cols = cur.fetchall()
@@ -16,14 +24,17 @@ def get_metrics():
                 metrics.append({"id": col_name, "name": display})
         return metrics
 
+@metacache.cached(lambda: DB_PATH)
 def get_all_stations():
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
         cur = conn.cursor()
         cur.execute("SELECT station_id, name FROM weather_station ORDER BY name;")
         return [{"id": str(row[0]), "name": row[1]} for row in cur.fetchall()]
 
 def get_metric_total(metric, station_id, start_date, end_date):
-    with sqlite3.connect(DB_PATH) as conn:
+    with dbpool.connect(DB_PATH) as conn:
+        if aggregates.has_range_stats(conn, metric):
+            return aggregates.get_station_range_total(conn, station_id, metric, start_date, end_date)
         cur = conn.cursor()
         query = f"""
             SELECT SUM({metric})
@@ -34,77 +45,92 @@ def get_metric_total(metric, station_id, start_date, end_date):
         result = cur.fetchone()
         return result[0] if result and result[0] is not None else None
 
+def get_all_metric_totals(metrics, station_id, p1_start, p1_end, p2_start, p2_end):
+    # Gets the period 1 and period 2 totals of every metric for the station in one scan
+    # of its rows (one SUM(CASE ...) pair per metric column), instead of two queries per metric
+    if not metrics:
+        return {}
+    with dbpool.connect(DB_PATH) as conn:
+        if aggregates.has_range_stats(conn):
+            # Answered by the column store if loaded, otherwise whole months come from the
+            # monthly rollup and only the partial months at the ends (and any metric the
+            # rollup doesn't cover) read daily rows
+            ids = [m["id"] for m in metrics]
+            stats1 = aggregates.get_range_stats(conn, ids, p1_start, p1_end, station_id)
+            stats2 = aggregates.get_range_stats(conn, ids, p2_start, p2_end, station_id)
+            totals = {}
+            for mid in ids:
+                t1, n1, rows1 = stats1.get((str(station_id), mid), (None, 0, 0))
+                t2, n2, rows2 = stats2.get((str(station_id), mid), (None, 0, 0))
+                totals[mid] = (t1 if n1 else None, t2 if n2 else None)
+            return totals
+    columns = ",\n".join(
+        f"SUM(CASE WHEN date BETWEEN :p1_start AND :p1_end THEN [{m['id']}] END), "
+        f"SUM(CASE WHEN date BETWEEN :p2_start AND :p2_end THEN [{m['id']}] END)"
+        for m in metrics
+    )
+    with dbpool.connect(DB_PATH) as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT {columns}
+            FROM climate_data
+            WHERE station_id = :station_id
+              AND (date BETWEEN :p1_start AND :p1_end OR date BETWEEN :p2_start AND :p2_end)
+        """, {"station_id": station_id, "p1_start": p1_start, "p1_end": p1_end,
+              "p2_start": p2_start, "p2_end": p2_end})
+        row = cur.fetchone()
+        return {m["id"]: (row[2 * i], row[2 * i + 1]) for i, m in enumerate(metrics)}
+
 def get_first(val):
     return val[0] if isinstance(val, list) and val else val
 
-def get_metric_name(metric_id):
-    for m in get_metrics():
+def get_metric_name(metric_id, metrics=None):
+    # Pass in an already loaded metric list to avoid reading the table schema again
+    for m in (get_metrics() if metrics is None else metrics):
         if m["id"] == metric_id:
             return m["name"]
     return "Unknown"
 
 def get_similar_metrics(ref_metric, station_id, p1_start, p1_end, p2_start, p2_end, num_results):
     metrics = get_metrics()
-    ref_total1 = get_metric_total(ref_metric, station_id, p1_start, p1_end)
-    ref_total2 = get_metric_total(ref_metric, station_id, p2_start, p2_end)
+    totals = get_all_metric_totals(metrics, station_id, p1_start, p1_end, p2_start, p2_end)
+    ref_total1, ref_total2 = totals.get(ref_metric, (None, None))
 
     if not ref_total1 or not ref_total2 or ref_total1 == 0:
         return []
 
     ref_pct_change = ((ref_total2 - ref_total1) / ref_total1) * 100.0
     results = [{
-        "name": get_metric_name(ref_metric),
+        "name": get_metric_name(ref_metric, metrics),
         "total1": f"{ref_total1:.2f}",
         "total2": f"{ref_total2:.2f}",
         "pct_change": f"{ref_pct_change:+.2f}",
         "diff": "0.00 (selected)"
     }]
 
-    others = []
-    for m in metrics:
-        mid = m["id"]
-        if mid == ref_metric:
-            continue
-        t1 = get_metric_total(mid, station_id, p1_start, p1_end)
-        t2 = get_metric_total(mid, station_id, p2_start, p2_end)
-        if not t1 or not t2 or t1 == 0:
-            continue
-        pct = ((t2 - t1) / t1) * 100.0
-        diff = pct - ref_pct_change
-        others.append({
-            "name": m["name"],
+    def candidates():
+        for m in metrics:
+            mid = m["id"]
+            if mid == ref_metric:
+                continue
+            t1, t2 = totals[mid]
+            if not t1 or not t2:
+                continue
+            yield ranking.pct_change(t1, t2), (m["name"], t1, t2)
+
+    # Ranked on the raw numbers, only the metrics that make the cut get formatted
+    for distance, pct, (name, t1, t2) in ranking.top_k(candidates(), num_results, ref_pct_change, RANK_DISTANCE):
+        results.append({
+            "name": name,
             "total1": f"{t1:.2f}",
             "total2": f"{t2:.2f}",
             "pct_change": f"{pct:+.2f}",
-            "diff": f"{diff:+.2f}"
+            "diff": f"{pct - ref_pct_change:+.2f}"
         })
-
-    others = sorted(others, key=lambda x: abs(float(x["diff"])))
-    results += others[:int(num_results)]
     return results
 
-def get_page_html(form_data):
-    metrics = get_metrics()
-    stations = get_all_stations()
-
-    p1_start = get_first(form_data.get("period1_start", ""))
-    p1_end = get_first(form_data.get("period1_end", ""))
-    p2_start = get_first(form_data.get("period2_start", ""))
-    p2_end = get_first(form_data.get("period2_end", ""))
-    ref_metric = get_first(form_data.get("ref_metric", ""))
-    station_id = get_first(form_data.get("station_id", ""))
-    num_results = get_first(form_data.get("num_results", "3"))
-
-    metric_options = "".join(
-        f'<option value="{m["id"]}" {"selected" if ref_metric == m["id"] else ""}>{m["name"]}</option>'
-        for m in metrics
-    )
-    station_options = "".join(
-        f'<option value="{s["id"]}" {"selected" if station_id == s["id"] else ""}>{s["name"]}</option>'
-        for s in stations
-    )
-
-    show_table = all([p1_start, p1_end, p2_start, p2_end, ref_metric, station_id, num_results])
+def get_table_rows(show_table, p1_start, p1_end, p2_start, p2_end, ref_metric, station_id, num_results):
+    # Runs the similarity search and builds the result table rows
     table_rows = ""
     if show_table:
         try:
@@ -123,29 +149,14 @@ def get_page_html(form_data):
                         </tr>
                     """
         except Exception as e:
-            table_rows = f'<tr><td colspan="5" style="color:red">Error: {e}</td></tr>'
+            table_rows = templates.Uncached(f'<tr><td colspan="5" style="color:red">Error: {e}</td></tr>')
     else:
         table_rows = '<tr><td colspan="5" style="text-align:center">No data to display. Please fill the form and submit.</td></tr>'
+    return table_rows
 
-    nav_bar = """
-    <header style="display:flex; align-items:center; gap:20px; padding:10px;">
-    <a href="/">
-        <img src="https://cdn-icons-png.flaticon.com/512/1163/1163661.png"
-             alt="Weather Logo"
-             style="height:40px; width:auto; vertical-align:middle;">
-    </a>
-    <nav style="display:flex; gap:12px;">
-        <a href="/">Home</a>
-        <a href="/page1b">Mission</a>
-        <a href="/page2a">Climate By Location</a>
-        <a href="/page2b">Climate By Metric</a>
-        <a href="/page3a">Similar Weather Station Sites</a>
-        <a href="/page3b">Similar Weather Station Metrics</a>
-    </nav>
-</header>
-    """
-
-    return f"""
+# Page layout, split into static bytes and slots once (see templates.py). The result
+# rows go between the two
+PAGE_TOP = templates.Template("""
     <!DOCTYPE html>
     <html>
     <head>
@@ -267,9 +278,49 @@ def get_page_html(form_data):
                     <th>% Change</th>
                     <th>Difference from Reference (%)</th>
                 </tr>
-                {table_rows}
+                """, nav_bar=templates.NAV_BAR)
+PAGE_BOTTOM = templates.Template("""
             </table>
         </div>
     </body>
     </html>
-    """
+    """)
+
+def get_page_html(form_data):
+    metrics = get_metrics()
+    stations = get_all_stations()
+
+    p1_start = get_first(form_data.get("period1_start", ""))
+    p1_end = get_first(form_data.get("period1_end", ""))
+    p2_start = get_first(form_data.get("period2_start", ""))
+    p2_end = get_first(form_data.get("period2_end", ""))
+    ref_metric = get_first(form_data.get("ref_metric", ""))
+    station_id = get_first(form_data.get("station_id", ""))
+    num_results = get_first(form_data.get("num_results", "3"))
+
+    metric_options = "".join(
+        f'<option value="{m["id"]}" {"selected" if ref_metric == m["id"] else ""}>{m["name"]}</option>'
+        for m in metrics
+    )
+    station_options = "".join(
+        f'<option value="{s["id"]}" {"selected" if station_id == s["id"] else ""}>{s["name"]}</option>'
+        for s in stations
+    )
+
+    show_table = all([p1_start, p1_end, p2_start, p2_end, ref_metric, station_id, num_results])
+
+    page_top = PAGE_TOP.render(
+        p1_start=p1_start, p1_end=p1_end, p2_start=p2_start, p2_end=p2_end,
+        station_options=station_options, metric_options=metric_options, num_results=num_results
+    )
+    page_bottom = PAGE_BOTTOM.render()
+    if not show_table:
+        return page_top + templates.encode(get_table_rows(show_table, p1_start, p1_end, p2_start, p2_end, ref_metric, station_id, num_results)) + page_bottom
+    # Send the top of the page (form and table header) straight away, the similarity
+    # search below can take a while
+    return stream_page(page_top, page_bottom, show_table, p1_start, p1_end, p2_start, p2_end, ref_metric, station_id, num_results)
+
+def stream_page(page_top, page_bottom, show_table, p1_start, p1_end, p2_start, p2_end, ref_metric, station_id, num_results):
+    yield page_top
+    yield get_table_rows(show_table, p1_start, p1_end, p2_start, p2_end, ref_metric, station_id, num_results)
+    yield page_bottom
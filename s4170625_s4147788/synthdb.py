@@ -0,0 +1,164 @@
+#Builds a synthetic climate.db with the same tables and columns the pages query, for
+#measuring performance when the real database (too large for the repo) isn't around.
+#
+#    python synthdb.py --stations 100 --years 10 --db /tmp/climate.db
+#
+#weather_station gets one row per station (name, state, region, latitude, longitude) and
+#climate_data one row per station per day, with a REAL column for every measurement listed
+#in description.csv (the *Qual quality flags are left out). Values follow rough seasonal and
+#latitude patterns with some missing (NULL) readings, and the same --seed always gives the
+#same database, so timings from different runs can be compared.
+
+import argparse
+import csv
+import datetime
+import math
+import os
+import random
+import re
+import sqlite3
+import time
+
+import aggregates
+import indexes
+
+DESC_CSV_PATH = os.path.join(os.path.dirname(__file__), "description.csv")
+DEFAULT_START_YEAR = 2000
+MISSING_RATE = 0.05  #Fraction of readings left NULL
+
+#state -> (latitude range, longitude range), roughly where each state is
+STATES = {
+    "NSW": ((-37.5, -28.2), (141.0, 153.6)),
+    "VIC": ((-39.1, -34.0), (141.0, 149.9)),
+    "QLD": ((-29.0, -10.7), (138.0, 153.5)),
+    "SA": ((-38.0, -26.0), (129.0, 141.0)),
+    "WA": ((-35.1, -13.7), (113.0, 129.0)),
+    "TAS": ((-43.6, -39.6), (144.6, 148.4)),
+    "NT": ((-26.0, -10.9), (129.0, 138.0)),
+    "ACT": ((-35.9, -35.1), (148.8, 149.4)),
+}
+REGIONS_PER_STATE = 4
+
+
+def get_metric_columns(desc_csv=DESC_CSV_PATH):
+    #description.csv field names in the snake_case form used for climate_data columns,
+    #eg. MaxTemp -> max_temp, Humid00 -> humid00
+    columns = []
+    with open(desc_csv, mode="r", encoding="utf-8") as csvfile:
+        for row in csv.DictReader(csvfile):
+            field = row["Field"].strip()
+            if field in ("Location", "DMY") or field.lower().endswith("qual"):
+                continue
+            columns.append(re.sub(r"(?<=[a-z])(?=[A-Z])", "_", field).lower())
+    return columns
+
+
+def make_value_function(column, rnd):
+    #Returns f(day_of_year, latitude) -> reading for that kind of measurement
+    season = lambda day: math.cos(2 * math.pi * (day - 15) / 365.25)  #1 in January, -1 in July
+    if column == "precipitation":
+        return lambda day, lat: 0.0 if rnd.random() < 0.6 else round(rnd.expovariate(0.2), 1)
+    if column == "evaporation":
+        return lambda day, lat: round(max(0.0, 5 + 3 * season(day) + rnd.gauss(0, 1.5)), 1)
+    if column == "max_temp":
+        return lambda day, lat: round(38 + lat * 0.45 + 6 * season(day) + rnd.gauss(0, 3), 1)
+    if column == "min_temp":
+        return lambda day, lat: round(25 + lat * 0.45 + 5 * season(day) + rnd.gauss(0, 3), 1)
+    if column.startswith("humid"):
+        return lambda day, lat: float(min(100, max(5, round(60 - 10 * season(day) + rnd.gauss(0, 15)))))
+    if column == "sunshine":
+        return lambda day, lat: round(min(14.0, max(0.0, 8 + 2 * season(day) + rnd.gauss(0, 2.5))), 1)
+    if column.startswith("okta"):
+        return lambda day, lat: float(rnd.randint(0, 8))
+    #Day counts (rain_days_num, max_temp_days, ...) are nearly always 1
+    return lambda day, lat: 1.0 if rnd.random() < 0.97 else float(rnd.randint(2, 4))
+
+
+def generate(database, stations=100, years=10, start_year=DEFAULT_START_YEAR, seed=1,
+             with_indexes=True, with_rollup=False, verbose=True):
+    started = time.perf_counter()
+    rnd = random.Random(seed)
+    columns = get_metric_columns()
+    for path in (database, database + "-wal", database + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+
+    conn = sqlite3.connect(database)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF;")
+        conn.execute("PRAGMA synchronous=OFF;")
+        conn.execute("""
+            CREATE TABLE weather_station (
+                station_id INTEGER PRIMARY KEY,
+                name TEXT,
+                latitude REAL,
+                longitude REAL,
+                state TEXT,
+                region TEXT
+            );
+        """)
+        column_defs = "".join(f",\n                [{c}] REAL" for c in columns)
+        conn.execute(f"""
+            CREATE TABLE climate_data (
+                station_id INTEGER,
+                date TEXT{column_defs}
+            );
+        """)
+
+        state_names = list(STATES)
+        station_rows = []
+        for i in range(stations):
+            state = state_names[i % len(state_names)]
+            (lat_lo, lat_hi), (lon_lo, lon_hi) = STATES[state]
+            station_rows.append((
+                1000 + i,
+                f"Station {i + 1:04d}",
+                round(rnd.uniform(lat_lo, lat_hi), 4),
+                round(rnd.uniform(lon_lo, lon_hi), 4),
+                state,
+                f"{state} Region {rnd.randrange(REGIONS_PER_STATE) + 1}",
+            ))
+        conn.executemany("INSERT INTO weather_station VALUES (?, ?, ?, ?, ?, ?);", station_rows)
+
+        first_day = datetime.date(start_year, 1, 1)
+        days = [(first_day + datetime.timedelta(days=k)) for k in range((datetime.date(start_year + years, 1, 1) - first_day).days)]
+        day_info = [(d.isoformat(), d.timetuple().tm_yday) for d in days]
+        value_functions = [make_value_function(c, rnd) for c in columns]
+        placeholders = ", ".join("?" * (len(columns) + 2))
+
+        def rows():
+            for station_id, name, lat, lon, state, region in station_rows:
+                for date, day in day_info:
+                    yield (station_id, date) + tuple(
+                        None if rnd.random() < MISSING_RATE else f(day, lat) for f in value_functions
+                    )
+
+        conn.executemany(f"INSERT INTO climate_data VALUES ({placeholders});", rows())
+        conn.commit()
+    finally:
+        conn.close()
+
+    if verbose:
+        print(f"Generated {database}: {stations} stations x {len(days)} days, "
+              f"{len(columns)} metrics in {time.perf_counter() - started:.1f}s")
+    if with_indexes:
+        indexes.ensure_indexes(database, verbose=verbose)
+    if with_rollup:
+        aggregates.build(database)
+    return database
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a synthetic climate.db for benchmarking")
+    parser.add_argument("--db", default=os.path.join(os.path.dirname(__file__), "database", "synthetic_climate.db"),
+                        help="database file to create (replaced if it exists)")
+    parser.add_argument("--stations", type=int, default=100)
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--start-year", type=int, default=DEFAULT_START_YEAR)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-indexes", action="store_true", help="skip creating the indexes from indexes.py")
+    parser.add_argument("--rollup", action="store_true", help="also build the monthly rollup (aggregates.py)")
+    args = parser.parse_args()
+    generate(args.db, args.stations, args.years, args.start_year, args.seed,
+             with_indexes=not args.no_indexes, with_rollup=args.rollup)
@@ -0,0 +1,73 @@
+#Precompiled page templates, shared by the page modules.
+#
+#Templates are written like str.format strings: {name} is a slot filled in per request and
+#{{ }} are literal braces, so a page's CSS reads the same as it did in its f-string. Each
+#template is split once, when the page module is imported, into UTF-8 encoded static segments
+#and the slots between them, and any constants given at that point (eg. the nav bar) are
+#folded into the static segments. Rendering then only encodes the slot values and joins bytes.
+#
+#Slot values can be str, bytes, or anything else (which goes through str()).
+
+import string
+
+#Header and nav bar at the top of every page
+NAV_BAR = """
+    <header style="display:flex; align-items:center; gap:20px; padding:10px;">
+    <a href="/">
+        <img src="https://cdn-icons-png.flaticon.com/512/1163/1163661.png"
+             alt="Weather Logo"
+             style="height:40px; width:auto; vertical-align:middle;">
+    </a>
+    <nav style="display:flex; gap:12px;">
+        <a href="/">Home</a>
+        <a href="/page1b">Mission</a>
+        <a href="/page2a">Climate By Location</a>
+        <a href="/page2b">Climate By Metric</a>
+        <a href="/page3a">Similar Weather Station Sites</a>
+        <a href="/page3b">Similar Weather Station Metrics</a>
+    </nav>
+    </header>
+    """
+
+
+class Uncached(str):
+    #Page text that must not be cached, eg. an error message. A page (or a piece of a streamed
+    #page) of this type is sent as usual, but pyhtml won't keep the response for CACHE_TTL, so a
+    #one-off failure isn't served again to later requests
+    pass
+
+
+def encode(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return value.encode("utf-8")
+
+
+class Template:
+    def __init__(self, source, **constants):
+        self.parts = []  #(static bytes, slot name) pairs, the last one has no slot
+        static = []
+        for text, name, spec, conversion in string.Formatter().parse(source):
+            static.append(text)
+            if name is None:
+                continue
+            if not name.isidentifier() or spec or conversion:
+                raise ValueError(f"Template slots must be plain names, not {{{name}}}")
+            if name in constants:
+                static.append(str(constants[name]))
+            else:
+                self.parts.append((encode("".join(static)), name))
+                static = []
+        self.tail = encode("".join(static))
+        self.slots = frozenset(name for _, name in self.parts)
+
+    def render(self, **values):
+        #The page as bytes. A missing slot is a KeyError
+        out = []
+        for static, name in self.parts:
+            out.append(static)
+            out.append(encode(values[name]))
+        out.append(self.tail)
+        return b"".join(out)
@@ -0,0 +1,100 @@
+#Shared fixtures: a small synthetic climate.db (see synthdb.py) and clean module state.
+#
+#    python -m pytest tests
+
+import math
+import os
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PACKAGE_DIR not in sys.path:
+    sys.path.insert(0, PACKAGE_DIR)
+
+import columnstore
+import dbpool
+import metacache
+import synthdb
+
+STATIONS = 12
+YEARS = 2
+METRICS = ["max_temp", "precipitation"]
+
+
+@pytest.fixture(scope="session")
+def base_db(tmp_path_factory):
+    #Generated once; tests that change the database get their own copy (climate_db)
+    path = str(tmp_path_factory.mktemp("base") / "climate.db")
+    synthdb.generate(path, stations=STATIONS, years=YEARS, verbose=False)
+    return path
+
+
+@pytest.fixture
+def climate_db(base_db, tmp_path):
+    path = str(tmp_path / "climate.db")
+    shutil.copyfile(base_db, path)
+    yield path
+    columnstore.unload(path)
+    dbpool.close_all()
+
+
+@pytest.fixture
+def pages_db(climate_db, monkeypatch):
+    #Points the page modules at the test database (like benchmark.use_database) for one test
+    import benchmark
+    for module in benchmark.DB_MODULES:
+        monkeypatch.setattr(module, "DB_PATH", climate_db)
+    return climate_db
+
+
+@pytest.fixture(autouse=True)
+def clean_caches():
+    metacache.clear()
+    yield
+    metacache.clear()
+
+
+def get_station_ids(database):
+    conn = sqlite3.connect(database)
+    try:
+        return [str(row[0]) for row in conn.execute("SELECT station_id FROM weather_station ORDER BY station_id;")]
+    finally:
+        conn.close()
+
+
+def append_rows(database, station_ids, month):
+    #Appends a copy of the given stations' rows for `month` (YYYY-MM), dated a year later so
+    #they land at the end of each station's rows, and returns how many were added
+    conn = sqlite3.connect(database)
+    try:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(climate_data);")]
+        rows = conn.execute(f"""
+            SELECT * FROM climate_data
+            WHERE station_id IN ({', '.join('?' for _ in station_ids)}) AND date LIKE ?
+            ORDER BY rowid;
+        """, list(station_ids) + [month + "-%"]).fetchall()
+        date_index = columns.index("date")
+        shifted = []
+        for row in rows:
+            row = list(row)
+            row[date_index] = str(int(row[date_index][:4]) + YEARS) + row[date_index][4:]
+            shifted.append(row)
+        with conn:
+            conn.executemany(f"INSERT INTO climate_data VALUES ({', '.join('?' for _ in columns)});", shifted)
+        return len(shifted)
+    finally:
+        conn.close()
+
+
+def assert_same_stats(actual, expected):
+    #{(station_id, metric): (total, value_count, row_count)} equal, totals to rounding
+    assert actual.keys() == expected.keys()
+    for key, (total, value_count, row_count) in expected.items():
+        assert actual[key][1:] == (value_count, row_count), key
+        if total is None:
+            assert actual[key][0] is None, key
+        else:
+            assert math.isclose(actual[key][0], total, rel_tol=1e-9, abs_tol=1e-9), key
@@ -0,0 +1,114 @@
+import sqlite3
+
+import pytest
+
+import aggregates
+import student_a_level_3
+from conftest import METRICS, append_rows, assert_same_stats, get_station_ids
+
+RANGES = [
+    ("2000-01-01", "2001-12-31"),  #whole months only
+    ("2000-02-15", "2000-05-10"),  #partial months at both ends
+    ("2001-06-03", "2001-06-20"),  #inside one month
+    ("1999-01-01", "1999-12-31"),  #no rows
+]
+
+
+def get_stats(database, start, end, **stations):
+    conn = sqlite3.connect(database)
+    try:
+        return aggregates.get_range_stats(conn, METRICS, start, end, **stations)
+    finally:
+        conn.close()
+
+
+def get_raw(database, start, end, **stations):
+    conn = sqlite3.connect(database)
+    try:
+        return aggregates.get_raw_stats(conn, METRICS, start, end, **stations)
+    finally:
+        conn.close()
+
+
+def test_split_range():
+    assert aggregates.split_range("2000-01-01", "2000-12-31") == (((2000, 1), (2000, 12)), [])
+    assert aggregates.split_range("2000-01-15", "2000-03-10") == (
+        ((2000, 2), (2000, 2)), [("2000-01-15", "2000-01-31"), ("2000-03-01", "2000-03-10")])
+    assert aggregates.split_range("2000-02-03", "2000-02-20") == (None, [("2000-02-03", "2000-02-20")])
+    assert aggregates.split_range("2000-1-1", "2000-12-31") == (None, [("2000-1-1", "2000-12-31")])
+    assert aggregates.split_range("2001-01-01", "2000-01-01") == (None, [])
+
+
+def test_station_filters_chunk_long_lists(monkeypatch):
+    monkeypatch.setattr(aggregates, "MAX_IN_PARAMS", 3)
+    assert aggregates.get_station_filters() == [("", [])]
+    assert aggregates.get_station_filters(station_id=7) == [("station_id = ? AND ", [7])]
+    filters = aggregates.get_station_filters(station_ids=[1, "2", 2, 3, 4, 5, 1])
+    assert [params for _, params in filters] == [["1", "2", "3"], ["4", "5"]]
+    assert filters[0][0] == "station_id IN (?, ?, ?) AND "
+
+
+@pytest.mark.parametrize("start, end", RANGES)
+def test_rollup_matches_raw(climate_db, start, end):
+    expected = get_raw(climate_db, start, end)
+    aggregates.build(climate_db)
+    assert aggregates.has_rollup(sqlite3.connect(climate_db), METRICS[0])
+    assert_same_stats(get_stats(climate_db, start, end), expected)
+
+
+def test_rollup_station_lists_match_raw(climate_db, monkeypatch):
+    aggregates.build(climate_db)
+    station_ids = get_station_ids(climate_db)[::3] + ["99999"]
+    monkeypatch.setattr(aggregates, "MAX_IN_PARAMS", 2)
+    for start, end in RANGES:
+        expected = {k: v for k, v in get_raw(climate_db, start, end).items() if k[0] in station_ids}
+        assert_same_stats(get_stats(climate_db, start, end, station_ids=station_ids), expected)
+        one = station_ids[1]
+        assert_same_stats(get_stats(climate_db, start, end, station_id=one),
+                          {k: v for k, v in expected.items() if k[0] == one})
+
+
+def test_stale_rollup_is_not_used_until_refreshed(climate_db):
+    aggregates.build(climate_db)
+    station_ids = get_station_ids(climate_db)
+    added = append_rows(climate_db, station_ids[2:5], "2000-03")
+    assert added
+    conn = sqlite3.connect(climate_db)
+    try:
+        assert not aggregates.has_rollup(conn)
+    finally:
+        conn.close()
+    #Appended rows are dated a year after the last one (see append_rows)
+    start, end = "2000-01-01", "2002-12-31"
+    assert_same_stats(get_stats(climate_db, start, end), get_raw(climate_db, start, end))
+
+    assert aggregates.refresh(climate_db) == 3
+    conn = sqlite3.connect(climate_db)
+    try:
+        assert aggregates.has_rollup(conn)
+    finally:
+        conn.close()
+    for start, end in RANGES + [(start, end), ("2002-03-01", "2002-03-31")]:
+        assert_same_stats(get_stats(climate_db, start, end), get_raw(climate_db, start, end))
+
+
+def test_refresh_without_rollup_builds_it(climate_db):
+    assert aggregates.refresh(climate_db) > 0
+    start, end = RANGES[1]
+    assert_same_stats(get_stats(climate_db, start, end), get_raw(climate_db, start, end))
+
+
+def test_page_3a_averages_same_from_raw_and_rollup(climate_db, monkeypatch):
+    periods = ("2000-01-10", "2000-08-20", "2001-02-01", "2001-11-15")
+    station_ids = get_station_ids(climate_db)[::2] + ["99999"]
+    raw_all = student_a_level_3.get_all_station_period_avgs("max_temp", *periods, database=climate_db)
+    raw_some = student_a_level_3.get_all_station_period_avgs("max_temp", *periods, station_ids=station_ids, database=climate_db)
+    assert raw_some == {k: v for k, v in raw_all.items() if k in station_ids}
+
+    aggregates.build(climate_db)
+    monkeypatch.setattr(aggregates, "MAX_IN_PARAMS", 2)
+    for station_list, expected in ((None, raw_all), (station_ids, raw_some)):
+        rolled = student_a_level_3.get_all_station_period_avgs("max_temp", *periods, station_ids=station_list, database=climate_db)
+        assert rolled.keys() == expected.keys()
+        for sid, avgs in expected.items():
+            assert rolled[sid] == pytest.approx(avgs, rel=1e-9)
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+import assets
+
+
+@pytest.fixture
+def images(tmp_path, monkeypatch):
+    #An empty images/ folder and a fresh store that checks files on every lookup
+    images_dir = tmp_path / "images"
+    images_dir.mkdir()
+    monkeypatch.setattr(assets, "ASSETS_DIR", str(images_dir))
+    monkeypatch.setattr(assets, "BUILD_DIR", str(images_dir / "build"))
+    monkeypatch.setattr(assets, "CHECK_INTERVAL", 0.0)
+    monkeypatch.setattr(assets, "store", assets.AssetStore())
+    return images_dir
+
+
+def write(path, data, mtime=None):
+    path.write_bytes(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_fingerprinted_url_changes_with_the_file(images):
+    write(images / "logo.png", b"first", mtime=1_000_000)
+    first = assets.url("logo.png")
+    assert first.startswith("/assets/logo.") and first.endswith(".png")
+    assert assets.url("logo.png") == first
+    write(images / "logo.png", b"second", mtime=1_000_100)
+    assert assets.url("logo.png") != first
+    assert assets.url("missing.png") == "/images/missing.png"
+
+
+def test_lookup(images):
+    write(images / "logo.png", b"image bytes")
+    url = assets.url("logo.png")
+    asset, immutable = assets.lookup(url)
+    assert asset.name == "logo.png" and immutable
+    assert asset.file.body == b"image bytes"
+    assert asset.file.content_type == "image/png"
+
+    #An old fingerprint still gets the file, but not the long caching
+    asset, immutable = assets.lookup("/assets/logo.000000000000.png")
+    assert asset.name == "logo.png" and not immutable
+    asset, immutable = assets.lookup("/images/logo.png")
+    assert asset.name == "logo.png" and not immutable
+
+    assert assets.lookup("/images/../logo.png") == (None, False)
+    assert assets.lookup("/assets/sub/logo.1.png") == (None, False)
+    assert assets.lookup("/assets/missing.1.png") == (None, False)
+    assert assets.lookup("/page2a") == (None, False)
+
+
+def test_removed_file_is_forgotten(images):
+    write(images / "logo.png", b"image bytes")
+    assert assets.lookup("/images/logo.png")[0] is not None
+    os.remove(images / "logo.png")
+    assert assets.lookup("/images/logo.png") == (None, False)
+
+
+def test_big_files_are_not_kept_in_memory(images, monkeypatch):
+    monkeypatch.setattr(assets, "MEMORY_MAX_BYTES", 4)
+    write(images / "big.jpg", b"0123456789")
+    asset, _ = assets.lookup("/images/big.jpg")
+    assert asset.file.body is None and asset.file.size == 10
+
+
+def test_build_makes_smaller_copies(images):
+    Image = pytest.importorskip("PIL.Image")
+    Image.new("RGB", (1200, 600), (30, 120, 200)).save(images / "photo.jpg", quality=95)
+    original = assets.url("photo.jpg")
+    assets.build(max_width=300)
+    asset, _ = assets.lookup(assets.url("photo.jpg"))
+    assert asset.url != original
+    assert asset.file.path == os.path.join(assets.BUILD_DIR, "photo.jpg")
+    assert asset.file.size < os.path.getsize(images / "photo.jpg")
+    with Image.open(asset.file.path) as image:
+        assert image.width == 300
+    if asset.webp is not None:
+        assert asset.get_file("image/avif,image/webp,*/*").content_type == "image/webp"
+    assert asset.get_file("image/*") is asset.file
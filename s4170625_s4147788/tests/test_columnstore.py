@@ -0,0 +1,150 @@
+import os
+import sqlite3
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import aggregates
+import columnstore
+import student_a_level_3
+from conftest import METRICS, append_rows, assert_same_stats, get_station_ids
+
+
+RANGES = [
+    ("2000-01-01", "2001-12-31"),
+    ("2000-02-15", "2000-03-10"),
+    ("2001-06-01", "2001-06-01"),
+    ("1999-01-01", "1999-12-31"),
+]
+
+
+def get_raw(database, start, end, station_id=None, station_ids=None):
+    conn = sqlite3.connect(database)
+    try:
+        return aggregates.get_raw_stats(conn, METRICS, start, end, station_id, station_ids=station_ids)
+    finally:
+        conn.close()
+
+
+def check_store(store, database):
+    station_ids = get_station_ids(database)
+    some = station_ids[1::4] + ["99999"]
+    for start, end in RANGES:
+        expected = get_raw(database, start, end)
+        assert_same_stats(store.range_stats(METRICS, start, end), expected)
+        assert_same_stats(store.range_stats(METRICS, start, end, station_id=station_ids[3]),
+                          {k: v for k, v in expected.items() if k[0] == station_ids[3]})
+        assert_same_stats(store.range_stats(METRICS, start, end, station_ids=some),
+                          {k: v for k, v in expected.items() if k[0] in some})
+
+
+def test_in_memory_store_matches_raw(climate_db):
+    store = columnstore.load(climate_db)
+    assert store is not None and not store.state.mapped
+    check_store(store, climate_db)
+
+
+def test_get_range_stats_uses_loaded_store(climate_db):
+    store = columnstore.load(climate_db, METRICS)
+    conn = sqlite3.connect(climate_db)
+    try:
+        assert aggregates.get_column_store(conn, METRICS) is store
+        start, end = RANGES[1]
+        assert_same_stats(aggregates.get_range_stats(conn, METRICS, start, end), get_raw(climate_db, start, end))
+    finally:
+        conn.close()
+
+
+def test_unknown_dates_go_to_sql(climate_db):
+    store = columnstore.load(climate_db)
+    assert store.range_stats(METRICS, "2000/01/01", "2000-12-31") is None
+
+
+def test_changed_database_reloads_in_background(climate_db):
+    store = columnstore.load(climate_db, METRICS)
+    old_state = store.state
+    station_ids = get_station_ids(climate_db)
+    assert append_rows(climate_db, station_ids[4:6], "2001-03")
+    assert columnstore.get_store(climate_db) is store
+    store.wait()
+    assert store.state is not old_state
+    check_store(store, climate_db)
+    #A query still holding the old state gets nothing mixed from the new one
+    other = sorted(old_state.metrics - set(METRICS))[0]
+    assert store.get_prefix(old_state, other) is None
+
+
+def test_page_3a_averages_same_from_sql_and_columns(climate_db):
+    periods = ("2000-01-10", "2000-08-20", "2001-02-01", "2001-11-15")
+    station_ids = get_station_ids(climate_db)[::2] + ["99999"]
+    results = {}
+    for source in ("raw", "rollup", "columns"):
+        if source == "rollup":
+            aggregates.build(climate_db)
+        if source == "columns":
+            columnstore.load(climate_db)
+        for station_list in (None, tuple(station_ids)):
+            results[source, station_list] = student_a_level_3.get_all_station_period_avgs(
+                "max_temp", *periods, station_ids=station_list, database=climate_db)
+    for (source, station_list), avgs in results.items():
+        expected = results["raw", station_list]
+        assert avgs.keys() == expected.keys()
+        for sid in expected:
+            assert avgs[sid] == pytest.approx(expected[sid], rel=1e-9), (source, sid)
+
+
+def test_mapped_files_match_raw(climate_db):
+    assert columnstore.export(climate_db) == sorted(aggregates.get_numeric_metrics(sqlite3.connect(climate_db)))
+    store = columnstore.load(climate_db)
+    assert store.state.mapped
+    check_store(store, climate_db)
+
+
+def test_out_of_date_files_are_not_mapped(climate_db):
+    columnstore.export(climate_db)
+    append_rows(climate_db, get_station_ids(climate_db)[:1], "2000-01")
+    store = columnstore.load(climate_db)
+    assert not store.state.mapped
+    check_store(store, climate_db)
+
+
+def read_files(files_dir):
+    return {name: np.fromfile(os.path.join(files_dir, name), dtype=np.uint8)
+            for name in sorted(os.listdir(files_dir)) if name != columnstore.INDEX_FILE}
+
+
+@pytest.mark.parametrize("stations", [slice(4, 6), slice(0, 1), slice(-1, None)])
+def test_refresh_matches_export(climate_db, stations):
+    columnstore.export(climate_db)
+    added = append_rows(climate_db, get_station_ids(climate_db)[stations], "2001-03")
+    assert columnstore.refresh(climate_db) == added
+    store = columnstore.load(climate_db)
+    assert store.state.mapped
+    check_store(store, climate_db)
+
+    files_dir = columnstore.get_files_dir(climate_db)
+    refreshed = read_files(files_dir)
+    index = store.read_index()
+    columnstore.unload(climate_db)
+    del store
+    columnstore.export(climate_db)
+    exported = read_files(files_dir)
+    assert refreshed.keys() == exported.keys()
+    for name in exported:
+        assert np.array_equal(refreshed[name], exported[name]), name
+    assert columnstore.ColumnStore(climate_db).read_index() == index
+
+
+def test_refresh_with_nothing_new(climate_db):
+    columnstore.export(climate_db)
+    assert columnstore.refresh(climate_db) == 0
+    assert columnstore.load(climate_db).state.mapped
+
+
+def test_make_prefix_restarts_for_every_station():
+    values = np.array([1.0, np.nan, 2.0, 5.0, 7.0, np.nan])
+    offsets = np.array([0, 3, 3, 6])  #the middle station has no rows
+    sums, counts = columnstore.make_prefix(values, offsets)
+    assert sums.tolist() == [0.0, 1.0, 1.0, 3.0, 0.0, 0.0, 5.0, 12.0, 12.0]
+    assert counts.tolist() == [0, 1, 1, 2, 0, 0, 1, 2, 2]
@@ -0,0 +1,130 @@
+import os
+import shutil
+import sqlite3
+
+import aggregates
+import metacache
+
+
+def write(path, text, mtime=None):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_loads_once_until_the_file_changes(tmp_path):
+    path = str(tmp_path / "data.csv")
+    write(path, "a", mtime=1_000_000)
+    cache = metacache.MetadataCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get("k", path, loader) == 1
+    assert cache.get("k", path, loader) == 1
+    write(path, "ab", mtime=1_000_000)
+    assert cache.get("k", path, loader) == 2
+    write(path, "cd", mtime=1_000_100)  #same size, newer file
+    assert cache.get("k", path, loader) == 3
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 3
+    assert cache.stats()["invalidations"] == 2
+
+
+def test_wal_file_counts_as_a_change(tmp_path):
+    path = str(tmp_path / "climate.db")
+    write(path, "db")
+    cache = metacache.MetadataCache()
+    assert cache.get("k", path, lambda: "old") == "old"
+    write(path + "-wal", "log")
+    assert cache.get("k", path, lambda: "new") == "new"
+
+
+def test_missing_file_is_a_signature_too(tmp_path):
+    path = str(tmp_path / "missing.db")
+    cache = metacache.MetadataCache()
+    assert cache.get("k", path, lambda: 1) == 1
+    assert cache.get("k", path, lambda: 2) == 1
+
+
+def test_ttl(tmp_path, monkeypatch):
+    path = str(tmp_path / "data.csv")
+    write(path, "a")
+    now = [100.0]
+    monkeypatch.setattr(metacache.time, "monotonic", lambda: now[0])
+    cache = metacache.MetadataCache()
+    assert cache.get("k", path, lambda: 1, ttl=10) == 1
+    now[0] = 109.0
+    assert cache.get("k", path, lambda: 2, ttl=10) == 1
+    now[0] = 110.0
+    assert cache.get("k", path, lambda: 3, ttl=10) == 3
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    path = str(tmp_path / "data.csv")
+    write(path, "a")
+    cache = metacache.MetadataCache(max_entries=2)
+    cache.get("a", path, lambda: "a")
+    cache.get("b", path, lambda: "b")
+    cache.get("a", path, lambda: "a again")
+    cache.get("c", path, lambda: "c")
+    assert cache.get("a", path, lambda: "a reloaded") == "a"
+    assert cache.get("b", path, lambda: "b reloaded") == "b reloaded"
+    assert cache.stats()["evictions"] == 2
+    assert cache.stats()["entries"] == 2
+
+
+def test_cached_decorator_keys_on_arguments(tmp_path):
+    path = str(tmp_path / "data.csv")
+    write(path, "a")
+    calls = []
+
+    @metacache.cached(path)
+    def get_value(x):
+        calls.append(x)
+        return x * 2
+
+    assert get_value(1) == 2
+    assert get_value(1) == 2
+    assert get_value(2) == 4
+    assert calls == [1, 2]
+    assert get_value.uncached(1) == 2
+    assert calls == [1, 2, 1]
+
+
+def test_cached_path_is_looked_up_per_call(tmp_path):
+    first, second = str(tmp_path / "first.db"), str(tmp_path / "second.db")
+    write(first, "a")
+    write(second, "b")
+    current = [first]
+    calls = []
+
+    @metacache.cached(lambda: current[0])
+    def get_source():
+        calls.append(current[0])
+        return current[0]
+
+    assert get_source() == first
+    current[0] = second
+    assert get_source() == second
+    current[0] = first
+    assert get_source() == first
+    assert calls == [first, second]
+
+
+def test_rollup_metrics_kept_per_database(base_db, tmp_path):
+    other = str(tmp_path / "other.db")
+    shutil.copyfile(base_db, other)
+    aggregates.build(other)
+    before = metacache.stats()["misses"]
+    for _ in range(2):
+        for database, expected in ((base_db, False), (other, True)):
+            conn = sqlite3.connect(database)
+            try:
+                assert aggregates.has_rollup(conn) is expected
+            finally:
+                conn.close()
+    assert metacache.stats()["misses"] == before + 2
@@ -0,0 +1,90 @@
+import email.utils
+import gzip
+import importlib
+import os
+import sys
+
+import pytest
+
+import assets
+import prerender
+
+PAGE_SOURCE = '''
+import os
+CACHE_FILE = os.path.join(os.path.dirname(__file__), "text.txt")
+ASSETS = ["logo.png"]
+STATIC_PAGE = True
+RENDERS = []
+
+def get_page_html(form_data):
+    RENDERS.append(1)
+    with open(CACHE_FILE, encoding="utf-8") as f:
+        return "<h1>{version}</h1><p>" + f.read() * 200 + "</p>"
+'''
+
+
+def write(path, text, mtime):
+    path.write_text(text, encoding="utf-8")
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def page(tmp_path, monkeypatch):
+    #A page module of its own, so it can be edited and reloaded
+    write(tmp_path / "text.txt", "hello ", 1_000_000)
+    write(tmp_path / "prerender_test_page.py", PAGE_SOURCE.replace("{version}", "one"), 1_000_000)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(assets, "url", lambda name: f"/assets/{name}.v1")
+    module = importlib.import_module("prerender_test_page")
+    yield module
+    sys.modules.pop("prerender_test_page", None)
+
+
+def test_variants(page):
+    entry = prerender.StaticPages().get(page)
+    body, etag = entry.variants["identity"]
+    assert body.startswith(b"<h1>one</h1><p>hello ")
+    gzipped, gzip_etag = entry.variants["gzip"]
+    assert gzip.decompress(gzipped) == body
+    assert gzip_etag == etag[:-1] + '-gzip"'
+    if "br" in entry.variants:
+        assert entry.variants["br"][1] == etag[:-1] + '-br"'
+    assert email.utils.parsedate_to_datetime(entry.last_modified).timestamp() == 1_000_000
+
+
+def test_built_once(page):
+    pages = prerender.StaticPages()
+    entry = pages.get(page)
+    assert pages.get(page) is entry
+    assert len(page.RENDERS) == 1
+
+
+def test_rebuilt_when_cache_file_changes(page, tmp_path):
+    pages = prerender.StaticPages()
+    first = pages.get(page)
+    write(tmp_path / "text.txt", "changed ", 1_000_100)
+    second = pages.get(page)
+    assert second is not first
+    assert b"changed" in second.variants["identity"][0]
+    assert second.variants["identity"][1] != first.variants["identity"][1]
+    assert email.utils.parsedate_to_datetime(second.last_modified).timestamp() == 1_000_100
+
+
+def test_rebuilt_when_an_asset_changes(page, monkeypatch):
+    pages = prerender.StaticPages()
+    first = pages.get(page)
+    monkeypatch.setattr(assets, "url", lambda name: f"/assets/{name}.v2")
+    assert pages.get(page) is not first
+    assert len(page.RENDERS) == 2
+
+
+def test_changed_module_is_reloaded(page, tmp_path):
+    pages = prerender.StaticPages()
+    assert pages.get(page).variants["identity"][0].startswith(b"<h1>one</h1>")
+    write(tmp_path / "prerender_test_page.py", PAGE_SOURCE.replace("{version}", "two"), 1_000_100)
+    assert pages.get(page).variants["identity"][0].startswith(b"<h1>two</h1>")
+
+
+def test_fragments_are_joined(page, monkeypatch):
+    monkeypatch.setattr(page, "get_page_html", lambda form_data: iter(["<p>", b"bytes", "</p>"]))
+    assert prerender.build(page) == b"<p>bytes</p>"
@@ -0,0 +1,373 @@
+import email.utils
+import gzip
+import http.client
+import os
+import socket
+import threading
+import time
+import types
+import zlib
+
+import pytest
+
+import prerender
+import pyhtml
+import student_a_level_2
+import student_a_level_3
+import student_b_level_3
+import templates
+
+
+BIG_PAGE = "<html><body>" + "".join(f"<p>row {i}</p>" for i in range(2000)) + "</body></html>"
+
+
+def make_page(html, **options):
+    page = types.SimpleNamespace(get_page_html=lambda form_data: html() if callable(html) else html)
+    for name, value in options.items():
+        setattr(page, name, value)
+    return page
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    #A real server on a free port, in a thread, with a few test pages and an empty static_dir
+    static = tmp_path / "static"
+    static.mkdir()
+    monkeypatch.setattr(pyhtml, "static_dir", str(static))
+    monkeypatch.setattr(pyhtml.MyRequestHandler, "protocol_version", "HTTP/1.1")
+    monkeypatch.setattr(pyhtml.MyRequestHandler, "pages", {})
+    pages = pyhtml.MyRequestHandler.pages
+    pages["/big"] = make_page(BIG_PAGE)
+    pages["/small"] = make_page("<p>hi</p>")
+    pages["/cached"] = make_page(BIG_PAGE, CACHE_TTL=60)
+    pyhtml.response_cache.clear()
+    httpd = pyhtml.PooledTCPServer(("127.0.0.1", 0), pyhtml.MyRequestHandler, workers=2, backlog=4)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield types.SimpleNamespace(port=httpd.server_address[1], pages=pages, static=static)
+    httpd.shutdown()
+    httpd.server_close()
+    pyhtml.response_cache.clear()
+
+
+def get(server, path, conn=None, **headers):
+    #(status, headers, body) of one request, on `conn` if given
+    own = conn is None
+    conn = conn or http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    try:
+        conn.request("GET", path, headers={k.replace("_", "-"): v for k, v in headers.items()})
+        response = conn.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        if own:
+            conn.close()
+
+
+def decode(body, encoding):
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "deflate":
+        return zlib.decompress(body)
+    assert encoding is None
+    return body
+
+
+#Encoding negotiation
+
+def test_accepted_encodings():
+    assert pyhtml.get_accepted_encodings("gzip;q=0.5, BR, identity;q=0, zstd;q=x") == {
+        "gzip": 0.5, "br": 1.0, "identity": 0.0, "zstd": 0.0}
+    assert pyhtml.get_accepted_encodings(None) == {}
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, "identity"),
+    ("", "identity"),
+    ("gzip", "gzip"),
+    ("deflate, gzip", "gzip"),  #ours to choose when the client has no preference
+    ("gzip;q=0.5, deflate", "deflate"),
+    ("br;q=1, gzip;q=0.5", "gzip"),  #br isn't available here
+    ("gzip;q=0", "identity"),
+    ("*", "gzip"),
+    ("*;q=0.2, gzip;q=0", "deflate"),
+    ("compress", "identity"),
+])
+def test_choose_encoding(header, expected):
+    assert pyhtml.choose_encoding(header, ["gzip", "deflate"]) == expected
+
+
+@pytest.mark.parametrize("encoding", pyhtml.get_compress_encodings())
+def test_compressor_flushes_decodable_pieces(encoding):
+    if encoding not in ("gzip", "deflate"):
+        pytest.skip("only gzip/deflate can be decoded here without extra packages")
+    compressor = pyhtml.Compressor(encoding)
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+    assert decoder.decompress(compressor.compress(b"first piece", flush=True)) == b"first piece"
+    assert decoder.decompress(compressor.compress(b" second", flush=True) + compressor.finish()) == b" second"
+
+
+#Response cache and 304s
+
+def test_cache_key_ignores_parameter_order():
+    assert pyhtml.get_cache_key("/p", {"b": ["2"], "a": ["1"]}) == pyhtml.get_cache_key("/p", {"a": ["1"], "b": ["2"]})
+    assert pyhtml.get_cache_key("/p", {"a": ["1"]}) != pyhtml.get_cache_key("/p", {"a": ["2"]})
+
+
+def test_page_is_rendered_once_while_cached(server):
+    renders = []
+    server.pages["/counted"] = make_page(lambda: renders.append(1) or BIG_PAGE, CACHE_TTL=60)
+    for query in ("?a=1&b=2", "?b=2&a=1", "?a=1&b=2"):
+        assert get(server, "/counted" + query)[2] == BIG_PAGE.encode()
+    assert len(renders) == 1
+    get(server, "/counted?a=2")
+    assert len(renders) == 2
+
+
+def test_etag_304(server):
+    _, headers, _ = get(server, "/big")
+    status, headers_304, body = get(server, "/big", If_None_Match=headers["ETag"])
+    assert (status, headers_304["ETag"], body) == (304, headers["ETag"], b"")
+    assert get(server, "/big", If_None_Match=f'"other", {headers["ETag"]}')[0] == 304
+    assert get(server, "/big", If_None_Match='"other"')[0] == 200
+
+
+def test_cached_page_if_modified_since(server):
+    _, headers, _ = get(server, "/cached")
+    last_modified = headers["Last-Modified"]
+    assert get(server, "/cached", If_Modified_Since=last_modified)[0] == 304
+    earlier = email.utils.formatdate(email.utils.parsedate_to_datetime(last_modified).timestamp() - 10, usegmt=True)
+    assert get(server, "/cached", If_Modified_Since=earlier)[0] == 200
+    assert "Last-Modified" not in get(server, "/big")[1]
+
+
+def test_error_page_is_not_cached(server):
+    results = [templates.Uncached("<pre>Error: database is locked</pre>"), BIG_PAGE]
+    server.pages["/flaky"] = make_page(lambda: results.pop(0), CACHE_TTL=60)
+    assert get(server, "/flaky")[2] == b"<pre>Error: database is locked</pre>"
+    assert pyhtml.response_cache.stats()["entries"] == 0
+    assert get(server, "/flaky")[2] == BIG_PAGE.encode()
+    assert get(server, "/flaky")[2] == BIG_PAGE.encode()
+    assert pyhtml.response_cache.stats()["entries"] == 1
+
+
+def fail(*args):
+    raise RuntimeError("database is locked")
+
+
+def test_page_modules_mark_errors_uncached(pages_db, monkeypatch):
+    monkeypatch.setattr(student_a_level_2, "get_station_data", fail)
+    page = student_a_level_2.get_page_html({"state": ["NSW"], "lat_start": ["-40"], "lat_end": ["-10"], "metric": ["max_temp"]})
+    assert isinstance(page, templates.Uncached) and "database is locked" in page
+    monkeypatch.setattr(student_a_level_3, "get_similar_stations", fail)
+    rows = student_a_level_3.get_table_rows(True, "2000-01-01", "2000-12-31", "2001-01-01", "2001-12-31", "max_temp", "1000", 5)
+    assert isinstance(rows, templates.Uncached) and "database is locked" in rows
+    monkeypatch.setattr(student_b_level_3, "get_similar_metrics", fail)
+    rows = student_b_level_3.get_table_rows(True, "2000-01-01", "2000-12-31", "2001-01-01", "2001-12-31", "max_temp", "1000", 5)
+    assert isinstance(rows, templates.Uncached) and "database is locked" in rows
+
+
+#Compression
+
+@pytest.mark.parametrize("encoding", ["gzip", "deflate"])
+def test_page_is_compressed(server, encoding):
+    status, headers, body = get(server, "/big", Accept_Encoding=encoding)
+    assert status == 200
+    assert headers["Content-Encoding"] == encoding
+    assert headers["Vary"] == "Accept-Encoding"
+    assert int(headers["Content-Length"]) == len(body) < len(BIG_PAGE)
+    assert decode(body, encoding) == BIG_PAGE.encode()
+
+
+def test_small_page_is_not_compressed(server):
+    status, headers, body = get(server, "/small", Accept_Encoding="gzip")
+    assert "Content-Encoding" not in headers
+    assert body == b"<p>hi</p>"
+
+
+def test_etag_per_encoding_and_304(server):
+    _, plain, _ = get(server, "/big")
+    _, gzipped, _ = get(server, "/big", Accept_Encoding="gzip")
+    assert gzipped["ETag"] == plain["ETag"][:-1] + '-gzip"'
+    status, headers, body = get(server, "/big", Accept_Encoding="gzip", If_None_Match=gzipped["ETag"])
+    assert (status, headers["ETag"], body) == (304, gzipped["ETag"], b"")
+    #The plain copy's ETag doesn't match the gzip copy the client would get now
+    status, _, _ = get(server, "/big", Accept_Encoding="gzip", If_None_Match=plain["ETag"])
+    assert status == 200
+    status, _, _ = get(server, "/big", If_None_Match=f'"other", {plain["ETag"]}')
+    assert status == 304
+
+
+def test_compressed_copies_count_in_the_cache(server):
+    hits = pyhtml.response_cache.stats()["hits"]
+    get(server, "/cached")
+    assert pyhtml.response_cache.stats()["bytes"] == len(BIG_PAGE)
+    _, _, gzipped = get(server, "/cached", Accept_Encoding="gzip")
+    get(server, "/cached", Accept_Encoding="gzip")
+    assert pyhtml.response_cache.stats()["bytes"] == len(BIG_PAGE) + len(gzipped)
+    assert pyhtml.response_cache.stats()["hits"] == hits + 2
+
+
+#Streamed pages
+
+def fragments():
+    yield "<html><body>"
+    for i in range(300):
+        yield f"<p>streamed row {i}</p>" * 10
+    yield b"</body></html>"
+
+
+STREAMED_PAGE = "".join(f if isinstance(f, str) else f.decode() for f in fragments()).encode()
+
+
+def wait_for_cache_entries(count):
+    #The finished page goes into the cache just after its last chunk is sent
+    deadline = time.monotonic() + 2
+    while pyhtml.response_cache.stats()["entries"] < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return pyhtml.response_cache.stats()["entries"]
+
+
+@pytest.mark.parametrize("encoding", [None, "gzip"])
+def test_streamed_page(server, encoding):
+    server.pages["/stream"] = make_page(fragments)
+    status, headers, body = get(server, "/stream", **({"Accept_Encoding": encoding} if encoding else {}))
+    assert status == 200
+    assert headers["Transfer-Encoding"] == "chunked"
+    assert headers.get("Content-Encoding") == encoding
+    assert decode(body, encoding) == STREAMED_PAGE
+
+
+def test_streamed_page_is_cached(server):
+    server.pages["/stream"] = make_page(fragments, CACHE_TTL=60)
+    get(server, "/stream")
+    assert wait_for_cache_entries(1) == 1
+    status, headers, body = get(server, "/stream")
+    assert "Transfer-Encoding" not in headers
+    assert int(headers["Content-Length"]) == len(body)
+    assert body == STREAMED_PAGE
+
+
+def failing_fragments():
+    yield "<table>"
+    yield templates.Uncached("<tr><td>Error: database is locked</td></tr>")
+    yield "</table>"
+
+
+@pytest.mark.parametrize("option", ["too_big", "opted_out", "error"])
+def test_streamed_page_not_cached(server, monkeypatch, option):
+    expected = STREAMED_PAGE
+    if option == "too_big":
+        monkeypatch.setattr(pyhtml, "stream_cache_max_bytes", 1024)
+        server.pages["/stream"] = make_page(fragments, CACHE_TTL=60)
+    elif option == "opted_out":
+        server.pages["/stream"] = make_page(fragments, CACHE_TTL=60, CACHE_STREAMED=False)
+    else:
+        server.pages["/stream"] = make_page(failing_fragments, CACHE_TTL=60)
+        expected = b"<table><tr><td>Error: database is locked</td></tr></table>"
+    assert get(server, "/stream")[2] == expected
+    time.sleep(0.2)
+    assert pyhtml.response_cache.stats()["entries"] == 0
+    assert get(server, "/stream")[1]["Transfer-Encoding"] == "chunked"
+
+
+#Pre-rendered pages
+
+@pytest.fixture
+def static_page(server, tmp_path):
+    source = tmp_path / "static_page.py"
+    source.write_text("#static test page\n")
+    page = types.ModuleType("static_page")
+    page.__file__ = str(source)
+    page.STATIC_PAGE = True
+    page.get_page_html = lambda form_data: BIG_PAGE
+    server.pages["/static"] = page
+    return page
+
+
+def test_static_page(server, static_page):
+    status, headers, body = get(server, "/static", Accept_Encoding="gzip")
+    assert status == 200 and headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(body) == BIG_PAGE.encode()
+    assert headers["Last-Modified"]
+    assert get(server, "/static", Accept_Encoding="gzip", If_None_Match=headers["ETag"])[0] == 304
+    _, plain, body = get(server, "/static")
+    assert body == BIG_PAGE.encode() and plain["ETag"] != headers["ETag"]
+
+
+def test_static_page_without_brotli(server, static_page, monkeypatch):
+    monkeypatch.setattr(prerender, "brotli", None)
+    prerender.static_pages.clear()
+    _, headers, body = get(server, "/static", Accept_Encoding="br, gzip;q=0.5")
+    assert headers["Content-Encoding"] == "gzip" and gzip.decompress(body) == BIG_PAGE.encode()
+    _, headers, body = get(server, "/static", Accept_Encoding="br")
+    assert "Content-Encoding" not in headers and body == BIG_PAGE.encode()
+
+
+#Keep-alive
+
+def test_requests_share_a_connection(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    try:
+        status, headers, _ = get(server, "/small", conn)
+        sock = conn.sock
+        assert status == 200 and headers["Keep-Alive"].startswith("timeout=")
+        for path in ("/big", "/small"):
+            assert get(server, path, conn)[0] == 200
+            assert conn.sock is sock
+    finally:
+        conn.close()
+
+
+def test_connection_closed_after_max_requests(server, monkeypatch):
+    monkeypatch.setattr(pyhtml, "keep_alive_max_requests", 2)
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    try:
+        assert "Connection" not in get(server, "/small", conn)[1]
+        assert get(server, "/small", conn)[1]["Connection"] == "close"
+    finally:
+        conn.close()
+
+
+def test_idle_connection_is_closed(server, monkeypatch):
+    monkeypatch.setattr(pyhtml, "keep_alive_timeout", 0.2)
+    with socket.create_connection(("127.0.0.1", server.port), timeout=5) as sock:
+        sock.sendall(b"GET /small HTTP/1.1\r\nHost: test\r\n\r\n")
+        received = b""
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            received += data
+    assert received.startswith(b"HTTP/1.1 200") and received.endswith(b"<p>hi</p>")
+
+
+def test_http_1_0_closes(server):
+    with socket.create_connection(("127.0.0.1", server.port), timeout=5) as sock:
+        sock.sendall(b"GET /small HTTP/1.0\r\n\r\n")
+        received = b""
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            received += data
+    assert received.startswith(b"HTTP/1.1 200") and received.endswith(b"<p>hi</p>")
+
+
+#Static files
+
+def test_only_static_dir_is_served(server):
+    (server.static / "style.css").write_text("body { color: red; }")
+    assert get(server, "/style.css")[2] == b"body { color: red; }"
+    for path in ("/pyhtml.py", "/database/climate.db", "/../pyhtml.py", "/missing.css"):
+        assert get(server, path)[0] == 404, path
+    os.mkdir(server.static / "sub")
+    assert get(server, "/sub/")[0] == 404
+
+
+def test_precompressed_static_file(server):
+    css = b"body { color: red; }" * 50
+    (server.static / "style.css").write_bytes(css)
+    (server.static / "style.css.gz").write_bytes(gzip.compress(css))
+    status, headers, body = get(server, "/style.css", Accept_Encoding="gzip")
+    assert headers["Content-Encoding"] == "gzip" and gzip.decompress(body) == css
+    assert get(server, "/style.css")[2] == css
@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+import ranking
+
+
+def test_pct_change():
+    assert ranking.pct_change(10.0, 15.0) == 50.0
+    assert ranking.pct_change(10.0, 5.0) == -50.0
+    assert ranking.pct_change(0, 5.0) is None
+    assert ranking.pct_change(None, 5.0) is None
+    assert ranking.pct_change(5.0, None) is None
+
+
+def test_rounded_abs_diff_ties_equal_shown_values():
+    assert ranking.rounded_abs_diff(1.004, 1.0) == ranking.rounded_abs_diff(0.996, 1.0) == 0.0
+    assert ranking.rounded_abs_diff(3.0, 1.5) == 1.5
+
+
+def test_ties_keep_input_order():
+    candidates = [(2.0, "a"), (0.0, "b"), (2.0, "c"), (4.0, "d"), (0.0, "e"), (2.0, "f")]
+    #Distances from 1.0: a 1, b 1, c 1, d 3, e 1, f 1
+    assert [item for _, _, item in ranking.top_k(candidates, 3, 1.0)] == ["a", "b", "c"]
+    assert [item for _, _, item in ranking.top_k(candidates, 5, 1.0)] == ["a", "b", "c", "e", "f"]
+
+
+def test_same_as_stable_sort():
+    rnd = random.Random(3)
+    candidates = [(round(rnd.uniform(-5, 5), 1), i) for i in range(500)]
+    candidates[::7] = [(None, i) for _, i in candidates[::7]]
+    present = [(v, i) for v, i in candidates if v is not None]
+    for k in (0, 1, 10, 200, 1000):
+        expected = sorted(present, key=lambda c: ranking.rounded_abs_diff(c[0], 0.3))[:k]
+        result = ranking.top_k(candidates, k, 0.3)
+        assert [(v, i) for _, v, i in result] == expected
+        assert [d for d, _, _ in result] == [ranking.rounded_abs_diff(v, 0.3) for v, _ in expected]
+
+
+def test_custom_distance():
+    candidates = [(10.0, "far"), (1.2, "near"), (-1.1, "nearer")]
+    result = ranking.top_k(candidates, 2, 0.0, distance=ranking.abs_diff)
+    assert [(item, d) for d, _, item in result] == [("nearer", pytest.approx(1.1)), ("near", pytest.approx(1.2))]
+
+
+def test_push_reports_whether_kept():
+    best = ranking.TopK(2)
+    assert best.push(5.0, 5.0, "a")
+    assert best.push(3.0, 3.0, "b")
+    assert not best.push(5.0, 5.0, "c")  #ties with the worst kept one, which came first
+    assert best.push(1.0, 1.0, "d")
+    assert [item for _, _, item in best.results()] == ["d", "b"]
+    assert ranking.TopK(-1).results() == []
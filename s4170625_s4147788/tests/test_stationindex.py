@@ -0,0 +1,59 @@
+import math
+import sqlite3
+
+import stationindex
+
+
+def get_stations(database):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute("SELECT station_id, latitude, longitude, UPPER(TRIM(state)) FROM weather_station;").fetchall()
+    finally:
+        conn.close()
+
+
+def distance(a, b):
+    return stationindex.get_distance(math.radians(a[1]), math.radians(a[2]), math.radians(b[1]), math.radians(b[2]))
+
+
+def test_band_matches_sql(climate_db):
+    conn = sqlite3.connect(climate_db)
+    try:
+        for state, lat_start, lat_end in [("NSW", -40.0, -25.0), ("VIC", -38.0, -37.0), ("QLD", -20.0, -10.0), ("XX", -90.0, 90.0)]:
+            expected = conn.execute("""
+                SELECT station_id FROM weather_station
+                WHERE UPPER(TRIM(state)) = ? AND latitude BETWEEN ? AND ?
+                ORDER BY latitude;
+            """, (state, lat_start, lat_end)).fetchall()
+            rows = stationindex.get_stations_in_band(climate_db, state, lat_start, lat_end)
+            assert [(row[0],) for row in rows] == expected
+    finally:
+        conn.close()
+
+
+def test_band_leaves_text_latitudes_to_sql(climate_db):
+    assert stationindex.get_stations_in_band(climate_db, "NSW", "south", "-10") is None
+    assert stationindex.get_stations_in_band(climate_db, "NSW", "nan", "-10") is None
+
+
+def test_nearest_matches_brute_force(climate_db):
+    stations = get_stations(climate_db)
+    for station in stations:
+        others = sorted((s for s in stations if s[0] != station[0]), key=lambda s: distance(station, s))
+        for n in (1, 3, len(stations)):
+            nearest = stationindex.get_nearest_stations(climate_db, station[0], n)
+            assert [distance(station, s) for s in others[:n]] == [
+                distance(station, next(s for s in stations if str(s[0]) == sid)) for sid in nearest]
+            assert str(station[0]) not in nearest
+
+
+def test_nearest_needs_coordinates():
+    rows = [(1, "A", "R", -30.0, None, "NSW"), (2, "B", "R", -31.0, None, "NSW")]
+    index = stationindex.StationIndex(rows, has_longitude=False)
+    assert index.band("NSW", -31.0, -30.0) == [rows[1], rows[0]]
+    assert index.nearest(-30.0, 150.0, 5) == []
+
+
+def test_unknown_station(climate_db):
+    assert stationindex.get_nearest_stations(climate_db, "99999", 3) is None
+    assert stationindex.get_nearest_stations(climate_db, get_stations(climate_db)[0][0], 0) == []
@@ -0,0 +1,64 @@
+import sqlite3
+
+import pytest
+
+import benchmark
+import student_a_level_2
+import templates
+
+
+def test_render_matches_str_format():
+    source = "<style>body {{ color: red; }}</style><h1>{title}</h1>{nav}<p>{count} rows</p>"
+    page = templates.Template(source, nav=templates.NAV_BAR)
+    values = {"title": "Climate", "count": 3}
+    assert page.render(**values) == source.format(nav=templates.NAV_BAR, **values).encode("utf-8")
+    assert page.slots == {"title", "count"}
+
+
+def test_braces_stay_literal():
+    page = templates.Template("a {{b}} {c} {{{d}}}", b="not used")
+    assert page.render(c="{x}", d="y") == b"a {b} {x} {y}"
+
+
+def test_constants_are_not_parsed_again():
+    page = templates.Template("<div>{top}</div><p>{body}</p>", top="{body} & {{")
+    assert page.slots == {"body"}
+    assert page.render(body="<b>") == b"<div>{body} & {{</div><p><b></p>"
+
+
+def test_values_are_inserted_as_given():
+    #The template doesn't escape: pages escape what they take from the database or the form
+    page = templates.Template("<td>{cell}</td>")
+    assert page.render(cell="A&amp;B") == b"<td>A&amp;B</td>"
+    assert page.render(cell=b"\xe2\x84\x83") == "<td>℃</td>".encode("utf-8")
+    assert page.render(cell=1.5) == b"<td>1.5</td>"
+    assert page.render(cell="℃") == "<td>℃</td>".encode("utf-8")
+
+
+def test_missing_value_is_an_error():
+    with pytest.raises(KeyError):
+        templates.Template("{a}{b}").render(a=1)
+
+
+@pytest.mark.parametrize("source", ["{0}", "{a.b}", "{a[0]}", "{a!r}", "{a:>5}", "{}"])
+def test_only_plain_names(source):
+    with pytest.raises(ValueError):
+        templates.Template(source)
+
+
+def test_page_escapes_database_text(pages_db):
+    conn = sqlite3.connect(pages_db)
+    try:
+        with conn:
+            conn.execute("UPDATE weather_station SET name = ?, region = ? WHERE station_id = (SELECT MIN(station_id) FROM weather_station);",
+                         ("Mt <Hotham> & Co", "\"North\" {region}"))
+        state, lat_min, lat_max = conn.execute(
+            "SELECT state, latitude - 1, latitude + 1 FROM weather_station ORDER BY station_id LIMIT 1;").fetchone()
+    finally:
+        conn.close()
+    page = benchmark.call(student_a_level_2.get_page_html, (
+        {"state": [state], "lat_start": [str(lat_min)], "lat_end": [str(lat_max)], "metric": ["max_temp"]},))
+    page = page.decode("utf-8") if isinstance(page, bytes) else page
+    assert "Mt &lt;Hotham&gt; &amp; Co" in page
+    assert "&quot;North&quot; {region}" in page
+    assert "<Hotham>" not in page